@@ -7,14 +7,123 @@ import os
 
 # set the command line arguments for the script
 def set_arguments():
+    return get_parser().parse_args()
+
+
+# the script's command line argument parser (also used by the benchmark to build its settings)
+def get_parser():
     parser = argparse.ArgumentParser(
         description='A quick way to load the complete GNAF and PSMA Admin Boundaries into Postgres, '
                     'simplified and ready to use as reference data for geocoding, analysis and visualisation.')
 
     parser.add_argument(
-        '--max-processes', type=int, default=3,
-        help='Maximum number of parallel processes to use for the data load. (Set it to the number of cores on the '
-             'Postgres server minus 2, limit to 12 if 16+ cores - there is minimal benefit beyond 12). Defaults to 3.')
+        '--max-processes', type=int,
+        help='Maximum number of parallel processes to use for the data load. If not set, it\'s the number of cores on '
+             'the Postgres server (max 16) and the number of jobs run at once is adjusted to the server\'s load '
+             '(see \'--adaptive-processes\'). Required if the server isn\'t on this machine - set it to the '
+             'server\'s cores.')
+    parser.add_argument(
+        '--adaptive-processes', action='store_true',
+        help='Adjust the number of jobs run at once in each step, up to \'--max-processes\', based on throughput, '
+             'lock waits and the number of active queries on the Postgres server. '
+             'Always on if \'--max-processes\' isn\'t set.')
+    parser.add_argument(
+        '--abort-on-failure', action='store_true',
+        help='Stop the run as soon as any parallel job fails, instead of logging the failure and carrying on.')
+
+    parser.add_argument(
+        '--shapefile-loader', default='copy', choices=['copy', 'sql'],
+        help='How shp2pgsql output is loaded: \'copy\' streams its dump format output into Postgres using COPY, '
+             '\'sql\' builds the INSERT statements in memory and runs them as one script. Defaults to \'copy\'.')
+
+    parser.add_argument(
+        '--parallel-meshblocks', action='store_true',
+        help='Load the per state meshblock Shapefiles in parallel into staging tables and merge them at the end, '
+             'instead of appending them to one table one at a time.')
+
+    parser.add_argument(
+        '--deferred-finalise', action='store_true',
+        help='Bulk load all census data CSV files first (each table is created & loaded with COPY FREEZE in one '
+             'transaction), then add their primary keys in a separate parallel step, with one ANALYZE for the '
+             'schema. Faster than finalising each table as it\'s loaded.')
+
+    parser.add_argument(
+        '--partitioned-tables', action='store_true',
+        help='Load all boundaries of a census table into one table, partitioned by boundary (e.g. g01 instead of '
+             'ced_g01, sa1_g01 etc...), with a primary key of boundary & region id. Requires Postgres 11+.')
+
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Skip the work completed by a previous load, unless its source files have changed. '
+             'Use this to restart a failed load, or to reload just the files that have changed. Web optimised '
+             'boundaries from a previous load are updated in place, rebuilding only the boundaries that changed.')
+
+    parser.add_argument(
+        '--output-format', default='geojson', choices=['geojson', 'mvt', 'topojson'],
+        help='Web optimised boundary output: \'geojson\' stores GeoJSON for each zoom level on every boundary row, '
+             '\'mvt\' builds Mapbox Vector Tiles into a tile table per boundary (z/x/y), \'topojson\' does both - '
+             'GeoJSON on each row, converted to TopoJSON tiles (shared edges stored once) for the tile table. '
+             'Defaults to \'geojson\'.')
+    parser.add_argument(
+        '--tile-min-zoom', type=int, default=4,
+        help='Lowest map zoom level to build vector tiles for and export to S3. Defaults to 4.')
+    parser.add_argument(
+        '--tile-max-zoom', type=int, default=10,
+        help='Highest map zoom level to build vector tiles for and export to S3 (max 17). Defaults to 10.')
+    parser.add_argument(
+        '--tile-size', type=int, default=256,
+        help='Size of the map tiles the boundaries are displayed on, in pixels. Bigger tiles have smaller pixels - '
+             'i.e. less simplified boundaries and more decimal places. Defaults to 256.')
+    parser.add_argument(
+        '--retina-scale', type=float, default=1.0,
+        help='Screen pixel ratio to optimise the boundaries for, e.g. 2 for high resolution (retina) screens. '
+             'Defaults to 1.')
+    parser.add_argument(
+        '--tolerance-pixels', type=float, default=7.0,
+        help='Area (in square pixels) of the details removed when simplifying the boundaries for each zoom level. '
+             'Defaults to 7.')
+
+    parser.add_argument(
+        '--cache-directory',
+        help='Directory for caching intermediate results between loads (e.g. parsed metadata spreadsheets). '
+             'Defaults to \'census-loader\' in the current user\'s cache directory (e.g. ~/.cache).')
+
+    # metrics & profiling
+    parser.add_argument(
+        '--metrics-file',
+        help='Append the metrics of each step and job (time queued & running, database time, rows, bytes, worker) '
+             'to this file, as JSON lines.')
+    parser.add_argument(
+        '--prometheus-file',
+        help='Write the load\'s metrics, summed by step & job type, to this file in the Prometheus text format '
+             '(e.g. for the node exporter\'s textfile collector). Updated after each step.')
+    parser.add_argument(
+        '--profile-directory',
+        help='Profile each worker process with cProfile, saving the stats to this directory as worker_<pid>.prof '
+             'when the workers shut down.')
+
+    parser.add_argument(
+        '--parquet-directory',
+        help='Export the census stats to Parquet files in this directory (one per census table & boundary, with '
+             'the metadata\'s long ids as column names). Uploaded to S3 as well if \'--s3-bucket\' is set. '
+             'Needs the pyarrow Python module.')
+
+    # S3 Options
+    parser.add_argument(
+        '--s3-bucket',
+        help='S3 bucket to export the web optimised boundaries to, as tiled GeoJSON files. '
+             'No export is done if this isn\'t set.')
+    parser.add_argument(
+        '--s3-prefix',
+        help='Folder (key prefix) in the S3 bucket to export the boundaries to. Defaults to \'census_<census-year>\'.')
+    parser.add_argument(
+        '--s3-compression', default='gzip', choices=['none', 'gzip', 'both'],
+        help='Pre-compress the exported files: \'gzip\' uploads them gzipped (with Content-Encoding set), '
+             '\'both\' adds a brotli copy of each file (*.br - needs the brotli Python module), '
+             '\'none\' uploads them uncompressed. Defaults to \'gzip\'.')
+    parser.add_argument(
+        '--s3-threads', type=int, default=8,
+        help='Number of concurrent S3 uploads per process. Defaults to 8.')
 
     # PG Options
     parser.add_argument(
@@ -59,7 +168,14 @@ def set_arguments():
     parser.add_argument(
         '--census-bdys-path', help='Local path to source admin boundary files.', required=True)
 
-    return parser.parse_args()
+    return parser
+
+
+# the current user's own cache directory - a shared directory (e.g. /tmp) would let other users plant cache files
+def get_default_cache_directory():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cache_home, "census-loader")
 
 
 # create the dictionary of settings
@@ -69,12 +185,34 @@ def get_settings(args):
     census_data_path = args.census_data_path or ""
     census_bdys_path = args.census_bdys_path or ""
 
-    settings['max_concurrent_processes'] = args.max_processes
+    settings['max_concurrent_processes'] = args.max_processes  # set from the server's cores if None
+    settings['adaptive_processes'] = args.adaptive_processes or args.max_processes is None
+    settings['abort_on_failure'] = args.abort_on_failure
+    settings['shapefile_dump_format'] = args.shapefile_loader == 'copy'
+    settings['parallel_meshblocks'] = args.parallel_meshblocks
+    settings['deferred_finalise'] = args.deferred_finalise
+    settings['partitioned_tables'] = args.partitioned_tables
+    settings['resume'] = args.resume
     settings['census_year'] = args.census_year
     settings['states'] = ["ACT", "NSW", "NT", "OT", "QLD", "SA", "TAS", "VIC", "WA"]
     settings['data_schema'] = args.data_schema or 'census_' + settings['census_year'] + '_data'
     settings['boundary_schema'] = args.boundary_schema or 'census_' + settings['census_year'] + '_bdys'
     settings['web_schema'] = args.web_schema or 'census_' + settings['census_year'] + '_web'
+    settings['cache_directory'] = args.cache_directory or get_default_cache_directory()
+    settings['parquet_directory'] = args.parquet_directory
+    settings['metrics_file'] = args.metrics_file
+    settings['prometheus_file'] = args.prometheus_file
+    settings['profile_directory'] = args.profile_directory
+    settings['output_format'] = args.output_format
+    settings['tile_min_zoom'] = max(args.tile_min_zoom, 4)
+    settings['tile_max_zoom'] = min(args.tile_max_zoom, 17)
+    settings['tile_size'] = args.tile_size
+    settings['retina_scale'] = args.retina_scale
+    settings['tolerance_square_pixels'] = args.tolerance_pixels
+    settings['s3_bucket'] = args.s3_bucket
+    settings['s3_prefix'] = args.s3_prefix or 'census_' + settings['census_year']
+    settings['s3_compression'] = args.s3_compression
+    settings['s3_upload_threads'] = args.s3_threads
     settings['data_directory'] = census_data_path.replace("\\", "/")
     settings['boundaries_directory'] = census_bdys_path.replace("\\", "/")
 
@@ -95,8 +233,8 @@ def get_settings(args):
     if settings['census_year'] == '2016':
         settings['metadata_file_prefix'] = "Metadata_"
         settings['metadata_file_type'] = ".xls"
-        settings["census_metadata_dicts"] = [{"table": "metadata_tables", "first_row": "table number"},
-                                             {"table": "metadata_stats", "first_row": "sequential"}]
+        settings["census_metadata_dicts"] = [{"table": "metadata_tables", "first_row": "table number", "columns": 3},
+                                             {"table": "metadata_stats", "first_row": "sequential", "columns": 6}]
 
         settings['data_file_prefix'] = "2016Census_"
         settings['data_file_type'] = ".csv"
@@ -104,6 +242,9 @@ def get_settings(args):
         settings['bdy_name_part'] = 3  # position in the data file name that equals it's census boundary name
         settings['region_id_field'] = "region_id"
 
+        # boundaries with ids that need the boundary type prefix added to match the census data (e.g. 'CED101')
+        settings['prefixed_boundaries'] = ["ced", "iare", "iloc", "ireg", "lga", "poa", "sed", "ssc"]
+
         settings['population_stat'] = "g3"
         settings['population_table'] = "g01"
         settings['indigenous_population_stat'] = "i3"
@@ -137,8 +278,8 @@ def get_settings(args):
     elif settings['census_year'] == '2011':
         settings['metadata_file_prefix'] = "Metadata_"
         settings['metadata_file_type'] = ".xlsx"
-        settings["census_metadata_dicts"] = [{"table": "metadata_tables", "first_row": "table number"},
-                                             {"table": "metadata_stats", "first_row": "sequential"}]
+        settings["census_metadata_dicts"] = [{"table": "metadata_tables", "first_row": "table number", "columns": 3},
+                                             {"table": "metadata_stats", "first_row": "sequential", "columns": 6}]
 
         settings['data_file_prefix'] = "2011Census_"
         settings['data_file_type'] = ".csv"
@@ -146,6 +287,8 @@ def get_settings(args):
         settings['bdy_name_part'] = 3  # position in the data file name that equals it's census boundary name
         settings['region_id_field'] = "region_id"
 
+        settings['prefixed_boundaries'] = list()
+
         settings['population_stat'] = "b3"
         settings['population_table'] = "b01"
         settings['indigenous_population_stat'] = "i3"
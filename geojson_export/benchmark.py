@@ -0,0 +1,707 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# *********************************************************************************************************************
+# benchmark
+# *********************************************************************************************************************
+#
+# Benchmarks the census loader against synthetic data: generates census metadata spreadsheets, stats CSV files and
+# polygon Shapefiles at a configurable scale, runs each stage of export_geojson_to_s3 against them and reports the
+# wall time, peak memory (RSS of the main process & the worker pool), rows/sec and database time of each stage.
+#
+# The results are saved as JSON, tagged with the git commit, to compare runs across commits and '--max-processes'
+# values.
+#
+# Pre-requisites:
+#  - the same Python modules as export_geojson_to_s3 & shp2pgsql on the path
+#  - a disposable Postgres/PostGIS database, e.g. a local Docker container:
+#      docker run -d --name census-bench -p 5433:5432 -e POSTGRES_PASSWORD=password -e POSTGRES_DB=geo \
+#        postgis/postgis -c shared_preload_libraries=pg_stat_statements
+#  - database time is read from the pg_stat_statements extension, if it's loaded (as above)
+#
+# Usage:
+#   python benchmark.py --pgport 5433 --max-processes 2 4 8 --features 5000 --output bench.json
+#   python benchmark.py --pgport 5433 --loader-args "--deferred-finalise --output-format mvt"
+#
+# WARNING: the benchmark schemas (census_bench_data, census_bench_bdys & census_bench_web) are dropped on each run
+#
+# *********************************************************************************************************************
+
+import argparse
+import arguments
+import checkpoint
+import csv
+import export_geojson_to_s3
+import json
+import logging
+import math
+import os
+import pandas
+import platform
+import psycopg2  # module needs to be installed
+import re
+import resource
+import shlex
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import utils
+
+from datetime import datetime
+
+# the synthetic boundaries are laid out as a grid over mainland Australia (GDA94 lat/longs)
+GRID_EXTENT = [113.0, -39.0, 153.0, -11.0]
+
+# how often peak memory is sampled
+RSS_SAMPLE_SECONDS = 0.2
+
+logger = logging.getLogger()
+
+
+def main():
+    full_start_time = datetime.now()
+
+    args = set_arguments()
+
+    data_path = os.path.join(args.work_dir, "data")
+    bdys_path = os.path.join(args.work_dir, "bdys")
+
+    boundaries = [boundary.lower() for boundary in args.boundaries]
+
+    # create the synthetic census data
+    start_time = datetime.now()
+    logger.info("Generating synthetic census data in {0}".format(args.work_dir))
+
+    row_counts = generate_data(data_path, bdys_path, boundaries, args)
+
+    logger.info("\t- {0} tables, {1} boundaries, {2} features per boundary, {3} vertices per polygon : {4}"
+                .format(args.tables, len(boundaries), args.features, row_counts["vertices"],
+                        datetime.now() - start_time))
+
+    # run the loader once per process count
+    runs = list()
+
+    for max_processes in args.max_processes:
+        logger.info("")
+        logger.info("Benchmarking with {0} processes".format(max_processes))
+
+        run = run_benchmark(max_processes, data_path, bdys_path, boundaries, row_counts, args)
+
+        if run is None:
+            return False
+
+        runs.append(run)
+
+    results = dict()
+    results["commit"] = get_git_commit()
+    results["timestamp"] = full_start_time.isoformat()
+    results["host"] = platform.node()
+    results["python_version"] = platform.python_version()
+    results["postgres_version"] = runs[0].pop("postgres_version")
+    results["parameters"] = {"boundaries": boundaries, "features": args.features,
+                             "vertices_per_side": args.vertices_per_side, "tables": args.tables,
+                             "stats_per_table": args.stats_per_table, "loader_args": args.loader_args}
+    results["runs"] = runs
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    logger.info("")
+    logger.info("Results saved to {0}".format(args.output))
+
+    if not args.keep_data:
+        shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    return True
+
+
+# set the command line arguments for the benchmark
+def set_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks each stage of the census loader against synthetic census data & boundaries.')
+
+    parser.add_argument(
+        '--max-processes', type=int, nargs='+', default=[3],
+        help='Process counts to benchmark the loader with, e.g. \'--max-processes 2 4 8\'. Defaults to 3.')
+    parser.add_argument(
+        '--loader-args', default='',
+        help='Extra export_geojson_to_s3 arguments to benchmark with, as one string '
+             '(e.g. "--deferred-finalise --output-format mvt").')
+
+    # scale of the synthetic data
+    parser.add_argument(
+        '--boundaries', nargs='+', default=['ced', 'lga', 'sa2'],
+        help='Census boundary types to generate (2016 names, excluding meshblocks). Defaults to \'ced lga sa2\'.')
+    parser.add_argument(
+        '--features', type=int, default=1000,
+        help='Number of polygons (and census regions) per boundary type. Defaults to 1000.')
+    parser.add_argument(
+        '--vertices-per-side', type=int, default=25,
+        help='Number of vertices along each side of a polygon. Defaults to 25.')
+    parser.add_argument(
+        '--tables', type=int, default=10,
+        help='Number of census tables (i.e. CSV files per boundary type), max 99. Defaults to 10.')
+    parser.add_argument(
+        '--stats-per-table', type=int, default=50,
+        help='Number of stats (columns) per census table, min 3. Defaults to 50.')
+
+    # output
+    parser.add_argument(
+        '--work-dir', default=os.path.join(tempfile.gettempdir(), "census-loader-benchmark"),
+        help='Directory to create the synthetic data in. Defaults to \'census-loader-benchmark\' in the '
+             'system temp directory.')
+    parser.add_argument(
+        '--keep-data', action='store_true',
+        help='Keep the synthetic data after the run.')
+    parser.add_argument(
+        '--output', default='benchmark_{0}.json'.format(datetime.now().strftime("%Y%m%d_%H%M%S")),
+        help='File to save the results to, as JSON. Defaults to \'benchmark_<timestamp>.json\'.')
+
+    # PG Options
+    parser.add_argument(
+        '--pghost',
+        help='Host name for Postgres server. Defaults to PGHOST environment variable if set, otherwise localhost.')
+    parser.add_argument(
+        '--pgport', type=int,
+        help='Port number for Postgres server. Defaults to PGPORT environment variable if set, otherwise 5432.')
+    parser.add_argument(
+        '--pgdb',
+        help='Database name for Postgres server. Defaults to PGDATABASE environment variable if set, '
+             'otherwise geo.')
+    parser.add_argument(
+        '--pguser',
+        help='Username for Postgres server. Defaults to PGUSER environment variable if set, otherwise postgres.')
+    parser.add_argument(
+        '--pgpassword',
+        help='Password for Postgres server. Defaults to PGPASSWORD environment variable if set, '
+             'otherwise \'password\'.')
+
+    args = parser.parse_args()
+
+    # the population stat (g3) needs to be in the population table (g01). table numbers are 2 digits
+    args.tables = min(max(args.tables, 1), 99)
+    args.stats_per_table = max(args.stats_per_table, 3)
+    args.vertices_per_side = max(args.vertices_per_side, 1)
+    args.features = max(args.features, 1)
+
+    return args
+
+
+# gets the loader's settings for a benchmark run, exactly as export_geojson_to_s3 would from the command line
+def get_settings(max_processes, data_path, bdys_path, boundaries, args):
+    loader_args = ["--max-processes", str(max_processes),
+                   "--census-year", "2016",
+                   "--data-schema", "census_bench_data",
+                   "--boundary-schema", "census_bench_bdys",
+                   "--web-schema", "census_bench_web",
+                   "--cache-directory", os.path.join(args.work_dir, "cache"),
+                   "--census-data-path", data_path,
+                   "--census-bdys-path", bdys_path]
+
+    for arg_name in ["pghost", "pgport", "pgdb", "pguser", "pgpassword"]:
+        if getattr(args, arg_name) is not None:
+            loader_args += ["--" + arg_name, str(getattr(args, arg_name))]
+
+    settings = arguments.get_settings(arguments.get_parser().parse_args(loader_args + shlex.split(args.loader_args)))
+
+    # only process the generated boundaries
+    settings['bdy_table_dicts'] = [boundary_dict for boundary_dict in settings['bdy_table_dicts']
+                                   if boundary_dict["boundary"] in boundaries]
+
+    return settings
+
+
+# runs each stage of the loader against a clean set of schemas, measuring each stage
+def run_benchmark(max_processes, data_path, bdys_path, boundaries, row_counts, args):
+    settings = get_settings(max_processes, data_path, bdys_path, boundaries, args)
+
+    # start with nothing cached or loaded, so every run does the same work
+    shutil.rmtree(settings['cache_directory'], ignore_errors=True)
+
+    if not utils.set_process_count(settings, logger):
+        return None
+
+    utils.start_pool(settings)
+
+    try:
+        pg_conn = psycopg2.connect(settings['pg_connect_string'])
+    except psycopg2.Error:
+        logger.fatal("Unable to connect to database\nACTION: Check your Postgres parameters and/or database security")
+        utils.stop_pool()
+        return None
+
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
+
+    pg_cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+
+    for schema in [settings['data_schema'], settings['boundary_schema'], settings['web_schema']]:
+        pg_cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE".format(schema))
+
+    utils.check_postgis_version(pg_cur, settings, logger)
+    checkpoint.create_manifest_table(pg_cur, settings)
+
+    pg_cur.execute("SHOW server_version")
+    postgres_version = pg_cur.fetchone()[0]
+
+    db_time_sql = get_db_time_sql(pg_cur)
+
+    if db_time_sql is None:
+        logger.warning("\t- pg_stat_statements isn't available - database times won't be reported")
+
+    # the loader's stages, with the rows each one processes
+    loader = export_geojson_to_s3
+    stage_list = list()
+    stage_list.append(("metadata", row_counts["metadata"],
+                       lambda: loader.create_metadata_tables(pg_cur, settings['metadata_file_prefix'],
+                                                             settings['metadata_file_type'], settings)))
+    stage_list.append(("census_data", row_counts["census_data"],
+                       lambda: loader.populate_data_tables(pg_cur, settings['data_file_prefix'],
+                                                           settings['data_file_type'], settings['table_name_part'],
+                                                           settings['bdy_name_part'], settings)))
+    if settings['parquet_directory'] is not None:
+        stage_list.append(("census_stats_export", row_counts["census_data"],
+                           lambda: loader.export_census_stats(pg_cur, settings)))
+    stage_list.append(("boundaries", row_counts["boundaries"], lambda: loader.load_boundaries(pg_cur, settings)))
+    stage_list.append(("display_boundaries", row_counts["boundaries"],
+                       lambda: loader.create_display_schema(pg_cur, settings)
+                       and loader.create_display_boundaries(pg_cur, settings)))
+    if settings['s3_bucket'] is not None:
+        stage_list.append(("s3_export", row_counts["boundaries"], lambda: loader.export_display_boundaries(settings)))
+
+    stages = list()
+    run_start_time = datetime.now()
+
+    for stage_name, rows, stage_function in stage_list:
+        stage = run_stage(stage_name, rows, stage_function, pg_cur, db_time_sql)
+        stages.append(stage)
+
+        logger.info("\t- {0} : {1:.2f}s, {2:.0f} rows/sec, peak RSS {3:.0f} MB, DB time {4}"
+                    .format(stage_name, stage["seconds"], stage["rows_per_second"], stage["peak_rss_mb"],
+                            "n/a" if stage["db_seconds"] is None else "{0:.2f}s".format(stage["db_seconds"])))
+
+        if not stage["success"]:
+            logger.warning("\t- {0} failed - skipping the remaining stages".format(stage_name))
+            break
+
+    pg_cur.close()
+    pg_conn.close()
+
+    utils.stop_pool()
+
+    run = dict()
+    run["max_processes"] = max_processes
+    run["postgres_version"] = postgres_version
+    run["seconds"] = (datetime.now() - run_start_time).total_seconds()
+    run["stages"] = stages
+
+    return run
+
+
+def run_stage(stage_name, rows, stage_function, pg_cur, db_time_sql):
+    if db_time_sql is not None:
+        pg_cur.execute("SELECT pg_stat_statements_reset()")
+
+    sampler = RssSampler()
+    sampler.start()
+
+    start_time = datetime.now()
+    success = stage_function()
+    seconds = (datetime.now() - start_time).total_seconds()
+
+    sampler.stop()
+
+    # total execution time of all statements run by the stage, across every connection
+    if db_time_sql is not None:
+        pg_cur.execute(db_time_sql)
+        db_seconds = float(pg_cur.fetchone()[0] or 0.0) / 1000.0
+    else:
+        db_seconds = None
+
+    stage = dict()
+    stage["stage"] = stage_name
+    stage["success"] = bool(success)
+    stage["seconds"] = seconds
+    stage["rows"] = rows
+    stage["rows_per_second"] = rows / seconds if seconds > 0 else 0.0
+    stage["peak_rss_mb"] = sampler.peak_rss / 1048576.0
+    stage["db_seconds"] = db_seconds
+
+    return stage
+
+
+# returns the SQL for the total database time recorded by pg_stat_statements, or None if it isn't available
+def get_db_time_sql(pg_cur):
+    try:
+        pg_cur.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+        pg_cur.execute("SELECT pg_stat_statements_reset()")
+    except psycopg2.Error:
+        return None
+
+    # the column was renamed in Postgres 13
+    pg_cur.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_name = 'pg_stat_statements' AND column_name IN ('total_exec_time', 'total_time')")
+    row = pg_cur.fetchone()
+
+    if row is None:
+        return None
+
+    return "SELECT sum({0}) FROM pg_stat_statements WHERE dbid = (SELECT oid FROM pg_database " \
+           "WHERE datname = current_database())".format(row[0])
+
+
+# samples the combined RSS of this process and all of its child processes (the worker pool & shp2pgsql) in a
+# background thread, keeping the peak
+class RssSampler(object):
+    def __init__(self):
+        self.peak_rss = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+        # no /proc (e.g. macOS) - fall back to the peak RSS of this process & its finished children (not the
+        # running workers). ru_maxrss is in KB on Linux, bytes on macOS
+        if self.peak_rss == 0:
+            multiplier = 1 if platform.system() == "Darwin" else 1024
+            self.peak_rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+                             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * multiplier
+
+    def _run(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, get_process_tree_rss(os.getpid()))
+
+            if self._stop_event.wait(RSS_SAMPLE_SECONDS):
+                break
+
+
+# total RSS in bytes of a process and its descendants, from /proc. returns 0 if /proc isn't available
+def get_process_tree_rss(root_pid):
+    if not os.path.isdir("/proc/{0}".format(root_pid)):
+        return 0
+
+    parent_dict = dict()
+    rss_dict = dict()
+
+    for pid in os.listdir("/proc"):
+        if pid.isdigit():
+            try:
+                with open("/proc/{0}/status".format(pid)) as status_file:
+                    for line in status_file:
+                        if line.startswith("PPid:"):
+                            parent_dict.setdefault(int(line.split()[1]), list()).append(int(pid))
+                        elif line.startswith("VmRSS:"):
+                            rss_dict[int(pid)] = int(line.split()[1]) * 1024
+            except (IOError, OSError):
+                pass  # the process has finished
+
+    total_rss = 0
+    pid_list = [root_pid]
+
+    while len(pid_list) > 0:
+        pid = pid_list.pop()
+        total_rss += rss_dict.get(pid, 0)
+        pid_list.extend(parent_dict.get(pid, list()))
+
+    return total_rss
+
+
+# creates the synthetic census data and returns the number of rows each stage will process
+def generate_data(data_path, bdys_path, boundaries, args):
+    for path in [data_path, bdys_path]:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    settings = get_settings(1, data_path, bdys_path, boundaries, args)
+
+    # census tables G01 to Gnn, with sequentially numbered stats (G1, G2...) across all tables
+    table_dict = dict()
+
+    for table_index in range(0, args.tables):
+        table_number = "G{0}".format(str(table_index + 1).zfill(2))
+        table_dict[table_number] = ["G{0}".format(table_index * args.stats_per_table + i + 1)
+                                    for i in range(0, args.stats_per_table)]
+
+    write_metadata_workbook(os.path.join(data_path, "Metadata_2016_Benchmark.xlsx"), table_dict)
+
+    for boundary_dict in settings['bdy_table_dicts']:
+        boundary_name = boundary_dict["boundary"]
+
+        # stats data ids have the boundary type prefix, boundary ids don't (as per the 2016 census)
+        region_ids = [str(10000 + i) for i in range(0, args.features)]
+
+        if boundary_name in settings['prefixed_boundaries']:
+            csv_region_ids = [boundary_name.upper() + region_id for region_id in region_ids]
+        else:
+            csv_region_ids = region_ids
+
+        for table_number, stat_list in table_dict.items():
+            file_path = os.path.join(data_path, "2016Census_{0}_AUS_{1}.csv".format(table_number,
+                                                                                 boundary_name.upper()))
+            write_census_csv(file_path, boundary_name, csv_region_ids, stat_list)
+
+        write_boundary_shapefile(os.path.join(bdys_path, "{0}_2016_AUST".format(boundary_name.upper())),
+                                 boundary_dict, region_ids, args.vertices_per_side)
+
+    num_boundaries = len(settings['bdy_table_dicts'])
+
+    row_counts = dict()
+    row_counts["metadata"] = args.tables * (args.stats_per_table + 1)
+    row_counts["census_data"] = args.tables * num_boundaries * args.features
+    row_counts["boundaries"] = num_boundaries * args.features
+    row_counts["vertices"] = args.vertices_per_side * 4 + 1
+
+    return row_counts
+
+
+# writes a census metadata spreadsheet: a sheet of tables and a sheet of stats, each with a few rows of titles
+# above the header row (like the ABS's spreadsheets)
+def write_metadata_workbook(file_path, table_dict):
+    title_rows = [["Australian Bureau of Statistics"], ["Synthetic census metadata for benchmarking"], []]
+
+    table_rows = title_rows + [["Table number", "Table name", "Table description"]]
+    stat_rows = title_rows + [["Sequential", "Short", "Long", "DataPack file", "Profile table",
+                               "Column heading description in profile"]]
+
+    for table_number, stat_list in table_dict.items():
+        table_rows.append([table_number, "Table {0}".format(table_number),
+                           "Synthetic stats table {0}".format(table_number)])
+
+        for i, stat in enumerate(stat_list):
+            stat_rows.append([stat, "Stat_{0}".format(i + 1), "{0}_Synthetic_stat_{1}".format(table_number, i + 1),
+                              table_number, table_number, "Synthetic stat {0}".format(i + 1)])
+
+    with pandas.ExcelWriter(file_path) as writer:
+        pandas.DataFrame(table_rows).to_excel(writer, sheet_name="Table Numbers", header=False, index=False)
+        pandas.DataFrame(stat_rows).to_excel(writer, sheet_name="Cell Descriptors Information", header=False,
+                                             index=False)
+
+
+def write_census_csv(file_path, boundary_name, region_ids, stat_list):
+    with open(file_path, "w") as csv_file:
+        writer = csv.writer(csv_file, lineterminator="\n")
+        writer.writerow(["{0}_CODE_2016".format(boundary_name.upper())] + stat_list)
+
+        for i, region_id in enumerate(region_ids):
+            writer.writerow([region_id] + [(i * 7 + j * 13) % 1000 for j in range(0, len(stat_list))])
+
+
+# writes a Shapefile of rectangular polygons in a grid, with the boundary's id, name & area fields. each side has
+# several vertices, wiggled so neighbouring polygons share their edges exactly (like real census boundaries)
+def write_boundary_shapefile(file_path, boundary_dict, region_ids, vertices_per_side):
+    columns = int(math.ceil(math.sqrt(len(region_ids))))
+    rows = int(math.ceil(len(region_ids) / float(columns)))
+    cell_size = min((GRID_EXTENT[2] - GRID_EXTENT[0]) / columns, (GRID_EXTENT[3] - GRID_EXTENT[1]) / rows)
+
+    vertex_spacing = cell_size / vertices_per_side
+
+    # a point on the grid of vertices, moved across the side it's on - points shared by polygons are identical.
+    # the corners of each polygon aren't moved, and the other points are moved by under half the vertex spacing, so
+    # the sides can't cross each other
+    def get_point(grid_x, grid_y):
+        x = GRID_EXTENT[0] + grid_x * vertex_spacing
+        y = GRID_EXTENT[1] + grid_y * vertex_spacing
+        wiggle = math.sin(grid_x * 12.9898 + grid_y * 78.233) * vertex_spacing * 0.3
+
+        if grid_x % vertices_per_side == 0 and grid_y % vertices_per_side != 0:
+            x += wiggle
+        elif grid_y % vertices_per_side == 0 and grid_x % vertices_per_side != 0:
+            y += wiggle
+
+        return x, y
+
+    polygons = list()
+
+    for i in range(0, len(region_ids)):
+        left = (i % columns) * vertices_per_side
+        bottom = (i // columns) * vertices_per_side
+        right = left + vertices_per_side
+        top = bottom + vertices_per_side
+
+        # outer rings are clockwise in Shapefiles
+        ring = [get_point(left, bottom + j) for j in range(0, vertices_per_side)]
+        ring += [get_point(left + j, top) for j in range(0, vertices_per_side)]
+        ring += [get_point(right, top - j) for j in range(0, vertices_per_side)]
+        ring += [get_point(right - j, bottom) for j in range(0, vertices_per_side)]
+        ring.append(ring[0])
+
+        if not is_simple_ring(ring, vertex_spacing):
+            raise ValueError("generated polygon {0} of {1} is self-intersecting".format(i, file_path))
+
+        polygons.append(ring)
+
+    # the DBF fields: the id, the columns in the name expression (e.g. "'SA1 ' || sa1_7dig16") & the area
+    name_columns = [column for column in re.findall(r"[a-z_][a-z0-9_]*",
+                                                    re.sub(r"'[^']*'", "", boundary_dict["name_field"]))
+                    if column != boundary_dict["id_field"]]
+
+    field_list = [(boundary_dict["id_field"], "C", 20, 0)]
+    field_list += [(column, "C", 50, 0) for column in name_columns]
+    field_list.append((boundary_dict["area_field"], "N", 18, 6))
+
+    record_list = list()
+
+    for region_id, ring in zip(region_ids, polygons):
+        centre_latitude = math.radians((ring[0][1] + ring[2 * vertices_per_side][1]) / 2.0)
+        area = (cell_size * 111.32) * (cell_size * 111.32 * math.cos(centre_latitude))
+
+        record_list.append([region_id] + ["Region {0}".format(region_id) for column in name_columns] + [area])
+
+    write_shp_and_shx(file_path, polygons)
+    write_dbf(file_path + ".dbf", field_list, record_list)
+
+    with open(file_path + ".prj", "w") as prj_file:
+        prj_file.write('GEOGCS["GCS_GDA_1994",DATUM["D_GDA_1994",SPHEROID["GRS_1980",6378137.0,298.257222101]],'
+                       'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+
+
+# is a ring valid - do none of its sides cross or touch, other than neighbouring sides at their shared vertex?
+# sides are only compared with the sides near them (bucketed by grid cells of the given size)
+def is_simple_ring(ring, bucket_size):
+    segments = list(zip(ring[:-1], ring[1:]))
+    bucket_dict = dict()
+
+    for i, (start, end) in enumerate(segments):
+        for bucket_x in range(int(math.floor(min(start[0], end[0]) / bucket_size)),
+                              int(math.floor(max(start[0], end[0]) / bucket_size)) + 1):
+            for bucket_y in range(int(math.floor(min(start[1], end[1]) / bucket_size)),
+                                  int(math.floor(max(start[1], end[1]) / bucket_size)) + 1):
+                bucket_dict.setdefault((bucket_x, bucket_y), list()).append(i)
+
+    checked = set()
+
+    for index_list in bucket_dict.values():
+        for i in index_list:
+            for j in index_list:
+                if j <= i + 1 or (i == 0 and j == len(segments) - 1) or (i, j) in checked:
+                    continue
+
+                checked.add((i, j))
+
+                if segments_intersect(segments[i], segments[j]):
+                    return False
+
+    return True
+
+
+def segments_intersect(segment_1, segment_2):
+    (a, b), (c, d) = segment_1, segment_2
+
+    def orientation(p, q, r):
+        value = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (value > 0) - (value < 0)
+
+    def on_segment(p, q, r):
+        return min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and min(p[1], r[1]) <= q[1] <= max(p[1], r[1])
+
+    o1, o2, o3, o4 = orientation(a, b, c), orientation(a, b, d), orientation(c, d, a), orientation(c, d, b)
+
+    if o1 != o2 and o3 != o4:
+        return True
+
+    return (o1 == 0 and on_segment(a, c, b)) or (o2 == 0 and on_segment(a, d, b)) or \
+        (o3 == 0 and on_segment(c, a, d)) or (o4 == 0 and on_segment(c, b, d))
+
+
+# writes the geometry (.shp) & index (.shx) files of a polygon Shapefile, one single ring polygon per record
+def write_shp_and_shx(file_path, polygons):
+    all_x = [point[0] for ring in polygons for point in ring]
+    all_y = [point[1] for ring in polygons for point in ring]
+    bbox = (min(all_x), min(all_y), max(all_x), max(all_y))
+
+    records = list()
+
+    for i, ring in enumerate(polygons):
+        ring_x = [point[0] for point in ring]
+        ring_y = [point[1] for point in ring]
+
+        content = struct.pack("<i4d2ii", 5, min(ring_x), min(ring_y), max(ring_x), max(ring_y), 1, len(ring), 0)
+        content += struct.pack("<{0}d".format(len(ring) * 2), *[value for point in ring for value in point])
+
+        records.append(struct.pack(">2i", i + 1, len(content) // 2) + content)
+
+    # file lengths are in 16 bit words
+    def get_header(file_length):
+        return struct.pack(">7i", 9994, 0, 0, 0, 0, 0, file_length // 2) + \
+               struct.pack("<2i8d", 1000, 5, bbox[0], bbox[1], bbox[2], bbox[3], 0.0, 0.0, 0.0, 0.0)
+
+    with open(file_path + ".shp", "wb") as shp_file:
+        shp_file.write(get_header(100 + sum([len(record) for record in records])))
+
+        for record in records:
+            shp_file.write(record)
+
+    with open(file_path + ".shx", "wb") as shx_file:
+        shx_file.write(get_header(100 + len(records) * 8))
+
+        offset = 100
+
+        for record in records:
+            shx_file.write(struct.pack(">2i", offset // 2, (len(record) - 8) // 2))
+            offset += len(record)
+
+
+# writes a dBASE III table. fields are (name, type, length, decimal places) tuples
+def write_dbf(file_path, field_list, record_list):
+    today = datetime.now()
+    header_length = 32 + len(field_list) * 32 + 1
+    record_length = 1 + sum([field[2] for field in field_list])
+
+    with open(file_path, "wb") as dbf_file:
+        dbf_file.write(struct.pack("<4BIHH20x", 3, today.year - 1900, today.month, today.day, len(record_list),
+                                   header_length, record_length))
+
+        for name, field_type, length, decimals in field_list:
+            dbf_file.write(struct.pack("<11sc4xBB14x", name.encode("ascii"), field_type.encode("ascii"), length,
+                                       decimals))
+
+        dbf_file.write(b"\r")
+
+        for record in record_list:
+            values = list()
+
+            for value, (name, field_type, length, decimals) in zip(record, field_list):
+                if field_type == "N":
+                    values.append("{0:.{1}f}".format(value, decimals).rjust(length)[:length])
+                else:
+                    values.append(str(value).ljust(length)[:length])
+
+            dbf_file.write((" " + "".join(values)).encode("ascii"))
+
+        dbf_file.write(b"\x1a")
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+if __name__ == '__main__':
+    # log to the screen only - the benchmark results are saved as JSON
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # the loader logs through its own module level logger
+    export_geojson_to_s3.logger = logger
+
+    logger.info("")
+    logger.info("Start census-loader benchmark")
+    utils.check_python_version(logger)
+
+    if main():
+        logger.info("Finished successfully!")
+    else:
+        logger.fatal("Something bad happened!")
+
+    logger.info("")
+    logger.info("-------------------------------------------------------------------------------")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# records each completed unit of work (metadata file, CSV file, Shapefile, display boundary) in a manifest table,
+# along with the size, modified time & hash of its source file(s). When the load is rerun with --resume, units whose
+# source files haven't changed are skipped
+
+import hashlib
+import os
+
+
+# files that make up a Shapefile - a change to any of them means the Shapefile needs reloading
+SHAPEFILE_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+
+def get_manifest_table(settings):
+    return "{0}.load_manifest".format(settings['data_schema'])
+
+
+def create_manifest_table(pg_cur, settings):
+    if settings['data_schema'] != "public":
+        pg_cur.execute("CREATE SCHEMA IF NOT EXISTS {0} AUTHORIZATION {1}"
+                       .format(settings['data_schema'], settings['pg_user']))
+
+    sql = "CREATE TABLE IF NOT EXISTS {0} (unit_type text NOT NULL, unit_name text NOT NULL, source_path text, " \
+          "source_size bigint, source_mtime double precision, source_hash text, " \
+          "completed timestamp with time zone NOT NULL DEFAULT now(), PRIMARY KEY (unit_type, unit_name)) " \
+          "WITH (OIDS=FALSE)".format(get_manifest_table(settings))
+    pg_cur.execute(sql)
+
+
+# all files that make up a source file (i.e. a Shapefile's .dbf, .shx etc...)
+def get_source_files(file_path):
+    stem, extension = os.path.splitext(file_path)
+
+    if extension.lower() != ".shp":
+        return [file_path]
+
+    file_list = list()
+
+    for file_name in sorted(os.listdir(os.path.dirname(file_path) or ".")):
+        component_path = os.path.join(os.path.dirname(file_path), file_name)
+        component_stem, component_extension = os.path.splitext(component_path)
+
+        if component_stem == stem and component_extension.lower() in SHAPEFILE_EXTENSIONS:
+            file_list.append(component_path)
+
+    return file_list
+
+
+# total size and latest modified time of a source file (and its component files)
+def get_file_signature(file_path):
+    size = 0
+    mtime = 0.0
+
+    for component_path in get_source_files(file_path):
+        stats = os.stat(component_path)
+        size += stats.st_size
+        mtime = max(mtime, stats.st_mtime)
+
+    return size, mtime
+
+
+# MD5 hash of a source file (and its component files)
+def get_file_hash(file_path):
+    file_hash = hashlib.md5()
+
+    for component_path in get_source_files(file_path):
+        with open(component_path, "rb") as source_file:
+            for chunk in iter(lambda: source_file.read(1048576), b""):
+                file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+# returns a dictionary of completed units of one type, keyed by unit name
+def get_completed_units(pg_cur, unit_type, settings):
+    pg_cur.execute("SELECT unit_name, source_path, source_size, source_mtime, source_hash FROM {0} "
+                   "WHERE unit_type = %s".format(get_manifest_table(settings)), (unit_type,))
+
+    unit_dict = dict()
+
+    for row in pg_cur.fetchall():
+        unit_dict[row[0]] = {"path": row[1], "size": row[2], "mtime": row[3], "hash": row[4]}
+
+    return unit_dict
+
+
+# has the source file changed since the unit was completed? - only hashes the file if its size or time has changed
+def is_unit_current(unit, file_path):
+    if unit is None:
+        return False
+
+    if file_path is None:
+        return True
+
+    size, mtime = get_file_signature(file_path)
+
+    if unit["size"] == size and unit["mtime"] == mtime:
+        return True
+
+    return unit["size"] == size and unit["hash"] is not None and unit["hash"] == get_file_hash(file_path)
+
+
+# filters a work list down to the units that haven't been completed, or whose source files have changed.
+# returns the whole list if the run isn't resuming a previous load
+def get_pending_work(pg_cur, unit_type, work_list, name_key, path_key, settings):
+    if not settings['resume']:
+        return work_list
+
+    completed_units = get_completed_units(pg_cur, unit_type, settings)
+
+    pending_list = list()
+
+    for work_dict in work_list:
+        file_path = work_dict[path_key] if path_key is not None else None
+
+        if not is_unit_current(completed_units.get(work_dict[name_key]), file_path):
+            pending_list.append(work_dict)
+
+    return pending_list
+
+
+# records a completed unit, along with the signature of its source file. the file's hash is computed by the worker
+# that loaded it (see get_file_hash) and passed in, so the files aren't read again here
+def record_unit(pg_cur, unit_type, unit_name, file_path, settings, file_hash=None):
+    if file_path is not None:
+        size, mtime = get_file_signature(file_path)
+    else:
+        size, mtime = None, None
+
+    sql = "INSERT INTO {0} (unit_type, unit_name, source_path, source_size, source_mtime, source_hash) " \
+          "VALUES (%s, %s, %s, %s, %s, %s) " \
+          "ON CONFLICT (unit_type, unit_name) DO UPDATE SET source_path = EXCLUDED.source_path, " \
+          "source_size = EXCLUDED.source_size, source_mtime = EXCLUDED.source_mtime, " \
+          "source_hash = EXCLUDED.source_hash, completed = now()".format(get_manifest_table(settings))
+    pg_cur.execute(sql, (unit_type, unit_name, file_path, size, mtime, file_hash))
+
+
+# forgets completed units so they're redone (e.g. when the data they were built from is reloaded).
+# pass unit_names=None to forget all units of a type
+def remove_units(pg_cur, unit_type, unit_names, settings):
+    if unit_names is None:
+        pg_cur.execute("DELETE FROM {0} WHERE unit_type = %s".format(get_manifest_table(settings)), (unit_type,))
+    elif len(unit_names) > 0:
+        pg_cur.execute("DELETE FROM {0} WHERE unit_type = %s AND unit_name = ANY(%s)"
+                       .format(get_manifest_table(settings)), (unit_type, list(unit_names)))
@@ -28,15 +28,26 @@
 # *********************************************************************************************************************
 
 import arguments
-import boto3
-import io
+import checkpoint
+import hashlib
+import json
 import logging.config
+import metrics
 import os
 import psycopg2  # module needs to be installed
+import s3utils
+import scheduler
+import threading
 import utils
 
 from datetime import datetime
 
+# the buffer around each GeoJSON tile that features are clipped to, in pixels (see get_geojson_tile_sql)
+TILE_BUFFER_PIXELS = 4
+
+# the size of source boundary table each web optimised boundary insert job covers (see create_display_boundaries)
+DISPLAY_SHARD_BYTES = 16 * 1024 * 1024
+
 
 def main():
     full_start_time = datetime.now()
@@ -51,101 +62,157 @@ def main():
         logger.fatal("Invalid Census Year\nACTION: Set value to 2011 or 2016")
         return False
 
+    # set the number of processes to use, from the Postgres server's cores if not set
+    if not utils.set_process_count(settings, logger):
+        return False
+
+    # start the worker pool used by all multiprocessing steps - each worker keeps its own Postgres connection open
+    # (done before the main process connects to Postgres so the workers don't inherit its connection)
+    utils.start_pool(settings)
+
     # connect to Postgres
     try:
         pg_conn = psycopg2.connect(settings['pg_connect_string'])
     except psycopg2.Error:
         logger.fatal("Unable to connect to database\nACTION: Check your Postgres parameters and/or database security")
+        utils.stop_pool()
         return False
 
     pg_conn.autocommit = True
     pg_cur = pg_conn.cursor()
 
-    # add postgis to database (in the public schema) - run this in a try to confirm db user has privileges
+    # the connection & worker pool are closed however the load ends (the pool's workers each hold a connection too)
+    success = False
+
     try:
-        pg_cur.execute("SET search_path = public, pg_catalog; CREATE EXTENSION IF NOT EXISTS postgis")
-    except psycopg2.Error:
-        logger.fatal("Unable to add PostGIS extension\nACTION: Check your Postgres user privileges or PostGIS install")
-        return False
+        # add postgis to database (in the public schema) - run this in a try to confirm db user has privileges
+        try:
+            pg_cur.execute("SET search_path = public, pg_catalog; CREATE EXTENSION IF NOT EXISTS postgis")
+        except psycopg2.Error:
+            logger.fatal("Unable to add PostGIS extension\n"
+                         "ACTION: Check your Postgres user privileges or PostGIS install")
+            return False
+
+        # log PostGIS version
+        utils.check_postgis_version(pg_cur, settings, logger)
+
+        # create the table that records completed work (used to skip unchanged work when resuming a load)
+        checkpoint.create_manifest_table(pg_cur, settings)
+
+        # # test if ST_ClusterKMeans exists (only in PostGIS 2.3+).
+        # # It's used to create classes to display the data in the map
+        # if not settings.get('st_clusterkmeans_supported'):
+        #     logger.warning("YOU NEED TO INSTALL POSTGIS 2.3 OR HIGHER FOR THE MAP SERVER TO WORK\n"
+        #                    "it utilises the ST_ClusterKMeans() function in v2.3+")
+
+        # START LOADING DATA
+
+        # test runtime parameters - 2011
+        # --census-year=2011
+        # --data-schema=census_2011_data
+        # --boundary-schema=census_2011_bdys
+        # --web-schema=census_2011_web
+        # --census-data-path=/Users/hugh/tmp/abs_census_2011_data
+        # --census-bdys-path=/Users/hugh/tmp/abs_census_2011_bdys
+
+        # test runtime parameters - 2016
+        # --census-data-path=/Users/hugh/tmp/abs_census_2016_data
+        # --census-bdys-path=/Users/hugh/tmp/abs_census_2016_bdys
+
+        # PARTS 1 & 2 - load census data from CSV files, and census boundaries from Shapefiles & optimise them for
+        # web visualisation. each step starts as soon as the steps it needs are done, so the data & boundary loads run
+        # at the same time, sharing the worker pool. each web optimised boundary only needs its own boundary & the
+        # population tables, so it's created while the rest of the data is loading
+        logger.info("")
+        start_time = datetime.now()
+        logger.info("Parts 1 & 2 of 3 : Start census data & boundary load : {0}".format(start_time))
+
+        step_list = get_load_steps(settings)
+
+        if not scheduler.run_steps(step_list, settings, logger):
+            return False
+        logger.info("Parts 1 & 2 of 3 : Census data & boundaries loaded! : {0}".format(datetime.now() - start_time))
+
+        # PART 3 - export web optimised boundaries to S3 as tiled GeoJSON files
+        logger.info("")
+        start_time = datetime.now()
+        if settings['s3_bucket'] is not None:
+            logger.info("Part 3 of 3 : Start S3 export : {0}".format(start_time))
+            if not export_display_boundaries(settings):
+                return False
+            logger.info("Part 3 of 3 : Boundaries exported to S3! : {0}".format(datetime.now() - start_time))
+        else:
+            logger.info("Part 3 of 3 : S3 export not requested (set '--s3-bucket' to export)")
+
+        success = True
+    finally:
+        # close Postgres connection
+        pg_cur.close()
+        pg_conn.close()
+
+        # shut down the worker pool (and its Postgres connections) - killing any jobs still running if the load failed
+        if success:
+            utils.stop_pool()
+        else:
+            utils.terminate_pool()
 
-    # log PostGIS version
-    utils.check_postgis_version(pg_cur, settings, logger)
+    logger.info("")
+    logger.info("Total time : : {0}".format(datetime.now() - full_start_time))
 
-    # # test if ST_ClusterKMeans exists (only in PostGIS 2.3+).
-    # # It's used to create classes to display the data in the map
-    # if not settings.get('st_clusterkmeans_supported'):
-    #     logger.warning("YOU NEED TO INSTALL POSTGIS 2.3 OR HIGHER FOR THE MAP SERVER TO WORK\n"
-    #                    "it utilises the ST_ClusterKMeans() function in v2.3+")
+    return True
 
-    # START LOADING DATA
 
-    # test runtime parameters - 2011
-    # --census-year=2011
-    # --data-schema=census_2011_data
-    # --boundary-schema=census_2011_bdys
-    # --web-schema=census_2011_web
-    # --census-data-path=/Users/hugh/tmp/abs_census_2011_data
-    # --census-bdys-path=/Users/hugh/tmp/abs_census_2011_bdys
+# returns the steps of the census data & boundary load (see scheduler.py): the population tables, each boundary and
+# each web optimised boundary are steps of their own
+def get_load_steps(settings):
+    pop_tables = [settings['population_table'], settings['indigenous_population_table']]
+    display_names = [boundary_dict["boundary"] for boundary_dict in settings['bdy_table_dicts']
+                     if boundary_dict["boundary"] != "mb"]
 
-    # test runtime parameters - 2016
-    # --census-data-path=/Users/hugh/tmp/abs_census_2016_data
-    # --census-bdys-path=/Users/hugh/tmp/abs_census_2016_bdys
+    # bind the loop variables of the step functions created below
+    def get_data_step(name, requires, tables=None, exclude_tables=None):
+        return scheduler.get_step(name, lambda step_cur: populate_data_tables(
+            step_cur, settings['data_file_prefix'], settings['data_file_type'], settings['table_name_part'],
+            settings['bdy_name_part'], settings, tables, exclude_tables, name), requires)
 
-    # PART 1 - load census data from CSV files
-    logger.info("")
-    start_time = datetime.now()
-    logger.info("Part 1 of 2 : Start census data load : {0}".format(start_time))
-    create_metadata_tables(pg_cur, settings['metadata_file_prefix'], settings['metadata_file_type'], settings)
-    populate_data_tables(settings['data_file_prefix'], settings['data_file_type'],
-                         settings['table_name_part'], settings['bdy_name_part'], settings)
-    logger.info("Part 1 of 2 : Census data loaded! : {0}".format(datetime.now() - start_time))
+    def get_boundary_step(name, boundary_names=None, exclude_boundaries=None):
+        return scheduler.get_step(name, lambda step_cur: load_boundaries(
+            step_cur, settings, boundary_names, exclude_boundaries, name))
 
-    # PART 2 - load census boundaries from Shapefiles and optimise them for web visualisation
-    logger.info("")
-    start_time = datetime.now()
-    logger.info("Part 2 of 2 : Start census boundary load : {0}".format(start_time))
-    load_boundaries(pg_cur, settings)
-    # add bdy type prefix to bdy id to enabled joins with stat data (Census 2016 data issue only)
-    if settings["census_year"] == "2016":
-        fix_boundary_ids(settings)
-    else:
-        logger.info("\t- Step 2 of 3 : boundary id prefixes not required : {0}".format(datetime.now() - start_time))
-    create_display_boundaries(pg_cur, settings)
-    logger.info("Part 2 of 2 : Census boundaries loaded! : {0}".format(datetime.now() - start_time))
+    def get_display_step(name, boundary_name):
+        return scheduler.get_step(name, lambda step_cur: create_display_boundaries(
+            step_cur, settings, [boundary_name], name),
+            ["display_schema", "census_population", "boundaries_" + boundary_name])
 
-    # close Postgres connection
-    pg_cur.close()
-    pg_conn.close()
+    step_list = list()
+    step_list.append(scheduler.get_step("metadata", lambda step_cur: create_metadata_tables(
+        step_cur, settings['metadata_file_prefix'], settings['metadata_file_type'], settings)))
+    step_list.append(get_data_step("census_population", ["metadata"], tables=pop_tables))
+    step_list.append(get_data_step("census_data", ["metadata"], exclude_tables=pop_tables))
+    if settings['parquet_directory'] is not None:
+        step_list.append(scheduler.get_step("census_stats_export", lambda step_cur: export_census_stats(
+            step_cur, settings), ["census_population", "census_data"]))
 
-    logger.info("")
-    logger.info("Total time : : {0}".format(datetime.now() - full_start_time))
+    # the boundaries that aren't web optimised (i.e. meshblocks) are loaded in one step
+    step_list.append(get_boundary_step("boundaries", exclude_boundaries=display_names))
+    step_list.append(scheduler.get_step("display_schema", lambda step_cur: create_display_schema(step_cur, settings)))
 
-    return True
+    for boundary_name in display_names:
+        step_list.append(get_boundary_step("boundaries_" + boundary_name, boundary_names=[boundary_name]))
+        step_list.append(get_display_step("display_boundaries_" + boundary_name, boundary_name))
+
+    return step_list
 
 
 def create_metadata_tables(pg_cur, prefix, suffix, settings):
     # Step 1 of 2 : create metadata tables from Census Excel spreadsheets
-    start_time = datetime.now()
+    start_time = metrics.start_stage("metadata")
 
     # create schema
     if settings['data_schema'] != "public":
         pg_cur.execute("CREATE SCHEMA IF NOT EXISTS {0} AUTHORIZATION {1}"
                        .format(settings['data_schema'], settings['pg_user']))
 
-    # create metadata tables
-    sql = "DROP TABLE IF EXISTS {0}.metadata_tables CASCADE;" \
-          "CREATE TABLE {0}.metadata_tables (table_number text, table_name text, table_description text) " \
-          "WITH (OIDS=FALSE);" \
-          "ALTER TABLE {0}.metadata_tables OWNER TO {1}".format(settings['data_schema'], settings['pg_user'])
-    pg_cur.execute(sql)
-
-    sql = "DROP TABLE IF EXISTS {0}.metadata_stats CASCADE;" \
-          "CREATE TABLE {0}.metadata_stats (sequential_id text, short_id text, long_id text, " \
-          "table_number text, profile_table text, column_heading_description text) " \
-          "WITH (OIDS=FALSE);" \
-          "ALTER TABLE {0}.metadata_stats OWNER TO {1}".format(settings['data_schema'], settings['pg_user'])
-    pg_cur.execute(sql)
-
     # get a list of all files matching the metadata filename prefix
     file_list = list()
 
@@ -162,63 +229,53 @@ def create_metadata_tables(pg_cur, prefix, suffix, settings):
 
                     file_list.append(file_dict)
 
-    # are there any files to load?
-    if len(file_list) == 0:
-        logger.fatal("No Census metadata XLS files found\nACTION: Check your '--census-data-path' value")
-        logger.fatal("\t- Step 1 of 4 : create metadata tables FAILED!")
-    else:
-        # read in excel worksheets into pandas dataframes
-        for file_dict in file_list:
-
-            xl = pandas.ExcelFile(file_dict["path"])
-
-            sheets = xl.sheet_names
-            i = 0
+    # skip the metadata if none of the files have changed since the last load
+    if len(file_list) > 0 and len(checkpoint.get_pending_work(pg_cur, "metadata", file_list, "name", "path",
+                                                              settings)) == 0:
+        completed_units = checkpoint.get_completed_units(pg_cur, "metadata", settings)
 
-            for table_dict in settings["census_metadata_dicts"]:
-
-                df = xl.parse(sheets[i])
-
-                # drop unwanted rows at the top
-                j = 0
-                first_row = False
-
-                while not first_row:
-                    cell = df.iloc[j, 0]
-
-                    if str(cell).lower() == table_dict["first_row"]:
-                        df_clean = df.drop(df.index[0:j+1])
-                        first_row = True
+        for file_dict in file_list:
+            file_dict["hash"] = completed_units[file_dict["name"]]["hash"]
 
-                        # drop excess columns in unclean Excel worksheets
-                        if table_dict["table"] == "metadata_stats":
-                            try:
-                                df_clean.drop(df.columns[[6, 7, 8]], axis=1, inplace=True)
-                            except:
-                                pass
+        settings['metadata_hash'] = get_metadata_hash(file_list)
+        logger.info("\t- Step 1 of 2 : metadata tables unchanged : {0}".format(datetime.now() - start_time))
+        metrics.end_stage(settings)
+        return True
 
-                        # # order what's left by sequential_id field
-                        # df_clean.sort_values(by="Sequential", inplace=True)
+    # the metadata defines the stats tables - they, and everything built from them, need to be reloaded
+    for unit_type in ["metadata", "csv", "display"]:
+        checkpoint.remove_units(pg_cur, unit_type, None, settings)
 
-                        # export to in-memory tab delimited text file
-                        tsv_file = io.StringIO()
-                        df_clean.to_csv(tsv_file, sep="\t", index=False, header=False)
-                        tsv_file.seek(0)  # move position back to beginning of file before reading
+    # create metadata tables
+    sql = "DROP TABLE IF EXISTS {0}.metadata_tables CASCADE;" \
+          "CREATE TABLE {0}.metadata_tables (table_number text, table_name text, table_description text) " \
+          "WITH (OIDS=FALSE);" \
+          "ALTER TABLE {0}.metadata_tables OWNER TO {1}".format(settings['data_schema'], settings['pg_user'])
+    pg_cur.execute(sql)
 
-                        # # output dataframe to test tsv file
-                        # with open(file_dict["name"] + '.tsv', 'w') as fd:
-                        #     shutil.copyfileobj(tsv_file, fd)
-                        # tsv_file.seek(0)
+    sql = "DROP TABLE IF EXISTS {0}.metadata_stats CASCADE;" \
+          "CREATE TABLE {0}.metadata_stats (sequential_id text, short_id text, long_id text, " \
+          "table_number text, profile_table text, column_heading_description text) " \
+          "WITH (OIDS=FALSE);" \
+          "ALTER TABLE {0}.metadata_stats OWNER TO {1}".format(settings['data_schema'], settings['pg_user'])
+    pg_cur.execute(sql)
 
-                        # import into Postgres
-                        sql = "COPY {0}.{1} FROM stdin WITH CSV DELIMITER as '\t' NULL as ''" \
-                            .format(settings['data_schema'], table_dict["table"])
-                        pg_cur.copy_expert(sql, tsv_file)
+    imported_list = list()
 
-                    j += 1
+    # are there any files to load?
+    if len(file_list) == 0:
+        logger.fatal("No Census metadata XLS files found\nACTION: Check your '--census-data-path' value")
+        logger.fatal("\t- Step 1 of 4 : create metadata tables FAILED!")
+    else:
+        # parse the Excel worksheets and import them using multiprocessing
+        def record_import(file_dict, result):
+            file_dict["hash"] = result.get("hash")
+            imported_list.append(file_dict)
 
-                i += 1
+        if not utils.multiprocess_metadata_import(file_list, settings, logger, record_import):
+            return False
 
+        for file_dict in imported_list:
             logger.info("\t\t- imported {0}".format(file_dict["name"]))
 
     # clean up invalid rows
@@ -238,14 +295,90 @@ def create_metadata_tables(pg_cur, prefix, suffix, settings):
     pg_cur.execute("VACUUM ANALYZE {0}.metadata_tables".format(settings['data_schema']))
     pg_cur.execute("VACUUM ANALYZE {0}.metadata_stats".format(settings['data_schema']))
 
+    for file_dict in imported_list:
+        checkpoint.record_unit(pg_cur, "metadata", file_dict["name"], file_dict["path"], settings, file_dict["hash"])
+
+    # the stats table definitions (see get_table_fields) are cached by the metadata files they're built from - but
+    # not if any files failed to import, as the definitions would be missing their tables
+    if len(imported_list) == len(file_list):
+        settings['metadata_hash'] = get_metadata_hash(file_list)
+    else:
+        settings['metadata_hash'] = None
+
     logger.info("\t- Step 1 of 2 : metadata tables created : {0}".format(datetime.now() - start_time))
+    metrics.end_stage(settings)
 
+    return True
 
-# create stats tables and import data from CSV files using multiprocessing
-def populate_data_tables(prefix, suffix, table_name_part, bdy_name_part, settings):
-    # Step 2 of 2 : create & populate stats tables with CSV files using multiprocessing
-    start_time = datetime.now()
 
+# a hash of all the metadata files (from the hashes of each file), used to tell if the stats table definitions have
+# changed. returns None if a file's hash isn't known
+def get_metadata_hash(file_list):
+    if any([file_dict.get("hash") is None for file_dict in file_list]):
+        return None
+
+    metadata_hash = hashlib.md5()
+
+    for file_dict in sorted(file_list, key=lambda file_dict: file_dict["name"]):
+        metadata_hash.update(file_dict["hash"].encode("utf-8"))
+
+    return metadata_hash.hexdigest()
+
+
+# returns the column definitions of every census stats table, from one grouped query on the metadata, as a dict of
+# create table column lists by table name (None if a table has no metadata). the dict is cached on disk by the hash
+# of the metadata files, only if every table has metadata
+def get_table_fields(pg_cur, table_list, settings):
+    cache_path = None
+
+    if settings.get('metadata_hash') is not None:
+        cache_path = os.path.join(settings['cache_directory'],
+                                  "table_fields_{0}.json".format(settings['metadata_hash']))
+
+        if os.path.isfile(cache_path):
+            with open(cache_path, "r") as cache_file:
+                table_fields_dict = json.load(cache_file)
+
+            if all([table_fields_dict.get(table) is not None for table in table_list]):
+                return table_fields_dict
+
+    # get the fields of each table, ordered by sequential_id (required to match field names with the right data).
+    # a table's fields include those of its parts (e.g. g04 = g04a + g04b)
+    sql = "SELECT tab.table_name, lower(string_agg(stats.sequential_id || ' double precision', ',' " \
+          "ORDER BY stats.table_number, right(stats.sequential_id, length(stats.sequential_id) - 1)::integer)) " \
+          "FROM unnest(%s) AS tab (table_name) " \
+          "INNER JOIN {0}.metadata_stats AS stats ON lower(stats.table_number) LIKE tab.table_name || '%%' " \
+          "GROUP BY tab.table_name".format(settings['data_schema'])
+    pg_cur.execute(sql, (sorted(set(table_list)),))
+
+    table_fields_dict = dict()
+
+    for row in pg_cur.fetchall():
+        table_fields_dict[row[0]] = row[1]
+
+    # remember the tables with no metadata too
+    for table in table_list:
+        table_fields_dict.setdefault(table, None)
+
+    if cache_path is not None and None not in table_fields_dict.values():
+        # write to a temp file first, so steps running at the same time never read a partly written cache
+        try:
+            utils.make_cache_directory(settings)
+
+            temp_path = "{0}.{1}.{2}.tmp".format(cache_path, os.getpid(), threading.get_ident())
+
+            with open(temp_path, "w") as cache_file:
+                json.dump(table_fields_dict, cache_file)
+
+            os.rename(temp_path, cache_path)
+        except (IOError, OSError):
+            pass  # the cache is only an optimisation
+
+    return table_fields_dict
+
+
+# returns a list of the census data CSV files, with the table & boundary each one is for
+def get_data_file_list(prefix, suffix, table_name_part, bdy_name_part, settings):
     # get the file list and create sql copy statements
     file_list = []
     # get a dictionary of all files matching the filename prefix
@@ -282,30 +415,269 @@ def populate_data_tables(prefix, suffix, table_name_part, bdy_name_part, setting
                     # print(file_dict)
                     file_list.append(file_dict)
 
+    return file_list
+
+
+# create stats tables and import data from CSV files using multiprocessing. the load can be limited to (or exclude) a
+# list of census tables, so some tables (e.g. the population tables) can be loaded as a step of their own
+def populate_data_tables(pg_cur, prefix, suffix, table_name_part, bdy_name_part, settings, tables=None,
+                         exclude_tables=None, stage_name="census_data"):
+    # Step 2 of 2 : create & populate stats tables with CSV files using multiprocessing
+    start_time = metrics.start_stage(stage_name)
+
+    file_list = get_data_file_list(prefix, suffix, table_name_part, bdy_name_part, settings)
+
     # are there any files to load?
     if len(file_list) == 0:
         logger.fatal("No Census data CSV files found\nACTION: Check your '--census-data-path' value")
         logger.fatal("\t- Step 2 of 2 : stats table create & populate FAILED!")
+        return True
+
+    # get the column definitions of every table once, instead of once per file (for all tables, so the steps loading
+    # different tables share the same cached definitions)
+    table_fields_dict = get_table_fields(pg_cur, [file_dict["table"] for file_dict in file_list], settings)
+
+    file_list = [file_dict for file_dict in file_list
+                 if (tables is None or file_dict["table"] in tables)
+                 and (exclude_tables is None or file_dict["table"] not in exclude_tables)]
+
+    # skip files that haven't changed since the last load
+    pending_list = checkpoint.get_pending_work(pg_cur, "csv", file_list, "name", "path", settings)
+
+    for file_dict in list(pending_list):
+        if table_fields_dict.get(file_dict["table"]) is None:
+            logger.warning("\t\t- no metadata found for table {0} - skipping {1}"
+                           .format(file_dict["table"], file_dict["name"]))
+            pending_list.remove(file_dict)
+        else:
+            file_dict["fields"] = table_fields_dict[file_dict["table"]]
+
+    if len(pending_list) < len(file_list):
+        logger.info("\t\t- {0} of {1} CSV files unchanged since the last load"
+                    .format(len(file_list) - len(pending_list), len(file_list)))
+
+    # display boundaries need rebuilding if their population data is being reloaded
+    pop_tables = [settings['population_table'], settings['indigenous_population_table']]
+    checkpoint.remove_units(pg_cur, "display", set([file_dict["boundary"] for file_dict in pending_list
+                                                    if file_dict["table"] in pop_tables]), settings)
+
+    # create the partitioned census tables the CSV files are loaded into
+    if settings['partitioned_tables']:
+        create_partitioned_tables(pg_cur, file_list, pending_list, settings)
+
+    # record a CSV file as loaded once its table is complete (with the hash its worker computed)
+    def record_csv(file_dict):
+        checkpoint.record_unit(pg_cur, "csv", file_dict["name"], file_dict["path"], settings, file_dict["hash"])
+
+    # load all files using multiprocessing
+    if settings['deferred_finalise']:
+        loaded_list = list()
+
+        def add_loaded(file_dict, result):
+            file_dict["hash"] = result.get("hash")
+            loaded_list.append(file_dict)
+
+        if not utils.multiprocess_csv_import(pending_list, settings, logger, add_loaded):
+            return False
+
+        if not finalise_csv_tables(pg_cur, loaded_list, record_csv, settings):
+            return False
     else:
-        # load all files using multiprocessing
-        utils.multiprocess_csv_import(file_list, settings, logger)
-        logger.info("\t- Step 2 of 2 : stats tables created & populated : {0}".format(datetime.now() - start_time))
+        def record_load(file_dict, result):
+            file_dict["hash"] = result.get("hash")
+            record_csv(file_dict)
 
+        if not utils.multiprocess_csv_import(pending_list, settings, logger, record_load):
+            return False
 
-# loads the admin bdy shapefiles using the shp2pgsql command line tool (part of PostGIS), using multiprocessing
-def load_boundaries(pg_cur, settings):
-    # Step 1 of 2 : load census boundaries
+    logger.info("\t- Step 2 of 2 : {0} : stats tables created & populated : {1}"
+                .format(stage_name, datetime.now() - start_time))
+    metrics.end_stage(settings)
+
+    return True
+
+
+# exports the census stats to Parquet files for analytics - one per census table & boundary, partitioned by boundary
+# ({table}/boundary={boundary}/{table}_{boundary}.parquet), with the metadata's long ids as column names.
+# the files are uploaded to S3 as well if a bucket is set
+def export_census_stats(pg_cur, settings):
+    start_time = metrics.start_stage("census_stats_export")
+
+    if utils.pyarrow is None:
+        logger.warning("\t- Parquet export : pyarrow Python module not installed - census stats NOT exported")
+        return True
+
+    file_list = get_data_file_list(settings['data_file_prefix'], settings['data_file_type'],
+                                   settings['table_name_part'], settings['bdy_name_part'], settings)
+    table_fields_dict = get_table_fields(pg_cur, [file_dict["table"] for file_dict in file_list], settings)
+
+    # get the long (readable) id of each stat
+    pg_cur.execute("SELECT lower(sequential_id), long_id FROM {0}.metadata_stats".format(settings['data_schema']))
+    long_id_dict = dict(pg_cur.fetchall())
+
+    work_list = list()
+
+    for file_dict in file_list:
+        if table_fields_dict.get(file_dict["table"]) is None:
+            continue
+
+        columns = [field.split(" ")[0] for field in table_fields_dict[file_dict["table"]].split(",")]
+
+        # use the stat's long id as its column name, unless it's missing or used more than once in the table
+        column_names = list()
+
+        for column in columns:
+            column_name = long_id_dict.get(column) or column
+
+            if column_name in column_names:
+                column_name = column
+
+            column_names.append(column_name)
+
+        partition = "boundary={0}".format(file_dict["boundary"])
+        file_name = "{0}_{1}.parquet".format(file_dict["table"], file_dict["boundary"])
+
+        work_dict = dict()
+        work_dict["name"] = file_name
+        work_dict["table"] = "{0}.{1}_{2}".format(settings['data_schema'], file_dict["boundary"], file_dict["table"])
+        work_dict["columns"] = columns
+        work_dict["column_names"] = column_names
+        work_dict["path"] = os.path.join(settings['parquet_directory'], file_dict["table"], partition, file_name)
+
+        if settings['s3_bucket'] is not None:
+            work_dict["key"] = "/".join([settings['s3_prefix'], "parquet", file_dict["table"], partition, file_name])
+        else:
+            work_dict["key"] = None
+
+        work_list.append(work_dict)
+
+    if not utils.multiprocess_parquet_export(work_list, settings, logger):
+        return False
+
+    logger.info("\t- Parquet export : census stats exported : {0}".format(datetime.now() - start_time))
+    metrics.end_stage(settings)
+
+    return True
+
+
+# creates one table per census table number, partitioned by boundary, for the CSV files to be loaded into as
+# partitions (see --partitioned-tables). tables are only recreated if all of their files are being reloaded
+def create_partitioned_tables(pg_cur, file_list, pending_list, settings):
+    for table in sorted(set([file_dict["table"] for file_dict in pending_list])):
+        fields_string = [file_dict["fields"] for file_dict in pending_list if file_dict["table"] == table][0]
+
+        sql_list = list()
+
+        if len([file_dict for file_dict in file_list if file_dict["table"] == table]) == \
+                len([file_dict for file_dict in pending_list if file_dict["table"] == table]):
+            sql_list.append("DROP TABLE IF EXISTS {0}.{1} CASCADE")
+
+        # the primary key is added after the data is loaded when finalising is deferred
+        if settings['deferred_finalise']:
+            primary_key = ""
+        else:
+            primary_key = ", CONSTRAINT {1}_pkey PRIMARY KEY (boundary, {2})"
+
+        sql_list.append("CREATE TABLE IF NOT EXISTS {0}.{1} (boundary text NOT NULL, {2} text NOT NULL, {3}"
+                        + primary_key + ") PARTITION BY LIST (boundary)")
+        sql_list.append("ALTER TABLE {0}.{1} OWNER TO {4}")
+
+        pg_cur.execute(";".join(sql_list).format(settings['data_schema'], table, settings['region_id_field'],
+                                                 fields_string, settings['pg_user']))
+
+        # the loads create their tables outside the census table & attach them once loaded - drop the partitions
+        # being reloaded now, rather than while the other boundaries are loading (see
+        # utils.run_csv_import_multiprocessing)
+        for file_dict in pending_list:
+            if file_dict["table"] == table:
+                pg_cur.execute("DROP TABLE IF EXISTS {0}.{1}_{2} CASCADE"
+                               .format(settings['data_schema'], file_dict["boundary"], table))
+
+
+# adds primary keys to the bulk loaded stats tables using multiprocessing, then analyses the schema once
+# (see --deferred-finalise)
+def finalise_csv_tables(pg_cur, file_list, on_finalised, settings):
     start_time = datetime.now()
 
+    finalise_sql_dict = dict()
+
+    # the loaded tables are attached to their partitioned census tables, which then get one primary key each (adding
+    # an index to each of their partitions)
+    if settings['partitioned_tables']:
+        primary_key_sql_dict = dict()
+
+        for table in sorted(set([file_dict["table"] for file_dict in file_list])):
+            sql_list = ["ALTER TABLE {0}.{1} DROP CONSTRAINT IF EXISTS {1}_pkey"]
+
+            for file_dict in file_list:
+                if file_dict["table"] == table:
+                    sql_list.append("ALTER TABLE {{0}}.{{1}} ATTACH PARTITION {{0}}.{0}_{{1}} FOR VALUES IN ('{0}')"
+                                    .format(file_dict["boundary"]))
+
+            sql_list.append("ALTER TABLE {0}.{1} ADD CONSTRAINT {1}_pkey PRIMARY KEY (boundary, {2})")
+
+            sql = ";".join(sql_list).format(settings['data_schema'], table, settings['region_id_field'])
+            primary_key_sql_dict[sql] = table
+
+        finalised_tables = list()
+
+        if not utils.multiprocess_list("sql", list(primary_key_sql_dict.keys()), settings, logger,
+                                       lambda sql, result: finalised_tables.append(primary_key_sql_dict[sql])):
+            return False
+
+        file_list = [file_dict for file_dict in file_list if file_dict["table"] in finalised_tables]
+
+    for file_dict in file_list:
+        table_name = file_dict["boundary"] + "_" + file_dict["table"]
+
+        if settings['partitioned_tables']:
+            sql = "ALTER TABLE {0}.{1} CLUSTER ON {1}_pkey".format(settings['data_schema'], table_name)
+        else:
+            sql = "ALTER TABLE {0}.{1} ADD CONSTRAINT {1}_pkey PRIMARY KEY ({2});" \
+                  "ALTER TABLE {0}.{1} CLUSTER ON {1}_pkey" \
+                .format(settings['data_schema'], table_name, settings['region_id_field'])
+        finalise_sql_dict[sql] = file_dict
+
+    if not utils.multiprocess_list("sql", list(finalise_sql_dict.keys()), settings, logger,
+                                   lambda sql, result: on_finalised(finalise_sql_dict[sql])):
+        return False
+
+    # one statement to ANALYZE the loaded tables, instead of one per table (analysing a partitioned census table
+    # analyses its partitions too). only this step's tables - other steps may still be loading theirs
+    if settings['partitioned_tables']:
+        table_list = sorted(set([file_dict["table"] for file_dict in file_list]))
+    else:
+        table_list = [file_dict["boundary"] + "_" + file_dict["table"] for file_dict in file_list]
+
+    if len(table_list) > 0:
+        sql = "DO $$DECLARE tab text; BEGIN FOREACH tab IN ARRAY ARRAY[{1}] LOOP " \
+              "EXECUTE 'ANALYZE {0}.' || quote_ident(tab); END LOOP; END$$" \
+            .format(settings['data_schema'], ",".join(["'{0}'".format(table) for table in table_list]))
+        pg_cur.execute(sql)
+
+    logger.info("\t\t- {0} stats tables finalised : {1}".format(len(file_list), datetime.now() - start_time))
+
+    return True
+
+
+# loads the admin bdy shapefiles using the shp2pgsql command line tool (part of PostGIS), using multiprocessing.
+# the load can be limited to (or exclude) a list of boundaries (e.g. 'sa1'), so each boundary can be loaded as a step
+# of its own
+def load_boundaries(pg_cur, settings, boundary_names=None, exclude_boundaries=None, stage_name="boundaries"):
+    # Step 1 of 2 : load census boundaries
+    start_time = metrics.start_stage(stage_name)
+
     # create schema
     if settings['boundary_schema'] != "public":
         pg_cur.execute("CREATE SCHEMA IF NOT EXISTS {0} AUTHORIZATION {1}"
                        .format(settings['boundary_schema'], settings['pg_user']))
 
     # get file list
+    file_list = list()
     table_list = list()
     create_list = list()
     append_list = list()
+    staging_dict = dict()  # per state staging tables to merge, by target table (parallel meshblock loads only)
 
     # get a dictionary of Shapefile paths
     for root, dirs, files in os.walk(settings['boundaries_directory']):
@@ -314,196 +686,830 @@ def load_boundaries(pg_cur, settings):
 
             if file_name.endswith(".shp") or file_name.endswith(".SHP"):
                 file_dict = dict()
+                file_dict['name'] = original_file_name
                 file_dict['file_path'] = os.path.join(root, original_file_name)
 
+                file_dict['staging'] = False
+
                 if file_name.startswith("mb_"):
                     for state in settings['states']:
                         state = state.lower()
 
                         if state in file_name:
                             file_dict['pg_table'] = file_name.replace("_" + state + ".shp", "_aust", 1)
+
+                    # load each state into its own unlogged staging table, to be merged after all states are loaded
+                    if settings['parallel_meshblocks']:
+                        file_dict['target_table'] = file_dict['pg_table']
+                        file_dict['pg_table'] = file_name.replace(".shp", "_stage")
+                        file_dict['staging'] = True
                 else:
                     file_dict['pg_table'] = file_name.replace(".shp", "")
 
+                file_dict['target_table'] = file_dict.get('target_table', file_dict['pg_table'])
+                file_dict['id_prefix'] = get_boundary_id_prefix(file_dict['target_table'], settings)
                 file_dict['pg_schema'] = settings['boundary_schema']
+                file_dict['spatial'] = True
 
-                # set to replace or append to table depending on whether this is the 1st state for that dataset
-                # (only applies to meshblocks in Census 2016)
-                table_list_add = False
-
-                if file_dict['pg_table'] not in table_list:
-                    table_list_add = True
+                file_list.append(file_dict)
 
-                    file_dict['delete_table'] = True
-                else:
-                    file_dict['delete_table'] = False
+    # are there any files to load?
+    if len(file_list) == 0:
+        logger.fatal("No census boundary files found\nACTION: Check your 'census-bdys-path' argument")
+        return True
 
-                file_dict['spatial'] = True
+    file_list = [file_dict for file_dict in file_list
+                 if (boundary_names is None or file_dict['target_table'].split("_")[0] in boundary_names)
+                 and (exclude_boundaries is None or file_dict['target_table'].split("_")[0] not in exclude_boundaries)]
 
-                if table_list_add:
-                    table_list.append(file_dict['pg_table'])
-                    create_list.append(file_dict)
-                else:
-                    append_list.append(file_dict)
+    if len(file_list) == 0:
+        if boundary_names is not None:
+            logger.warning("\t\t- no Shapefiles found for {0}".format(", ".join(boundary_names)))
+
+        metrics.end_stage(settings)
+        return True
+
+    # skip Shapefiles that haven't changed since the last load. tables made from more than one Shapefile (i.e.
+    # meshblocks) are reloaded in full if any of their Shapefiles have changed
+    pending_tables = set([file_dict['target_table'] for file_dict in
+                          checkpoint.get_pending_work(pg_cur, "shapefile", file_list, "name", "file_path", settings)])
+    pending_list = [file_dict for file_dict in file_list if file_dict['target_table'] in pending_tables]
+
+    if len(pending_list) < len(file_list):
+        logger.info("\t\t- {0} of {1} Shapefiles unchanged since the last load"
+                    .format(len(file_list) - len(pending_list), len(file_list)))
+
+    # display boundaries need rebuilding if their boundaries are being reloaded
+    checkpoint.remove_units(pg_cur, "display", set([pg_table.split("_")[0] for pg_table in pending_tables]),
+                            settings)
+
+    for file_dict in pending_list:
+        # set to replace or append to table depending on whether this is the 1st state for that dataset
+        # (only applies to meshblocks in Census 2016)
+        if file_dict['pg_table'] not in table_list:
+            file_dict['delete_table'] = True
+            table_list.append(file_dict['pg_table'])
+            create_list.append(file_dict)
+        else:
+            file_dict['delete_table'] = False
+            append_list.append(file_dict)
+
+        if file_dict['staging']:
+            staging_dict.setdefault(file_dict['target_table'], list()).append(file_dict)
 
     # logger.info(create_list)
     # logger.info(append_list)
 
-    # are there any files to load?
-    if len(create_list) == 0:
-        logger.fatal("No census boundary files found\nACTION: Check your 'census-bdys-path' argument")
-    else:
-        # load files in separate processes
-        utils.multiprocess_shapefile_load(create_list, settings, logger)
+    # record a Shapefile as loaded once its table is complete (with the hash its worker computed)
+    def record_shapefile(shp):
+        checkpoint.record_unit(pg_cur, "shapefile", shp['name'], shp['file_path'], settings, shp['hash'])
 
-        # Run the appends one at a time (Can't multi process as large sets of parallel INSERTs cause database deadlocks)
-        # utils.multiprocess_shapefile_load(append_list, settings, logger)
-        for shp in append_list:
-            utils.import_shapefile_to_postgres(pg_cur, shp['file_path'], shp['pg_table'], shp['pg_schema'],
-                                               shp['delete_table'], True)
+    # the staging tables that loaded - a table is only merged if all of its states loaded
+    loaded_staging_tables = set()
 
-        logger.info("\t- Step 1 of 3 : boundaries loaded : {0}".format(datetime.now() - start_time))
+    def record_load(shp, result):
+        shp['hash'] = result.get('hash')
 
+        if shp['staging']:
+            loaded_staging_tables.add(shp['pg_table'])
+        else:
+            record_shapefile(shp)
 
-def fix_boundary_ids(settings):
-    # Step 2 of 3 : add bdy type prefix to bdy id to enabled joins with stat data (Census 2016 data issue only)
-    start_time = datetime.now()
+    # load files in separate processes
+    if not utils.multiprocess_shapefile_load(create_list, settings, logger, record_load):
+        return False
 
-    alter_sql_list = list()
-    update_sql_list = list()
-    vacuum_sql_list = list()
+    # Run the appends one at a time (Can't multi process as large sets of parallel INSERTs cause database deadlocks)
+    # utils.multiprocess_shapefile_load(append_list, settings, logger)
+    for shp in append_list:
+        result = utils.import_shapefile_to_postgres(pg_cur, shp['file_path'], shp['pg_table'], shp['pg_schema'],
+                                                    shp['delete_table'], True, settings['shapefile_dump_format'],
+                                                    id_prefix=shp['id_prefix'])
+        if result != "SUCCESS":
+            logger.warning(result)
 
-    for boundary_dict in settings['bdy_table_dicts']:
-        boundary_name = boundary_dict["boundary"]
-        input_pg_table = "{0}_{1}_aust".format(boundary_name, settings["census_year"])
+            if settings['abort_on_failure']:
+                return False
+        else:
+            shp['hash'] = checkpoint.get_file_hash(shp['file_path'])
+            record_shapefile(shp)
+
+    # merge the per state staging tables into their Australia wide tables, then index them once
+    for pg_table, staging_list in staging_dict.items():
+        missing_list = [shp['name'] for shp in staging_list if shp['pg_table'] not in loaded_staging_tables]
 
-        if boundary_name in ["ced", "iare", "iloc", "ireg", "lga", "poa", "sed", "ssc"]:
-            id_field = boundary_dict["id_field"]
+        if len(missing_list) > 0:
+            logger.warning("\t\t- {0} not created, {1} failed to load".format(pg_table, ", ".join(missing_list)))
 
-            sql = "ALTER TABLE {0}.{1} ALTER COLUMN {2} TYPE text"\
-                .format(settings['boundary_schema'], input_pg_table, id_field)
-            alter_sql_list.append(sql)
+            if settings['abort_on_failure']:
+                return False
 
-            sql = "UPDATE {0}.{1} SET {2} = upper('{3}') || {2}"\
-                .format(settings['boundary_schema'], input_pg_table, id_field, boundary_name)
-            update_sql_list.append(sql)
+            continue
 
-            vacuum_sql_list.append("VACUUM ANALYZE {0}.{1}".format(settings['boundary_schema'], input_pg_table))
+        merge_staging_tables(pg_cur, pg_table, sorted([shp['pg_table'] for shp in staging_list]), settings)
+
+        for shp in staging_list:
+            record_shapefile(shp)
+
+    logger.info("\t- Step 1 of 2 : {0} : boundaries loaded : {1}".format(stage_name, datetime.now() - start_time))
+    metrics.end_stage(settings)
+
+    return True
 
-    utils.multiprocess_list("sql", alter_sql_list, settings, logger)
-    utils.multiprocess_list("sql", update_sql_list, settings, logger)
-    utils.multiprocess_list("sql", vacuum_sql_list, settings, logger)
 
-    logger.info("\t- Step 2 of 3 : boundary ids prefixed : {0}".format(datetime.now() - start_time))
+# the census data's ids for some boundaries have the boundary type as a prefix (e.g. 'CED101', not '101' - Census
+# 2016 data issue only). the prefix is added to the boundary's ids as it's loaded, to enable joins with the data.
+# returns the id field & prefix as a tuple, or None if the boundary doesn't need one
+def get_boundary_id_prefix(pg_table, settings):
+    boundary_name = pg_table.split("_")[0]
 
+    if boundary_name not in settings['prefixed_boundaries']:
+        return None
 
-def create_display_boundaries(pg_cur, settings):
-    # Step 3 of 3 : create web optimised versions of the census boundaries
+    for boundary_dict in settings['bdy_table_dicts']:
+        if boundary_dict["boundary"] == boundary_name:
+            return boundary_dict["id_field"], boundary_name.upper()
+
+    return None
+
+
+# combines boundary staging tables into a single table with one INSERT ... SELECT ... UNION ALL,
+# then adds the primary key & spatial index and clusters it
+def merge_staging_tables(pg_cur, pg_table, staging_tables, settings):
     start_time = datetime.now()
 
+    schema = settings['boundary_schema']
+
+    # get the column names (the staging tables have identical structures)
+    pg_cur.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_schema = '{0}' AND table_name = '{1}' AND column_name <> 'gid' "
+                   "ORDER BY ordinal_position".format(schema, staging_tables[0]))
+    columns = ",".join(['"{0}"'.format(row[0]) for row in pg_cur.fetchall()])
+
+    select_list = list()
+
+    for staging_table in staging_tables:
+        select_list.append("SELECT {0} FROM {1}.{2}".format(columns, schema, staging_table))
+
+    sql = "DROP TABLE IF EXISTS {0}.{1} CASCADE;" \
+          "CREATE TABLE {0}.{1} (LIKE {0}.{2}) WITH (OIDS=FALSE);" \
+          "INSERT INTO {0}.{1} (gid, {3}) SELECT row_number() OVER (), {3} FROM ({4}) AS stage;" \
+          "ALTER TABLE {0}.{1} ADD CONSTRAINT {1}_pkey PRIMARY KEY (gid);" \
+          "CREATE INDEX {1}_geom_idx ON {0}.{1} USING gist (geom);" \
+          "ALTER TABLE {0}.{1} CLUSTER ON {1}_geom_idx;" \
+          "ALTER TABLE {0}.{1} OWNER TO {5}" \
+        .format(schema, pg_table, staging_tables[0], columns, " UNION ALL ".join(select_list), settings['pg_user'])
+    pg_cur.execute(sql)
+
+    pg_cur.execute("ANALYZE {0}.{1}".format(schema, pg_table))
+
+    for staging_table in staging_tables:
+        pg_cur.execute("DROP TABLE {0}.{1}".format(schema, staging_table))
+
+    logger.info("\t\t- {0} staging tables merged into {1} : {2}"
+                .format(len(staging_tables), pg_table, datetime.now() - start_time))
+
+
+# creates the web schema & zoom level table the web optimised boundaries are built in. run once, before any
+# boundaries are created (see create_display_boundaries)
+def create_display_schema(pg_cur, settings):
+    start_time = metrics.start_stage("display_schema")
+
     # create schema
     if settings['web_schema'] != "public":
         pg_cur.execute("CREATE SCHEMA IF NOT EXISTS {0} AUTHORIZATION {1}"
                        .format(settings['web_schema'], settings['pg_user']))
 
+    # store the simplification & display parameters of each zoom level, for clients to use. all boundaries need
+    # rebuilding in full if they've changed
+    settings['zoom_levels_changed'] = utils.create_zoom_level_table(pg_cur, settings)
+
+    if settings['zoom_levels_changed']:
+        checkpoint.remove_units(pg_cur, "display", None, settings)
+
+    logger.info("\t- Step 2 of 2 : web schema created : {0}".format(datetime.now() - start_time))
+    metrics.end_stage(settings)
+
+    return True
+
+
+# creates web optimised versions of the census boundaries, from their boundaries & population tables. can be limited
+# to a list of boundaries, so each boundary can be created as soon as its own data is loaded.
+# create_display_schema must be run first
+def create_display_boundaries(pg_cur, settings, boundary_names=None, stage_name="display_boundaries"):
+    # Step 2 of 2 : create web optimised versions of the census boundaries
+    start_time = metrics.start_stage(stage_name)
+
+    zoom_levels_changed = settings['zoom_levels_changed']
+
     # prepare boundaries for all tiled map zoom levels
     create_sql_list = list()
-    insert_sql_list = list()
+    insert_sql_dicts = list()
     vacuum_sql_list = list()
+    tile_work_list = list()
+    tile_vacuum_sql_list = list()
 
-    for boundary_dict in settings['bdy_table_dicts']:
-        boundary_name = boundary_dict["boundary"]
+    bdy_table_dicts = [boundary_dict for boundary_dict in settings['bdy_table_dicts']
+                       if boundary_names is None or boundary_dict["boundary"] in boundary_names]
 
-        if boundary_name != "mb":
-            id_field = boundary_dict["id_field"]
-            name_field = boundary_dict["name_field"]
-            area_field = boundary_dict["area_field"]
+    # skip boundaries that are unchanged since the last load
+    pending_list = checkpoint.get_pending_work(pg_cur, "display", bdy_table_dicts, "boundary", None, settings)
+    pending_names = [boundary_dict["boundary"] for boundary_dict in pending_list]
+
+    if len(pending_list) < len(bdy_table_dicts):
+        logger.info("\t\t- {0} of {1} boundaries unchanged since the last load"
+                    .format(len(bdy_table_dicts) - len(pending_list), len(bdy_table_dicts)))
+
+    # the boundary each job belongs to, and how many of each boundary's jobs have succeeded
+    job_boundary_dict = dict()
+    success_dict = dict()
 
+    for boundary_dict in bdy_table_dicts:
+        boundary_name = boundary_dict["boundary"]
+
+        if boundary_name != "mb" and boundary_name in pending_names:
             input_pg_table = "{0}_{1}_aust".format(boundary_name, settings["census_year"])
             pg_table = "{0}".format(boundary_name)
 
+            # skip boundaries whose source table wasn't loaded (they're left unrecorded, so they're built next time)
+            pg_cur.execute("SELECT to_regclass('{0}.{1}')".format(settings['boundary_schema'], input_pg_table))
+
+            if pg_cur.fetchone()[0] is None:
+                logger.warning("\t\t- {0} : not created, {1}.{2} doesn't exist"
+                               .format(boundary_name, settings['boundary_schema'], input_pg_table))
+                continue
+
+            # pg_total_relation_size of the source table, for splitting the insert into shards (see below)
+            pg_cur.execute("SELECT pg_total_relation_size('{0}.{1}')"
+                           .format(settings['boundary_schema'], input_pg_table))
+            table_size = float(pg_cur.fetchone()[0])
+
+            # when resuming, boundaries built by a previous load are updated in place - only the ids whose source rows
+            # have changed are rebuilt (e.g. after an ABS correction to a few boundaries)
+            incremental = settings['resume'] and not zoom_levels_changed \
+                and is_display_boundary_updatable(pg_cur, boundary_name, settings)
+
+            if incremental:
+                changed_count, removed_count, total_count = \
+                    find_changed_display_boundaries(pg_cur, boundary_dict, settings)
+
+                logger.info("\t\t- {0} : {1} of {2} boundaries changed, {3} removed"
+                            .format(boundary_name, changed_count, total_count, removed_count))
+
+                if changed_count == 0 and removed_count == 0:
+                    pg_cur.execute("DROP TABLE {0}.{1}_changes".format(settings['web_schema'], pg_table))
+                    checkpoint.record_unit(pg_cur, "display", boundary_name, None, settings)
+                    continue
+
+                # only the changed boundaries need simplifying
+                table_size = table_size * float(changed_count) / float(max(total_count, 1))
+
             # build create table statement
             create_table_list = list()
-            create_table_list.append("DROP TABLE IF EXISTS {0}.{1} CASCADE;")
-            create_table_list.append("CREATE TABLE {0}.{1} (")
-
-            # build column list
-            column_list = list()
-            column_list.append("id text NOT NULL PRIMARY KEY")
-            column_list.append("name text NOT NULL")
-            column_list.append("area double precision NOT NULL")
-            column_list.append("population double precision NOT NULL")
-            column_list.append("geom geometry(MultiPolygon, 4283) NULL")
-
-            for zoom_level in range(4, 18):
-                display_zoom = str(zoom_level).zfill(2)
-                column_list.append("geojson_{0} jsonb NOT NULL".format(display_zoom))
-
-            # add columns to create table statement and finish it
-            create_table_list.append(",".join(column_list))
-            create_table_list.append(") WITH (OIDS=FALSE);")
-            create_table_list.append("ALTER TABLE {0}.{1} OWNER TO {2};")
-            create_table_list.append("CREATE INDEX {1}_geom_idx ON {0}.{1} USING gist (geom);")
-            create_table_list.append("ALTER TABLE {0}.{1} CLUSTER ON {1}_geom_idx")
-
-            sql = "".join(create_table_list).format(settings['web_schema'], pg_table, settings['pg_user'])
-            create_sql_list.append(sql)
-
-            # get population field and table
-            if boundary_name[:1] == "i":
-                pop_stat = settings['indigenous_population_stat']
-                pop_table = settings['indigenous_population_table']
+
+            if not incremental:
+                create_table_list.append("DROP TABLE IF EXISTS {0}.{1} CASCADE;")
+                create_table_list.append("CREATE TABLE {0}.{1} (")
+
+                # build column list
+                column_list = ["{0} {1}".format(column_name, column_type)
+                               for column_name, column_type in get_display_boundary_columns(settings)]
+
+                # add columns to create table statement and finish it
+                create_table_list.append(",".join(column_list))
+                create_table_list.append(") WITH (OIDS=FALSE);")
+                create_table_list.append("ALTER TABLE {0}.{1} OWNER TO {2};")
+                create_table_list.append("CREATE INDEX {1}_geom_idx ON {0}.{1} USING gist (geom);")
+                create_table_list.append("ALTER TABLE {0}.{1} CLUSTER ON {1}_geom_idx;")
+
+            if settings['output_format'] in ["mvt", "topojson"]:
+                # vector tiles are binary, TopoJSON tiles are text. a boundary's tiles are always cut again in full
+                # (unchanged tiles aren't uploaded to S3 again)
+                tile_type = "bytea" if settings['output_format'] == "mvt" else "text"
+
+                create_table_list.append("DROP TABLE IF EXISTS {0}.{1}_tiles CASCADE;")
+                create_table_list.append("CREATE TABLE {0}.{1}_tiles (z smallint NOT NULL, x integer NOT NULL, "
+                                         "y integer NOT NULL, tile " + tile_type + " NOT NULL, "
+                                         "PRIMARY KEY (z, x, y)) WITH (OIDS=FALSE);")
+                create_table_list.append("ALTER TABLE {0}.{1}_tiles OWNER TO {2};")
+
+                # one job per zoom level - the higher zoom levels have the most tiles, so they're run first
+                for zoom_level in range(settings['tile_max_zoom'], settings['tile_min_zoom'] - 1, -1):
+                    if settings['output_format'] == "mvt":
+                        work = get_vector_tile_insert_sql(boundary_name, zoom_level, settings)
+                        job_boundary_dict[work] = boundary_name
+                    else:
+                        work = dict()
+                        work["name"] = "{0} zoom {1} topojson".format(boundary_name, zoom_level)
+                        work["boundary"] = boundary_name
+                        work["zoom"] = zoom_level
+                        work["decimal_places"] = utils.get_zoom_level(zoom_level, settings)["decimal_places"]
+                        work["table"] = "{0}.{1}_tiles".format(settings['web_schema'], pg_table)
+                        work["sql"] = get_geojson_tile_sql(boundary_name, zoom_level, settings)
+                        job_boundary_dict[work["name"]] = boundary_name
+
+                    tile_work_list.append(work)
+
+                sql = "VACUUM ANALYZE {0}.{1}_tiles".format(settings['web_schema'], pg_table)
+                tile_vacuum_sql_list.append(sql)
+                job_boundary_dict[sql] = boundary_name
+
+            if len(create_table_list) > 0:
+                sql = "".join(create_table_list).format(settings['web_schema'], pg_table, settings['pg_user'])
+                create_sql_list.append(sql)
+                job_boundary_dict[sql] = boundary_name
+
+            # split the insert into shards by boundary id - the number of shards is proportional to the size of
+            # the source table, so that big boundaries (e.g. SA1s) are spread across all the processes (see below)
+            insert_sql_dicts.append({"boundary_dict": boundary_dict, "size": table_size, "incremental": incremental})
+
+            if incremental:
+                sql = "DROP TABLE {0}.{1}_changes".format(settings['web_schema'], pg_table)
+                vacuum_sql_list.append(sql)
+                job_boundary_dict[sql] = boundary_name
+
+            sql = "VACUUM ANALYZE {0}.{1}".format(settings['web_schema'], pg_table)
+            vacuum_sql_list.append(sql)
+            job_boundary_dict[sql] = boundary_name
+
+    # a shard per DISPLAY_SHARD_BYTES of source table, up to a few per process (so there's always work left to
+    # balance the load at the end). sized by each table alone, as boundaries are created as they're loaded
+    max_shards = settings['max_concurrent_processes'] * 4
+
+    job_list = list()
+
+    for insert_sql_dict in insert_sql_dicts:
+        shards = max(min(int(round(insert_sql_dict["size"] / DISPLAY_SHARD_BYTES)), max_shards), 1)
+
+        # split by ranges of boundary ids holding roughly the same number of points, so every row for a boundary
+        # id lands in the same shard and each shard takes about as long to simplify
+        boundary_dict = insert_sql_dict["boundary_dict"]
+        sql = get_display_boundary_insert_sql(boundary_dict, settings, insert_sql_dict["incremental"])
+
+        if insert_sql_dict["incremental"]:
+            # split the changed ids by row count
+            shard_sql_list = utils.split_sql_into_list(pg_cur, sql, settings['web_schema'],
+                                                       "{0}_changes".format(boundary_dict["boundary"]), "bdy",
+                                                       boundary_dict["id_field"], settings, logger, shards)
+        else:
+            input_pg_table = "{0}_{1}_aust".format(boundary_dict["boundary"], settings["census_year"])
+            shard_sql_list = utils.split_sql_into_list(pg_cur, sql, settings['boundary_schema'], input_pg_table,
+                                                       "bdy", boundary_dict["id_field"], settings, logger, shards,
+                                                       "geom")
+
+        for sql in shard_sql_list:
+            job_list.append((insert_sql_dict["size"] / len(shard_sql_list), sql))
+            job_boundary_dict[sql] = boundary_dict["boundary"]
+
+    # longest job first - the small jobs fill in the gaps at the end, keeping all processes busy
+    job_list.sort(key=lambda job: job[0], reverse=True)
+    insert_sql_list = [job[1] for job in job_list]
+
+    # print("\n".join(insert_sql_list))
+
+    def count_success(work, result):
+        boundary_name = job_boundary_dict[work["name"] if isinstance(work, dict) else work]
+        success_dict[boundary_name] = success_dict.get(boundary_name, 0) + 1
+
+    for sql_list in [create_sql_list, insert_sql_list, vacuum_sql_list]:
+        if not utils.multiprocess_list("sql", sql_list, settings, logger, count_success):
+            return False
+
+    # cut the boundaries into tiles (vector tiles are built in Postgres, TopoJSON tiles in Python)
+    if settings['output_format'] == "topojson":
+        if not utils.multiprocess_topojson_tiles(tile_work_list, settings, logger, count_success):
+            return False
+    elif not utils.multiprocess_list("sql", tile_work_list, settings, logger, count_success):
+        return False
+
+    if not utils.multiprocess_list("sql", tile_vacuum_sql_list, settings, logger, count_success):
+        return False
+
+    # record the boundaries where every job succeeded
+    for boundary_name in set(job_boundary_dict.values()):
+        if success_dict.get(boundary_name, 0) == list(job_boundary_dict.values()).count(boundary_name):
+            checkpoint.record_unit(pg_cur, "display", boundary_name, None, settings)
+
+    logger.info("\t- Step 2 of 2 : {0} : web optimised boundaries created : {1}"
+                .format(stage_name, datetime.now() - start_time))
+    metrics.end_stage(settings)
+
+    return True
+
+
+# exports the web optimised boundaries to S3 as tiles ({prefix}/{boundary}/{z}/{x}/{y}.geojson, .mvt or .topojson),
+# with an index of each boundary's tiles & their hashes. unchanged tiles since the last export aren't uploaded
+def export_display_boundaries(settings):
+    start_time = metrics.start_stage("s3_export")
+
+    s3_client = s3utils.get_s3_client()
+
+    if settings['s3_compression'] == "both" and s3utils.brotli is None:
+        logger.warning("\t\t- brotli Python module not installed - exporting gzipped files only")
+
+    encodings = [str(encoding) for encoding in s3utils.get_content_encodings(settings)]
+
+    if settings['output_format'] == "mvt":
+        file_type = "mvt"
+        content_type = "application/vnd.mapbox-vector-tile"
+    elif settings['output_format'] == "topojson":
+        file_type = "topojson"
+        content_type = "application/json"
+    else:
+        file_type = "geojson"
+        content_type = "application/geo+json"
+
+    # export the simplification & display parameters of each zoom level, for clients to use
+    zoom_levels = utils.get_zoom_levels(settings)
+    s3utils.put_object(s3_client, settings['s3_bucket'], settings['s3_prefix'] + "/zoom_levels.json",
+                       json.dumps([zoom_levels[zoom] for zoom in sorted(zoom_levels)]).encode("utf-8"),
+                       "application/json", settings)
+
+    # no index records whether the last export added a brotli variant - delete it if there's none now
+    if "br" not in encodings:
+        s3utils.delete_keys(s3_client, settings['s3_bucket'], [settings['s3_prefix'] + "/zoom_levels.json.br"])
+
+    work_list = list()
+    index_dict = dict()
+
+    for boundary_dict in settings['bdy_table_dicts']:
+        boundary_name = boundary_dict["boundary"]
+
+        if boundary_name != "mb":
+            key_prefix = "{0}/{1}".format(settings['s3_prefix'], boundary_name)
+
+            # get the tile hashes from the last export
+            previous_index = s3utils.get_json_object(s3_client, settings['s3_bucket'], key_prefix + "/index.json")
+
+            if previous_index is None:
+                previous_index = {"format": file_type, "zooms": dict()}
+
+            # a change of format or compression means every tile needs uploading again
+            if previous_index.get("format") == file_type and previous_index.get("encodings") == encodings:
+                previous_hash_dict = previous_index["zooms"]
             else:
-                pop_stat = settings['population_stat']
-                pop_table = settings['population_table']
+                previous_hash_dict = dict()
+
+            index_dict[boundary_name] = {"previous": previous_index, "previous_hashes": previous_hash_dict,
+                                         "zooms": dict()}
+
+            for zoom_level in range(settings['tile_min_zoom'], settings['tile_max_zoom'] + 1):
+                work_dict = dict()
+                work_dict["name"] = "{0} zoom {1}".format(boundary_name, zoom_level)
+                work_dict["boundary"] = boundary_name
+                work_dict["zoom"] = zoom_level
+                work_dict["key_prefix"] = key_prefix
+                work_dict["file_type"] = file_type
+                work_dict["content_type"] = content_type
+                work_dict["previous_tiles"] = previous_hash_dict.get(str(zoom_level), dict())
+
+                if settings['output_format'] in ["mvt", "topojson"]:
+                    work_dict["sql"] = "SELECT x, y, tile FROM {0}.{1}_tiles WHERE z = {2}"\
+                        .format(settings['web_schema'], boundary_name, zoom_level)
+                else:
+                    work_dict["sql"] = get_geojson_tile_sql(boundary_name, zoom_level, settings)
+
+                work_list.append(work_dict)
 
-            # print(boundary_name)
-            # print(pop_stat + " - " + pop_table)
+    # the high zoom levels have the most tiles - start them first
+    work_list.sort(key=lambda work_dict: work_dict["zoom"], reverse=True)
 
-            # build insert statement
-            insert_into_list = list()
-            insert_into_list.append("INSERT INTO {0}.{1}".format(settings['web_schema'], pg_table))
-            insert_into_list.append("SELECT bdy.{0} AS id, {1} AS name, SUM(bdy.{2}) AS area, tab.{3} AS population,"
-                                    .format(id_field, name_field, area_field, pop_stat))
+    def add_tiles(work_dict, result):
+        index_dict[work_dict["boundary"]]["zooms"][str(work_dict["zoom"])] = result["tiles"]
 
-            # thin geometry to make querying faster
-            tolerance = utils.get_tolerance(10)
-            insert_into_list.append("ST_Transform(ST_Multi(ST_Union(ST_SimplifyVW("
-                                    "ST_Transform(geom, 3577), {0}))), 4283),".format(tolerance,))
+    if not utils.multiprocess_tile_export(work_list, settings, logger, add_tiles):
+        return False
 
-            # create statements for geojson optimised for each zoom level
-            geojson_list = list()
+    # write the new indexes and delete tiles that no longer exist
+    for boundary_name, boundary_index_dict in index_dict.items():
+        key_prefix = "{0}/{1}".format(settings['s3_prefix'], boundary_name)
+        zooms = boundary_index_dict["zooms"]
 
-            for zoom_level in range(4, 18):
-                # thin geometries to a default tolerance per zoom level
-                tolerance = utils.get_tolerance(zoom_level)
-                # trim coords to only the significant ones
-                decimal_places = utils.get_decimal_places(zoom_level)
+        # keep the previous tiles for any zoom level that failed to export
+        for zoom_level in range(settings['tile_min_zoom'], settings['tile_max_zoom'] + 1):
+            if str(zoom_level) not in zooms and str(zoom_level) in boundary_index_dict["previous_hashes"]:
+                zooms[str(zoom_level)] = boundary_index_dict["previous_hashes"][str(zoom_level)]
 
-                geojson_list.append("ST_AsGeoJSON(ST_Transform(ST_Multi(ST_Union(ST_SimplifyVW(ST_Transform("
-                                    "bdy.geom, 3577), {0}))), 4283), {1})::jsonb"
-                                    .format(tolerance, decimal_places))
+        index = {"boundary": boundary_name, "format": file_type, "tiles": "{z}/{x}/{y}." + file_type,
+                 "encodings": encodings, "min_zoom": settings['tile_min_zoom'], "max_zoom": settings['tile_max_zoom'],
+                 "zooms": zooms}
+        s3utils.put_object(s3_client, settings['s3_bucket'], key_prefix + "/index.json",
+                           json.dumps(index, sort_keys=True).encode("utf-8"), "application/json", settings)
 
-            insert_into_list.append(",".join(geojson_list))
-            insert_into_list.append("FROM {0}.{1} AS bdy".format(settings['boundary_schema'], input_pg_table))
-            insert_into_list.append("INNER JOIN {0}.{1}_{2} AS tab"
-                                    .format(settings['data_schema'], boundary_name, pop_table))
-            insert_into_list.append("ON bdy.{0} = tab.{1}".format(id_field, settings["region_id_field"]))
-            insert_into_list.append("WHERE bdy.geom IS NOT NULL")
-            insert_into_list.append("GROUP BY {0}, {1}, {2}".format(id_field, name_field, pop_stat))
+        num_stale = delete_stale_tiles(s3_client, key_prefix, boundary_index_dict["previous"], index, settings)
 
-            sql = " ".join(insert_into_list)
-            insert_sql_list.append(sql)
+        logger.info("\t\t- {0} : {1} tiles indexed, {2} stale tiles deleted"
+                    .format(boundary_name, sum([len(tiles) for tiles in zooms.values()]), num_stale))
 
-            vacuum_sql_list.append("VACUUM ANALYZE {0}.{1}".format(settings['web_schema'], pg_table))
+    logger.info("\t- Step 1 of 1 : boundaries exported to S3 : {0}".format(datetime.now() - start_time))
+    metrics.end_stage(settings)
+
+    return True
+
+
+# deletes the tiles in a boundary's previous index that aren't in its new one (or are in another format), and the
+# brotli variants of the tiles (and index) that are kept if brotli has been turned off since (e.g. a re-export with
+# --s3-compression gzip after one with both). returns the number of tiles deleted
+def delete_stale_tiles(s3_client, key_prefix, previous_index, index, settings):
+    previous_file_type = previous_index.get("format", "geojson")
+    drop_brotli = "br" in previous_index.get("encodings", list()) and "br" not in index["encodings"]
+
+    stale_keys = list()
+    stale_variant_keys = list()
+
+    for zoom, tiles in previous_index["zooms"].items():
+        for tile_id in tiles:
+            key = "{0}/{1}/{2}.{3}".format(key_prefix, zoom, tile_id, previous_file_type)
+
+            if tile_id not in index["zooms"].get(zoom, dict()) or previous_file_type != index["format"]:
+                stale_keys.append(key)
+            elif drop_brotli:
+                stale_variant_keys.append(key + ".br")
+
+    if drop_brotli:
+        stale_variant_keys.append(key_prefix + "/index.json.br")
+
+    s3utils.delete_objects(s3_client, settings['s3_bucket'], stale_keys)
+    s3utils.delete_keys(s3_client, settings['s3_bucket'], stale_variant_keys)
+
+    return len(stale_keys)
+
+
+# builds the query that returns a boundary's features for a zoom level, as one GeoJSON FeatureCollection per
+# map tile (x, y, geojson). features that cross tile edges are clipped to each tile they touch (plus a small buffer,
+# so the clipped edges aren't drawn inside the tile), so a tile only holds the part of a big boundary it shows
+def get_geojson_tile_sql(boundary_name, zoom_level, settings):
+    display_zoom = str(zoom_level).zfill(2)
+    tile_count = 2 ** zoom_level
+    decimal_places = utils.get_zoom_level(zoom_level, settings)["decimal_places"]
+
+    # the buffer in degrees - the tile's width in degrees is spread over its pixels
+    tile_buffer = 360.0 / float(tile_count) * TILE_BUFFER_PIXELS / float(settings['tile_size'])
+
+    # web mercator tile numbering - x counts east from 180 degrees west, y counts south from ~85 degrees north
+    lon_to_x = "least(greatest(floor(({0} + 180.0) / 360.0 * {1})::integer, 0), {1} - 1)"
+    lat_to_y = "least(greatest(floor((1.0 - ln(tan(radians({0})) + 1.0 / cos(radians({0}))) / pi()) / 2.0 " \
+               "* {1})::integer, 0), {1} - 1)"
+    x_to_lon = "(({0}) / {1}.0 * 360.0 - 180.0)"
+    y_to_lat = "degrees(atan(sinh(pi() * (1.0 - 2.0 * ({0}) / {1}.0))))"
+
+    tile_envelope = "ST_MakeEnvelope({0}, {1}, {2}, {3}, 4283)"\
+        .format(x_to_lon.format("tile_x", tile_count), y_to_lat.format("tile_y + 1", tile_count),
+                x_to_lon.format("tile_x + 1", tile_count), y_to_lat.format("tile_y", tile_count))
+
+    sql_list = list()
+    sql_list.append("SELECT tile_x, tile_y, json_build_object('type', 'FeatureCollection', 'features', "
+                    "json_agg(json_build_object('type', 'Feature', 'id', bdy.id, 'properties', "
+                    "json_build_object('name', bdy.name, 'area', bdy.area, 'population', bdy.population), "
+                    "'geometry', ST_AsGeoJSON(clipped.geom, {0})::json) ORDER BY bdy.id))::text"
+                    .format(decimal_places))
+    sql_list.append("FROM {0}.{1} AS bdy".format(settings['web_schema'], boundary_name))
+
+    # the zoom level's geometry is parsed once per feature, not once per tile
+    sql_list.append("CROSS JOIN LATERAL (SELECT ST_GeomFromGeoJSON(bdy.geojson_{0}::text) AS geom OFFSET 0) AS display"
+                    .format(display_zoom))
+    sql_list.append("CROSS JOIN LATERAL generate_series({0}, {1}) AS tile_x"
+                    .format(lon_to_x.format("ST_XMin(bdy.geom)", tile_count),
+                            lon_to_x.format("ST_XMax(bdy.geom)", tile_count)))
+    sql_list.append("CROSS JOIN LATERAL generate_series({0}, {1}) AS tile_y"
+                    .format(lat_to_y.format("ST_YMax(bdy.geom)", tile_count),
+                            lat_to_y.format("ST_YMin(bdy.geom)", tile_count)))
+    sql_list.append("CROSS JOIN LATERAL (SELECT ST_ClipByBox2D(display.geom, ST_Expand({0}, {1})::box2d) AS geom) "
+                    "AS clipped".format(tile_envelope, tile_buffer))
+    sql_list.append("WHERE bdy.geom IS NOT NULL")
+    sql_list.append("AND ST_Intersects(bdy.geom, {0})".format(tile_envelope))
+    sql_list.append("AND NOT ST_IsEmpty(clipped.geom)")
+    sql_list.append("GROUP BY tile_x, tile_y")
+
+    return " ".join(sql_list)
+
+
+# the columns of a web optimised boundary table, as (name, type) tuples
+def get_display_boundary_columns(settings):
+    column_list = list()
+    column_list.append(("id", "text NOT NULL PRIMARY KEY"))
+    column_list.append(("name", "text NOT NULL"))
+    column_list.append(("area", "double precision NOT NULL"))
+    column_list.append(("population", "double precision NOT NULL"))
+    column_list.append(("geom", "geometry(MultiPolygon, 4283) NULL"))
+
+    if settings['output_format'] == "mvt":
+        # vector tiles are cut from the most detailed geometry - one geometry instead of a column per zoom
+        column_list.append(("geom_3577", "geometry(MultiPolygon, 3577) NULL"))
+    else:
+        for zoom_level in range(4, 18):
+            column_list.append(("geojson_{0}".format(str(zoom_level).zfill(2)), "jsonb NOT NULL"))
+
+    # hash of the source rows each boundary was built from, to find the boundaries that change between loads
+    column_list.append(("source_hash", "text NOT NULL"))
+
+    return column_list
+
+
+# can a web optimised boundary table from a previous load be updated in place? it needs the columns of the current
+# output format (and the source hashes)
+def is_display_boundary_updatable(pg_cur, boundary_name, settings):
+    pg_cur.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_schema = '{0}' AND table_name = '{1}'".format(settings['web_schema'], boundary_name))
+    table_columns = set([row[0] for row in pg_cur.fetchall()])
+
+    return table_columns == set([column_name for column_name, column_type in get_display_boundary_columns(settings)])
 
-    # print("\n".join(insert_sql_list))
 
-    utils.multiprocess_list("sql", create_sql_list, settings, logger)
-    utils.multiprocess_list("sql", insert_sql_list, settings, logger)
-    utils.multiprocess_list("sql", vacuum_sql_list, settings, logger)
+# finds the boundaries whose source rows (geometries, name, area or population) have changed since their web optimised
+# versions were built, by comparing each id's source hash with the one stored in the web optimised table.
+# removes boundaries that no longer exist & saves the ids of the changed and new ones to a '{boundary}_changes' table.
+# returns the number of changed (or new), removed & total boundaries
+def find_changed_display_boundaries(pg_cur, boundary_dict, settings):
+    boundary_name = boundary_dict["boundary"]
+    id_field = boundary_dict["id_field"]
+    web_table = "{0}.{1}".format(settings['web_schema'], boundary_name)
+    changes_table = "{0}.{1}_changes".format(settings['web_schema'], boundary_name)
+
+    pop_stat = get_population_stat(boundary_name, settings)[0]
+
+    pg_cur.execute("DROP TABLE IF EXISTS {0}".format(changes_table))
+    pg_cur.execute("CREATE UNLOGGED TABLE {0} AS SELECT bdy.{1}, {2} AS source_hash {3} GROUP BY bdy.{1}, {4}, tab.{5}"
+                   .format(changes_table, id_field, get_source_hash_sql(boundary_dict, settings),
+                           " ".join(get_display_boundary_source_sql(boundary_dict, settings)),
+                           boundary_dict["name_field"], pop_stat))
+    total_count = pg_cur.rowcount
+
+    pg_cur.execute("DELETE FROM {0} AS web WHERE NOT EXISTS (SELECT 1 FROM {1} AS src WHERE src.{2} = web.id)"
+                   .format(web_table, changes_table, id_field))
+    removed_count = pg_cur.rowcount
+
+    pg_cur.execute("DELETE FROM {0} AS src USING {1} AS web WHERE web.id = src.{2} "
+                   "AND web.source_hash = src.source_hash".format(changes_table, web_table, id_field))
+    changed_count = total_count - pg_cur.rowcount
+
+    # for splitting the changed ids into shards
+    pg_cur.execute("ANALYZE {0}".format(changes_table))
+
+    return changed_count, removed_count, total_count
+
+
+# the population stat & census table of a boundary
+def get_population_stat(boundary_name, settings):
+    if boundary_name[:1] == "i":
+        return settings['indigenous_population_stat'], settings['indigenous_population_table']
+    else:
+        return settings['population_stat'], settings['population_table']
 
-    logger.info("\t- Step 3 of 3 : web optimised boundaries created : {0}".format(datetime.now() - start_time))
+
+# the source rows of a boundary's web optimised boundaries - its Shapefile's rows (aliased as 'bdy') with their
+# population (aliased as 'tab'). returns a list of SQL clauses
+def get_display_boundary_source_sql(boundary_dict, settings):
+    boundary_name = boundary_dict["boundary"]
+    id_field = boundary_dict["id_field"]
+
+    input_pg_table = "{0}_{1}_aust".format(boundary_name, settings["census_year"])
+    pop_stat, pop_table = get_population_stat(boundary_name, settings)
+
+    sql_list = list()
+    sql_list.append("FROM {0}.{1} AS bdy".format(settings['boundary_schema'], input_pg_table))
+    if settings['partitioned_tables']:
+        # the partitioned census table is filtered down to the boundary's partition by the planner
+        sql_list.append("INNER JOIN {0}.{1} AS tab".format(settings['data_schema'], pop_table))
+        sql_list.append("ON tab.boundary = '{0}' AND bdy.{1} = tab.{2}"
+                        .format(boundary_name, id_field, settings["region_id_field"]))
+    else:
+        sql_list.append("INNER JOIN {0}.{1}_{2} AS tab".format(settings['data_schema'], boundary_name, pop_table))
+        sql_list.append("ON bdy.{0} = tab.{1}".format(id_field, settings["region_id_field"]))
+    sql_list.append("WHERE bdy.geom IS NOT NULL")
+
+    return sql_list
+
+
+# hash of a boundary id's source rows - its geometries (in any order), name, area & population. use in a query
+# grouped by id, over get_display_boundary_source_sql
+def get_source_hash_sql(boundary_dict, settings):
+    pop_stat = get_population_stat(boundary_dict["boundary"], settings)[0]
+
+    return "md5(concat_ws('|', string_agg(md5(ST_AsEWKB(bdy.geom)), ',' ORDER BY md5(ST_AsEWKB(bdy.geom))), {0}, " \
+           "SUM(bdy.{1}), tab.{2}))".format(boundary_dict["name_field"], boundary_dict["area_field"], pop_stat)
+
+
+# builds the insert statement for a web optimised boundary table, with a placeholder for the filter that limits it to a
+# subset (shard) of the ids (see utils.split_sql_into_list). if changed_only is set, only the boundaries in the
+# '{boundary}_changes' table are built (see find_changed_display_boundaries), replacing their existing rows
+def get_display_boundary_insert_sql(boundary_dict, settings, changed_only=False):
+    boundary_name = boundary_dict["boundary"]
+    id_field = boundary_dict["id_field"]
+    name_field = boundary_dict["name_field"]
+    area_field = boundary_dict["area_field"]
+
+    pg_table = "{0}".format(boundary_name)
+
+    # get population field
+    pop_stat = get_population_stat(boundary_name, settings)[0]
+
+    # build insert statement
+    # each boundary is transformed & unioned once, then simplified for each zoom level from the previous
+    # (more detailed) zoom level's output - VW tolerances only grow as you zoom out.
+    # the OFFSET 0s stop Postgres flattening the LATERAL chain (which would rerun every simplification)
+    geom_zoom_level = 10  # zoom level of the thinned geometry used to make querying faster
+
+    if settings['output_format'] == "mvt":
+        zoom_levels = [geom_zoom_level, 17]  # vector tiles are cut from the most detailed geometry
+    else:
+        zoom_levels = list(range(4, 18))
+
+    insert_into_list = list()
+    insert_into_list.append("INSERT INTO {0}.{1}".format(settings['web_schema'], pg_table))
+    insert_into_list.append("SELECT src.id, src.name, src.area, src.population,")
+    insert_into_list.append("ST_Transform(ST_Multi(z{0}.geom), 4283),".format(str(geom_zoom_level).zfill(2)))
+
+    if settings['output_format'] == "mvt":
+        insert_into_list.append("ST_Multi(z17.geom)")
+    else:
+        # create statements for geojson optimised for each zoom level
+        geojson_list = list()
+
+        for zoom_level in zoom_levels:
+            # trim coords to only the significant ones
+            decimal_places = utils.get_zoom_level(zoom_level, settings)["decimal_places"]
+
+            geojson_list.append("ST_AsGeoJSON(ST_Transform(ST_Multi(z{0}.geom), 4283), {1})::jsonb"
+                                .format(str(zoom_level).zfill(2), decimal_places))
+
+        insert_into_list.append(",".join(geojson_list))
+
+    insert_into_list.append(", src.source_hash")
+
+    # union the boundary's source geometries once, in Australian Albers
+    insert_into_list.append("FROM (SELECT bdy.{0} AS id, {1} AS name, SUM(bdy.{2}) AS area, "
+                            "tab.{3} AS population, ST_Union(ST_Transform(bdy.geom, 3577)) AS geom, {4} AS source_hash"
+                            .format(id_field, name_field, area_field, pop_stat,
+                                    get_source_hash_sql(boundary_dict, settings)))
+    insert_into_list.extend(get_display_boundary_source_sql(boundary_dict, settings))
+    insert_into_list.append("AND {0}".format(utils.SHARD_FILTER_PLACEHOLDER))
+
+    if changed_only:
+        insert_into_list.append("AND bdy.{0} IN (SELECT {0} FROM {1}.{2}_changes)"
+                                .format(id_field, settings['web_schema'], pg_table))
+
+    insert_into_list.append("GROUP BY {0}, {1}, {2}) AS src".format(id_field, name_field, pop_stat))
+
+    # thin geometries to a default tolerance per zoom level, from the most detailed to the least
+    previous_zoom = "src"
+
+    for zoom_level in reversed(zoom_levels):
+        tolerance = utils.get_zoom_level(zoom_level, settings)["tolerance"]
+        display_zoom = "z" + str(zoom_level).zfill(2)
+
+        insert_into_list.append("CROSS JOIN LATERAL (SELECT ST_SimplifyVW({0}.geom, {1}) AS geom OFFSET 0) "
+                                "AS {2}".format(previous_zoom, tolerance, display_zoom))
+        previous_zoom = display_zoom
+
+    # replace the changed boundaries' existing rows
+    if changed_only:
+        insert_into_list.append("ON CONFLICT (id) DO UPDATE SET {0}"
+                                .format(", ".join(["{0} = EXCLUDED.{0}".format(column_name) for column_name, column_type
+                                                   in get_display_boundary_columns(settings) if column_name != "id"])))
+
+    return " ".join(insert_into_list)
+
+
+# builds the insert statement for one zoom level of a boundary's vector tiles. each feature is simplified for the
+# zoom level once, then clipped into every tile it touches. tile envelopes are calculated here in web mercator,
+# rather than with ST_TileEnvelope, so PostGIS 2.4+ works
+def get_vector_tile_insert_sql(boundary_name, zoom_level, settings):
+    tile_count = 2 ** zoom_level
+    world_extent = 20037508.342789244  # half the width of the web mercator world, in metres
+    tile_size = world_extent * 2.0 / tile_count
+
+    # tile numbering - x counts east from 180 degrees west, y counts south from ~85 degrees north
+    to_x = "least(greatest(floor(({0} + {1}) / {2})::integer, 0), {3} - 1)"
+    to_y = "least(greatest(floor(({1} - {0}) / {2})::integer, 0), {3} - 1)"
+
+    sql_list = list()
+    sql_list.append("INSERT INTO {0}.{1}_tiles (z, x, y, tile)".format(settings['web_schema'], boundary_name))
+    sql_list.append("SELECT {0}, tile.tile_x, tile.tile_y, ST_AsMVT(mvt, '{1}', 4096, 'geom')"
+                    .format(zoom_level, boundary_name))
+    sql_list.append("FROM (SELECT tile_x, tile_y, bdy.id, bdy.name, bdy.area, bdy.population,")
+    sql_list.append("ST_AsMVTGeom(bdy.geom, ST_MakeEnvelope(-{0} + tile_x * {1}, {0} - (tile_y + 1) * {1}, "
+                    "-{0} + (tile_x + 1) * {1}, {0} - tile_y * {1}, 3857), 4096, 64, true) AS geom"
+                    .format(world_extent, tile_size))
+    sql_list.append("FROM (SELECT id, name, area, population, "
+                    "ST_Transform(ST_SimplifyVW(geom_3577, {0}), 3857) AS geom FROM {1}.{2} "
+                    "WHERE geom_3577 IS NOT NULL OFFSET 0) AS bdy"
+                    .format(utils.get_zoom_level(zoom_level, settings)["tolerance"], settings['web_schema'],
+                            boundary_name))
+    sql_list.append("CROSS JOIN LATERAL generate_series({0}, {1}) AS tile_x"
+                    .format(to_x.format("ST_XMin(bdy.geom)", world_extent, tile_size, tile_count),
+                            to_x.format("ST_XMax(bdy.geom)", world_extent, tile_size, tile_count)))
+    sql_list.append("CROSS JOIN LATERAL generate_series({0}, {1}) AS tile_y"
+                    .format(to_y.format("ST_YMax(bdy.geom)", world_extent, tile_size, tile_count),
+                            to_y.format("ST_YMin(bdy.geom)", world_extent, tile_size, tile_count)))
+    sql_list.append("WHERE NOT ST_IsEmpty(bdy.geom)) AS tile")
+
+    # the feature's properties, without the tile numbers
+    sql_list.append("CROSS JOIN LATERAL (SELECT tile.id, tile.name, tile.area, tile.population, tile.geom) AS mvt")
+    sql_list.append("WHERE tile.geom IS NOT NULL")
+    sql_list.append("GROUP BY tile.tile_x, tile.tile_y")
+
+    return " ".join(sql_list)
 
 
 if __name__ == '__main__':
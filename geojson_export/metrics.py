@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# records metrics for each step of a load and each job run by the worker pool (time queued & running, time spent
+# waiting on Postgres, rows & bytes processed, the worker that ran it), to find the slowest boundaries & files in a
+# load. metrics are written as JSON lines (one per job & step) and/or as a Prometheus textfile (summed by step &
+# job type), as set by '--metrics-file' and '--prometheus-file'
+
+import checkpoint
+import cProfile
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+
+from datetime import datetime
+
+# all metrics are prefixed with this in the Prometheus textfile
+PROMETHEUS_PREFIX = "census_loader"
+
+# identifies the load each metric came from
+run_start_time = datetime.now()
+run_start_timestamp = time.time()
+
+# the step running in each thread (see start_stage) - its jobs are recorded against it. steps can run at the same time,
+# each in its own thread (see scheduler.py)
+stage_local = threading.local()
+
+# serialises updates to the summed metrics & writes to the metrics files, from steps running at the same time
+metrics_lock = threading.Lock()
+
+# summed job metrics & step times, for the Prometheus textfile
+job_stats_dict = dict()
+stage_seconds_dict = dict()
+
+# per worker profiler (see start_worker_profile)
+worker_profile = None
+
+
+# marks the start of a step. returns the start time, for the step's own logging
+def start_stage(stage_name):
+    stage_local.stage = stage_name
+    stage_local.start_time = datetime.now()
+
+    return stage_local.start_time
+
+
+# the step running in this thread, or None
+def get_current_stage():
+    return getattr(stage_local, "stage", None)
+
+
+# records the time taken by the current step
+def end_stage(settings):
+    current_stage = get_current_stage()
+
+    if current_stage is None:
+        return
+
+    seconds = (datetime.now() - stage_local.start_time).total_seconds()
+
+    metric = dict()
+    metric["type"] = "stage"
+    metric["stage"] = current_stage
+    metric["seconds"] = seconds
+
+    with metrics_lock:
+        stage_seconds_dict[current_stage] = seconds
+
+        write_json_line(metric, settings)
+        write_prometheus_file(settings)
+
+    stage_local.stage = None
+
+
+# records a job's metrics, from the result dict returned by utils.run_job
+def record_job(job_type, work, result, settings):
+    file_path, table, boundary = get_job_details(work)
+
+    # jobs that read a file (CSVs, Shapefiles, spreadsheets) are measured by the size of the file
+    num_bytes = result.get("bytes")
+
+    if num_bytes is None and file_path is not None and os.path.isfile(file_path):
+        num_bytes = checkpoint.get_file_signature(file_path)[0]
+
+    current_stage = get_current_stage()
+
+    metric = dict()
+    metric["type"] = "job"
+    metric["stage"] = current_stage
+    metric["job_type"] = job_type
+    metric["name"] = result["name"]
+    metric["file"] = file_path
+    metric["table"] = table
+    metric["boundary"] = boundary
+    metric["success"] = result["result"] == "SUCCESS"
+    metric["worker"] = result.get("worker")
+    metric["worker_pid"] = result.get("worker_pid")
+    metric["queue_wait_seconds"] = result.get("queue_wait_seconds")
+    metric["seconds"] = result["seconds"]
+    metric["db_seconds"] = result.get("db_seconds")
+    metric["rows"] = result.get("rows")
+    metric["bytes"] = num_bytes
+
+    with metrics_lock:
+        write_json_line(metric, settings)
+
+        # sum the job's metrics for the step & job type, keeping the slowest job
+        stats = job_stats_dict.setdefault((current_stage or "", job_type), {
+            "jobs": 0, "failed_jobs": 0, "seconds": 0.0, "queue_wait_seconds": 0.0, "db_seconds": 0.0,
+            "rows": 0, "bytes": 0, "slowest_job": None, "slowest_job_seconds": 0.0})
+
+        stats["jobs"] += 1
+        stats["failed_jobs"] += 0 if metric["success"] else 1
+        stats["seconds"] += metric["seconds"]
+        stats["queue_wait_seconds"] += metric["queue_wait_seconds"] or 0.0
+        stats["db_seconds"] += metric["db_seconds"] or 0.0
+        stats["rows"] += metric["rows"] or 0
+        stats["bytes"] += metric["bytes"] or 0
+
+        if stats["slowest_job"] is None or metric["seconds"] > stats["slowest_job_seconds"]:
+            stats["slowest_job"] = metric["name"]
+            stats["slowest_job_seconds"] = metric["seconds"]
+
+
+# the file, table & boundary a job works on (None if not known, e.g. for SQL statements)
+def get_job_details(work):
+    if not isinstance(work, dict):
+        return None, None, None
+
+    file_path = work.get("path") or work.get("file_path")
+    table = work.get("pg_table") or work.get("table")
+    boundary = work.get("boundary")
+
+    # census data files are loaded into a table per boundary & census table (e.g. sa1_g01)
+    if table is not None and boundary is not None and "pg_table" not in work and "." not in table:
+        table = "{0}_{1}".format(boundary, table)
+
+    return file_path, table, boundary
+
+
+def write_json_line(metric, settings):
+    if settings.get('metrics_file') is None:
+        return
+
+    metric["run_start_time"] = run_start_time.isoformat()
+    metric["time"] = datetime.now().isoformat()
+
+    with open(settings['metrics_file'], "a") as metrics_file:
+        metrics_file.write(json.dumps(metric) + "\n")
+
+
+# writes all metrics so far in the Prometheus text format (e.g. for the node exporter's textfile collector).
+# written to a temp file then renamed, so the file is never read half written
+def write_prometheus_file(settings):
+    if settings.get('prometheus_file') is None:
+        return
+
+    line_list = list()
+
+    def add_metric(name, metric_type, help_text, value_list):
+        line_list.append("# HELP {0}_{1} {2}".format(PROMETHEUS_PREFIX, name, help_text))
+        line_list.append("# TYPE {0}_{1} {2}".format(PROMETHEUS_PREFIX, name, metric_type))
+
+        for labels, value in value_list:
+            label_string = ",".join(['{0}="{1}"'.format(label, escape_label(label_value))
+                                     for label, label_value in labels])
+
+            if label_string != "":
+                label_string = "{" + label_string + "}"
+
+            line_list.append("{0}_{1}{2} {3}".format(PROMETHEUS_PREFIX, name, label_string, value))
+
+    add_metric("run_start_time_seconds", "gauge", "Start time of the load (Unix time).",
+               [([], run_start_timestamp)])
+    add_metric("stage_seconds", "gauge", "Time taken by each step of the load.",
+               [([("stage", stage)], seconds) for stage, seconds in sorted(stage_seconds_dict.items())])
+
+    job_stats_list = [([("stage", stage), ("job_type", job_type)], stats)
+                      for (stage, job_type), stats in sorted(job_stats_dict.items())]
+
+    add_metric("jobs_total", "counter", "Jobs run.",
+               [(labels, stats["jobs"]) for labels, stats in job_stats_list])
+    add_metric("failed_jobs_total", "counter", "Jobs that failed.",
+               [(labels, stats["failed_jobs"]) for labels, stats in job_stats_list])
+    add_metric("job_seconds_total", "counter", "Time spent running jobs, summed across all workers.",
+               [(labels, stats["seconds"]) for labels, stats in job_stats_list])
+    add_metric("job_queue_wait_seconds_total", "counter", "Time jobs spent queued, waiting for a worker.",
+               [(labels, stats["queue_wait_seconds"]) for labels, stats in job_stats_list])
+    add_metric("job_db_seconds_total", "counter", "Time jobs spent waiting on Postgres.",
+               [(labels, stats["db_seconds"]) for labels, stats in job_stats_list])
+    add_metric("job_rows_total", "counter", "Rows copied, inserted or exported by jobs.",
+               [(labels, stats["rows"]) for labels, stats in job_stats_list])
+    add_metric("job_bytes_total", "counter", "Bytes read or written by jobs.",
+               [(labels, stats["bytes"]) for labels, stats in job_stats_list])
+    add_metric("slowest_job_seconds", "gauge", "Time taken by the slowest job of each step & job type.",
+               [(labels + [("job", stats["slowest_job"])], stats["slowest_job_seconds"])
+                for labels, stats in job_stats_list])
+
+    temp_path = "{0}.{1}.tmp".format(settings['prometheus_file'], os.getpid())
+
+    with open(temp_path, "w") as prometheus_file:
+        prometheus_file.write("\n".join(line_list) + "\n")
+
+    os.rename(temp_path, settings['prometheus_file'])
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# profiles everything a pool worker runs, dumping the stats to '{profile directory}/worker_{pid}.prof' when the
+# worker exits. view them with pstats or snakeviz
+def start_worker_profile(settings):
+    global worker_profile
+
+    try:
+        if not os.path.isdir(settings['profile_directory']):
+            os.makedirs(settings['profile_directory'])
+    except OSError:
+        pass  # another worker created it
+
+    worker_profile = cProfile.Profile()
+    worker_profile.enable()
+
+    multiprocessing.util.Finalize(None, dump_worker_profile, args=(settings,), exitpriority=20)
+
+
+def dump_worker_profile(settings):
+    worker_profile.disable()
+    worker_profile.dump_stats(os.path.join(settings['profile_directory'], "worker_{0}.prof".format(os.getpid())))
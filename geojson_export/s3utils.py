@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# helpers for writing the web optimised census boundaries to S3
+
+import boto3
+import gzip
+import hashlib
+import io
+import json
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# brotli is optional - only needed to export brotli compressed variants of each object
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# objects bigger than this are uploaded in parallel parts
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+
+def get_s3_client():
+    return boto3.client('s3')
+
+
+def get_transfer_config(settings):
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_THRESHOLD,
+                          max_concurrency=settings['s3_upload_threads'])
+
+
+# hash of an object's content, used to skip uploading objects that haven't changed
+def get_content_hash(body):
+    return hashlib.md5(body).hexdigest()
+
+
+def gzip_compress(body):
+    compressed_file = io.BytesIO()
+
+    # mtime=0 keeps the output the same for the same input
+    with gzip.GzipFile(fileobj=compressed_file, mode="wb", compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(body)
+
+    return compressed_file.getvalue()
+
+
+def brotli_compress(body):
+    return brotli.compress(body, mode=brotli.MODE_TEXT, quality=11)
+
+
+# the encodings each object is uploaded with. 'gzip' compresses the object at its key (every browser & CDN
+# supports it); 'both' adds a brotli variant at key + '.br' for servers that can pick an encoding per request
+def get_content_encodings(settings):
+    if settings['s3_compression'] == "none":
+        return [None]
+    elif settings['s3_compression'] == "both" and brotli is not None:
+        return ["gzip", "br"]
+    else:
+        return ["gzip"]
+
+
+# returns the variants of an object to upload as (key, body, content encoding) tuples
+def get_encoded_objects(key, body, settings):
+    object_list = list()
+
+    for content_encoding in get_content_encodings(settings):
+        if content_encoding == "gzip":
+            object_list.append((key, gzip_compress(body), content_encoding))
+        elif content_encoding == "br":
+            object_list.append((key + ".br", brotli_compress(body), content_encoding))
+        else:
+            object_list.append((key, body, content_encoding))
+
+    return object_list
+
+
+# uploads one object, compressed once here so neither the web server nor a CDN has to compress it per request.
+# uses a multipart upload for big objects
+def put_object(client, bucket, key, body, content_type, settings):
+    for encoded_key, encoded_body, content_encoding in get_encoded_objects(key, body, settings):
+        put_encoded_object(client, bucket, encoded_key, encoded_body, content_type, content_encoding,
+                           get_content_hash(body), settings)
+
+
+def put_encoded_object(client, bucket, key, body, content_type, content_encoding, content_hash, settings):
+    extra_args = {"ContentType": content_type, "Metadata": {"content-md5-hex": content_hash}}
+
+    if content_encoding is not None:
+        extra_args["ContentEncoding"] = content_encoding
+
+    client.upload_fileobj(io.BytesIO(body), bucket, key, ExtraArgs=extra_args, Config=get_transfer_config(settings))
+
+
+# uploads (key, body, content type) tuples from an iterator using a pool of threads.
+# only a few uploads are queued at a time, so the iterator can stream the objects from Postgres with bounded memory
+def put_objects(client, bucket, object_iterator, settings):
+    max_queued = settings['s3_upload_threads'] * 4
+    num_uploaded = 0
+
+    with ThreadPoolExecutor(max_workers=settings['s3_upload_threads']) as executor:
+        futures = set()
+
+        for key, body, content_type in object_iterator:
+            futures.add(executor.submit(put_object, client, bucket, key, body, content_type, settings))
+
+            if len(futures) >= max_queued:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    future.result()  # raises the upload's error, if it failed
+                    num_uploaded += 1
+
+        for future in futures:
+            future.result()
+            num_uploaded += 1
+
+    return num_uploaded
+
+
+# uploads a local file as is (for files that are already compressed, e.g. Parquet), using a multipart upload for
+# big files
+def upload_file(client, bucket, key, file_path, content_type, settings):
+    client.upload_file(file_path, bucket, key, ExtraArgs={"ContentType": content_type},
+                       Config=get_transfer_config(settings))
+
+
+# returns a JSON object from S3, or None if it doesn't exist. S3 returns 403 instead of 404 for a missing object if
+# the caller can't list the bucket
+def get_json_object(client, bucket, key):
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as ex:
+        if ex.response.get("ResponseMetadata", dict()).get("HTTPStatusCode") in [403, 404]:
+            return None
+        raise
+
+    body = response["Body"].read()
+
+    if response.get("ContentEncoding") == "gzip":
+        body = gzip.decompress(body)
+
+    return json.loads(body.decode("utf-8"))
+
+
+# deletes a list of objects (and their compressed variants)
+def delete_objects(client, bucket, keys):
+    delete_keys(client, bucket, keys + [key + ".br" for key in keys])
+
+
+# deletes a list of keys as is, 1,000 at a time (the S3 limit)
+def delete_keys(client, bucket, keys):
+    for i in range(0, len(keys), 1000):
+        client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]],
+                                                     "Quiet": True})
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# runs the steps of a load (e.g. census CSV load, Shapefile load, web optimised boundaries) as a dependency graph.
+# each step starts as soon as the steps it requires have finished, in its own thread with its own Postgres connection,
+# so independent steps (e.g. the census data & boundary loads) run at the same time & share the worker pool - the
+# pool's workers pick up one step's jobs while another step is waiting on its last few jobs
+
+import psycopg2
+import utils
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+
+# creates a step. function is called with a Postgres cursor and returns True if the step succeeded.
+# requires is a list of the names of the steps that must succeed before it can start
+def get_step(name, function, requires=None):
+    return {"name": name, "function": function, "requires": requires or list()}
+
+
+# runs a list of steps, each as soon as the steps it requires have succeeded. steps that require a step that failed
+# aren't run, and the whole run is aborted if a step fails and --abort-on-failure is set. returns False if any step
+# failed or wasn't run
+def run_steps(step_list, settings, logger):
+    step_names = [step["name"] for step in step_list]
+
+    for step in step_list:
+        for required_name in step["requires"]:
+            if required_name not in step_names:
+                raise ValueError("step '{0}' requires unknown step '{1}'".format(step["name"], required_name))
+
+    pending_list = list(step_list)
+    succeeded_names = set()
+    failed_names = set()
+
+    with ThreadPoolExecutor(max_workers=max(len(step_list), 1)) as executor:
+        futures = dict()
+
+        while True:
+            # start the steps whose required steps have all succeeded, skip those with a failed required step
+            # (repeated until no more are skipped, as skipping a step skips the steps that require it)
+            skipped = True
+
+            while skipped:
+                skipped = False
+
+                for step in list(pending_list):
+                    if utils.abort_event.is_set():
+                        logger.warning("\t- {0} : not run, the run was aborted".format(step["name"]))
+                        failed_names.add(step["name"])
+                        pending_list.remove(step)
+                    elif any([required_name in failed_names for required_name in step["requires"]]):
+                        logger.warning("\t- {0} : not run, a step it requires failed".format(step["name"]))
+                        failed_names.add(step["name"])
+                        pending_list.remove(step)
+                        skipped = True
+                    elif all([required_name in succeeded_names for required_name in step["requires"]]):
+                        logger.debug("\t- {0} : started : {1}".format(step["name"], datetime.now()))
+                        futures[executor.submit(run_step, step, settings)] = step
+                        pending_list.remove(step)
+
+            if len(futures) == 0:
+                break
+
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                step = futures.pop(future)
+
+                # a step that raised an error stops the others before it's raised (the steps still running are
+                # waited on before the error gets to the caller)
+                if future.exception() is not None:
+                    logger.fatal("\t- {0} : raised an error - aborting the run".format(step["name"]))
+                    utils.abort_event.set()
+
+                if future.result():  # raises the step's error, if it raised one
+                    succeeded_names.add(step["name"])
+                else:
+                    failed_names.add(step["name"])
+
+                    # stop the steps that are running too (they stop waiting on their jobs - see utils.abort_event)
+                    if settings.get('abort_on_failure') and not utils.abort_event.is_set():
+                        logger.fatal("\t- {0} : failed - aborting the run".format(step["name"]))
+                        utils.abort_event.set()
+
+    # steps left over have a circular dependency
+    for step in pending_list:
+        logger.fatal("\t- {0} : not run, its required steps can never finish".format(step["name"]))
+        failed_names.add(step["name"])
+
+    return len(failed_names) == 0
+
+
+# runs a step in its own Postgres connection (cursors can't be shared between threads)
+def run_step(step, settings):
+    pg_conn = psycopg2.connect(settings['pg_connect_string'])
+    pg_conn.autocommit = True
+    pg_cur = pg_conn.cursor()
+
+    try:
+        return step["function"](pg_cur)
+    finally:
+        pg_cur.close()
+        pg_conn.close()
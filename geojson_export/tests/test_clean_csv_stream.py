@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tests the census CSV cleaning stream: the output must be the same however the file is split into chunks
+
+import io
+
+import pytest
+
+import utils
+
+# spaces & \x1A characters in values, whitespace before the header, and a DOS style end of file (\r\n\x1A) followed
+# by blank lines
+RAW_CSV = "  \r\n \n SA1_7DIGITCODE_2016 , Tot_P_M ,Tot_P_F\r\n" \
+          "1100701, 1 23,\x1A456\r\n" \
+          "1100702,7 8 9, 10\r\n" \
+          "\r\n1100703,..,..\r\n\x1A\r\n \n"
+
+CLEAN_CSV = "SA1_7DIGITCODE_2016,Tot_P_M,Tot_P_F\r\n" \
+            "1100701,123,456\r\n" \
+            "1100702,789,10\r\n" \
+            "\r\n1100703,..,.."
+
+
+def read_all(stream, size):
+    data_list = list()
+
+    while True:
+        data = stream.read(size)
+
+        if data == "":
+            return "".join(data_list)
+
+        data_list.append(data)
+
+
+def read_lines(stream):
+    line_list = list()
+
+    while True:
+        line = stream.readline()
+
+        if line == "":
+            return line_list
+
+        line_list.append(line)
+
+
+# every chunk size splits the leading & trailing whitespace and the \x1A characters across reads somewhere
+@pytest.mark.parametrize("chunk_size", list(range(1, len(RAW_CSV) + 2)))
+def test_read_is_the_same_for_every_chunk_size(chunk_size):
+    stream = utils.CleanCsvStream(io.StringIO(RAW_CSV), chunk_size)
+
+    assert stream.read() == CLEAN_CSV
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8, 64])
+@pytest.mark.parametrize("read_size", [1, 4, 7, 1000])
+def test_sized_reads_are_the_same_as_one_read(chunk_size, read_size):
+    stream = utils.CleanCsvStream(io.StringIO(RAW_CSV), chunk_size)
+
+    assert read_all(stream, read_size) == CLEAN_CSV
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8, 64])
+def test_readline_returns_whole_lines(chunk_size):
+    stream = utils.CleanCsvStream(io.StringIO(RAW_CSV), chunk_size)
+
+    assert read_lines(stream) == CLEAN_CSV.splitlines(True)
+
+
+# whitespace between rows is kept - it's only dropped at the start & end of the file
+def test_whitespace_only_chunks_between_rows_are_kept():
+    stream = utils.CleanCsvStream(io.StringIO("a,b\n\n\n\nc,d\n\n"), 1)
+
+    assert stream.read() == "a,b\n\n\n\nc,d"
+
+
+@pytest.mark.parametrize("raw_csv", ["", "   ", "\r\n\x1A\r\n", "\x1A"])
+def test_empty_files(raw_csv):
+    stream = utils.CleanCsvStream(io.StringIO(raw_csv), 2)
+
+    assert stream.read() == ""
+    assert stream.readline() == ""
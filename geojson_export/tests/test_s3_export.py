@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tests the S3 tile export against a mocked S3 (moto): new tiles are uploaded compressed, unchanged tiles are skipped
+
+import gzip
+import json
+
+import boto3
+import pytest
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from moto import mock_aws
+
+import export_geojson_to_s3
+import s3utils
+import utils
+
+BUCKET = "census-test"
+
+
+# stands in for a worker's server side cursor over a tile query - (x, y, tile) rows
+class TileCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.itersize = None
+
+    def execute(self, sql):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def get_settings():
+    return {"s3_bucket": BUCKET, "s3_upload_threads": 2, "s3_compression": "gzip"}
+
+
+def export_tiles(monkeypatch, rows, previous_tiles):
+    monkeypatch.setattr(utils, "get_worker_cursor", lambda settings, name=None: TileCursor(rows))
+
+    work_dict = {"key_prefix": "census/ste", "zoom": 5, "file_type": "geojson", "content_type": "application/geo+json",
+                 "previous_tiles": previous_tiles, "sql": "SELECT x, y, tile FROM tiles"}
+
+    return utils.run_tile_export_multiprocessing([work_dict, get_settings()])
+
+
+def get_tile(client, key):
+    response = client.get_object(Bucket=BUCKET, Key=key)
+    assert response["ContentEncoding"] == "gzip"
+
+    return gzip.decompress(response["Body"].read()).decode("utf-8")
+
+
+def test_new_tiles_are_uploaded_compressed(s3_client, monkeypatch):
+    rows = [(1, 2, '{"type": "FeatureCollection", "features": []}'), (1, 3, '{"type": "FeatureCollection"}')]
+
+    result = export_tiles(monkeypatch, rows, dict())
+
+    assert result["result"] == "SUCCESS"
+    assert result["rows"] == 2
+    assert sorted(result["tiles"].keys()) == ["1/2", "1/3"]
+    assert get_tile(s3_client, "census/ste/5/1/2.geojson") == rows[0][2]
+    assert get_tile(s3_client, "census/ste/5/1/3.geojson") == rows[1][2]
+
+
+def test_unchanged_tiles_are_skipped(s3_client, monkeypatch):
+    rows = [(1, 2, '{"type": "FeatureCollection", "features": []}'), (1, 3, '{"type": "FeatureCollection"}')]
+    previous_tiles = export_tiles(monkeypatch, rows, dict())["tiles"]
+
+    # remove the unchanged tile - it mustn't be uploaded again
+    s3_client.delete_object(Bucket=BUCKET, Key="census/ste/5/1/2.geojson")
+
+    changed_rows = [rows[0], (1, 3, '{"type": "FeatureCollection", "features": [1]}')]
+    result = export_tiles(monkeypatch, changed_rows, previous_tiles)
+
+    assert result["rows"] == 1
+    assert result["bytes"] == len(changed_rows[1][2])
+    assert result["tiles"]["1/2"] == previous_tiles["1/2"]
+    assert result["tiles"]["1/3"] != previous_tiles["1/3"]
+    assert get_tile(s3_client, "census/ste/5/1/3.geojson") == changed_rows[1][2]
+
+    keys = [item["Key"] for item in s3_client.list_objects_v2(Bucket=BUCKET)["Contents"]]
+    assert keys == ["census/ste/5/1/3.geojson"]
+
+
+def test_index_round_trip(s3_client):
+    index = {"format": "geojson", "zooms": {"5": {"1/2": "abc"}}}
+
+    assert s3utils.get_json_object(s3_client, BUCKET, "census/ste/index.json") is None
+
+    s3utils.put_object(s3_client, BUCKET, "census/ste/index.json", json.dumps(index).encode("utf-8"),
+                       "application/json", get_settings())
+
+    assert s3utils.get_json_object(s3_client, BUCKET, "census/ste/index.json") == index
+
+
+def list_keys(client):
+    return sorted([item["Key"] for item in client.list_objects_v2(Bucket=BUCKET).get("Contents", list())])
+
+
+# a re-export without brotli (--s3-compression gzip after both) deletes the brotli variants of the tiles it keeps
+def test_brotli_variants_are_deleted_when_brotli_is_turned_off(s3_client):
+    for key in ["index.json", "index.json.br", "5/1/2.geojson", "5/1/2.geojson.br", "5/1/3.geojson",
+                "5/1/3.geojson.br"]:
+        s3_client.put_object(Bucket=BUCKET, Key="census/ste/" + key, Body=b"{}")
+
+    previous_index = {"format": "geojson", "encodings": ["gzip", "br"], "zooms": {"5": {"1/2": "abc", "1/3": "def"}}}
+    index = {"format": "geojson", "encodings": ["gzip"], "zooms": {"5": {"1/2": "abc"}}}
+
+    num_stale = export_geojson_to_s3.delete_stale_tiles(s3_client, "census/ste", previous_index, index,
+                                                        get_settings())
+
+    assert num_stale == 1
+    assert list_keys(s3_client) == ["census/ste/5/1/2.geojson", "census/ste/index.json"]
+
+
+def test_brotli_variants_are_kept_while_brotli_is_on(s3_client):
+    for key in ["5/1/2.geojson", "5/1/2.geojson.br", "5/1/3.geojson", "5/1/3.geojson.br"]:
+        s3_client.put_object(Bucket=BUCKET, Key="census/ste/" + key, Body=b"{}")
+
+    previous_index = {"format": "geojson", "encodings": ["gzip", "br"], "zooms": {"5": {"1/2": "abc", "1/3": "def"}}}
+    index = {"format": "geojson", "encodings": ["gzip", "br"], "zooms": {"5": {"1/2": "abc"}}}
+
+    export_geojson_to_s3.delete_stale_tiles(s3_client, "census/ste", previous_index, index, get_settings())
+
+    assert list_keys(s3_client) == ["census/ste/5/1/2.geojson", "census/ste/5/1/2.geojson.br"]
+
+
+@pytest.mark.parametrize("status_code, error_code", [(403, "AccessDenied"), (404, "NoSuchKey"), (404, "404")])
+def test_missing_or_forbidden_index_is_none(status_code, error_code):
+    client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="testing",
+                          aws_secret_access_key="testing")
+
+    with Stubber(client) as stubber:
+        stubber.add_client_error("get_object", error_code, http_status_code=status_code)
+
+        assert s3utils.get_json_object(client, BUCKET, "census/ste/index.json") is None
+
+
+def test_other_errors_are_raised():
+    client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="testing",
+                          aws_secret_access_key="testing")
+
+    with Stubber(client) as stubber:
+        stubber.add_client_error("get_object", "InternalError", http_status_code=500)
+
+        with pytest.raises(ClientError):
+            s3utils.get_json_object(client, BUCKET, "census/ste/index.json")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tests streaming shp2pgsql dump format output into COPY: the data rows are passed through untouched (or with their ids
+# prefixed), the rest of the dump is run as SQL, and a failed shp2pgsql run fails the load
+
+import io
+import shlex
+
+import pytest
+
+import utils
+
+COPY_SQL = 'COPY "census_2016_bdys"."ced_2016_aust" ("ced_code16","ced_name16",geom) FROM stdin'
+
+# a shp2pgsql -D dump. COPY text format escapes tabs & newlines in values (\t, \n), so only real tabs separate values
+DUMP = b'SET CLIENT_ENCODING TO UTF8;\n' \
+       b'BEGIN;\n' \
+       b'CREATE TABLE "census_2016_bdys"."ced_2016_aust" (gid serial,\n"ced_code16" varchar(3),\n' \
+       b'"ced_name16" varchar(40));\n' \
+       b'SELECT AddGeometryColumn(\'census_2016_bdys\',\'ced_2016_aust\',\'geom\',\'4283\',\'MULTIPOLYGON\',2);\n' + \
+       COPY_SQL.encode("utf-8") + b';\n' \
+       b'101\tCanberra\\tACT\t0106000020BB10\n' \
+       b'102\tFenner\\nACT\\\\\t0106000020BB10\n' \
+       b'\\N\tNo Usual Address\t\\N\n' \
+       b'\\.\n' \
+       b'CREATE INDEX ON "census_2016_bdys"."ced_2016_aust" USING GIST ("geom");\n' \
+       b'COMMIT;\n'
+
+DATA_ROWS = [b'101\tCanberra\\tACT\t0106000020BB10\n',
+             b'102\tFenner\\nACT\\\\\t0106000020BB10\n',
+             b'\\N\tNo Usual Address\t\\N\n']
+
+
+# records the SQL run & the data copied
+class CopyCursor(object):
+    def __init__(self):
+        self.sql_list = list()
+        self.copy_sql = None
+        self.copy_data = None
+
+    def execute(self, sql):
+        self.sql_list.append(sql)
+
+    def copy_expert(self, sql, copy_file, size=8192):
+        self.copy_sql = sql
+        self.copy_data = read_all(copy_file, size)
+
+
+def read_all(stream, size):
+    data_list = list()
+
+    while True:
+        data = stream.read(size)
+
+        if len(data) == 0:
+            return b"".join(data_list)
+
+        data_list.append(data)
+
+
+def get_dump_file():
+    dump_file = io.BytesIO(DUMP)
+
+    # skip to the data rows, as copy_shapefile_dump_to_postgres does
+    while not dump_file.readline().startswith(b"COPY "):
+        pass
+
+    return dump_file
+
+
+@pytest.mark.parametrize("read_size", [1, 5, 64, 8192, -1])
+def test_data_rows_are_read_up_to_the_end_of_data_marker(read_size):
+    dump_file = get_dump_file()
+
+    assert read_all(utils.CopyDataStream(dump_file), read_size) == b"".join(DATA_ROWS)
+
+    # the rest of the dump is left unread
+    assert dump_file.read().startswith(b"CREATE INDEX ")
+
+
+def test_readline_returns_each_data_row():
+    stream = utils.CopyDataStream(get_dump_file())
+
+    assert [stream.readline() for i in range(0, 4)] == DATA_ROWS + [b""]
+
+
+def test_id_prefix_is_added_to_the_id_field_only():
+    add_prefix = utils.get_id_prefix_transform(COPY_SQL, ("ced_code16", "CED"))
+
+    assert [add_prefix(row) for row in DATA_ROWS] == [b'CED101\tCanberra\\tACT\t0106000020BB10\n',
+                                                     b'CED102\tFenner\\nACT\\\\\t0106000020BB10\n',
+                                                     b'\\N\tNo Usual Address\t\\N\n']
+
+
+# escaped tabs before the id field mustn't move it
+def test_id_prefix_is_added_after_escaped_tabs():
+    add_prefix = utils.get_id_prefix_transform(COPY_SQL, ("ced_name16", "X"))
+
+    assert [add_prefix(row) for row in DATA_ROWS] == [b'101\tXCanberra\\tACT\t0106000020BB10\n',
+                                                     b'102\tXFenner\\nACT\\\\\t0106000020BB10\n',
+                                                     b'\\N\tXNo Usual Address\t\\N\n']
+
+
+def test_id_prefix_transform_is_applied_as_rows_are_read():
+    stream = utils.CopyDataStream(get_dump_file(), utils.get_id_prefix_transform(COPY_SQL, ("ced_code16", "CED")))
+
+    assert read_all(stream, 7).startswith(b'CED101\tCanberra\\tACT\t')
+
+
+# shp2pgsql is stood in for by a shell command that writes the dump (and fails, if an exit code is given)
+def get_dump_command(tmp_path, exit_code=0):
+    dump_path = tmp_path / "dump.sql"
+    dump_path.write_bytes(DUMP)
+
+    return "cat {0}; echo 'Shapefile type: Polygon' >&2; exit {1}".format(shlex.quote(str(dump_path)), exit_code)
+
+
+def test_dump_is_copied_into_postgres(tmp_path):
+    pg_cur = CopyCursor()
+
+    result = utils.copy_shapefile_dump_to_postgres(pg_cur, get_dump_command(tmp_path), "ced_2016_aust.shp", True,
+                                                   True, False, ("ced_code16", "CED"))
+
+    assert result == "SUCCESS"
+    assert pg_cur.copy_sql == COPY_SQL
+    assert pg_cur.copy_data.startswith(b'CED101\tCanberra\\tACT\t')
+
+    # the id field is created as text, to hold the prefix
+    assert '"ced_code16" text' in pg_cur.sql_list[0]
+    assert pg_cur.sql_list[-1].startswith('CREATE INDEX ON "census_2016_bdys"."ced_2016_aust"')
+    assert "COMMIT;" in pg_cur.sql_list[-1]
+
+
+# the end of the dump (with its COMMIT) isn't run if shp2pgsql failed
+def test_failed_shp2pgsql_fails_the_load(tmp_path):
+    pg_cur = CopyCursor()
+
+    result = utils.copy_shapefile_dump_to_postgres(pg_cur, get_dump_command(tmp_path, 1), "ced_2016_aust.shp", True,
+                                                   True, False)
+
+    assert result != "SUCCESS"
+    assert "exit code 1" in result
+    assert "Shapefile type: Polygon" in result
+    assert pg_cur.sql_list[-1] == "ROLLBACK"
+    assert not any(["COMMIT;" in sql for sql in pg_cur.sql_list])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tests splitting a query into shards: the shard filters cover every key exactly once, with the first and last
+# shards open ended
+
+import logging
+
+import pytest
+
+import utils
+
+SQL = "INSERT INTO census_bdys.sa1_display SELECT * FROM census_bdys.sa1 AS bdy WHERE {shard_filter}"
+
+
+# stands in for a cursor over the table to split. key_type & histogram are what pg_attribute & pg_stats return
+# (None if the table doesn't exist or hasn't been analysed), shard_keys the lowest key of each shard found by counting
+class ShardCursor(object):
+    def __init__(self, shard_keys, key_type="integer", histogram=None):
+        self.shard_keys = shard_keys
+        self.key_type = key_type
+        self.histogram = histogram
+        self.sql_list = list()
+
+    def execute(self, sql):
+        self.sql_list.append(sql)
+
+    def fetchone(self):
+        if "FROM pg_attribute" in self.sql_list[-1]:
+            return None if self.key_type is None else (self.key_type,)
+        elif "FROM pg_stats" in self.sql_list[-1]:
+            return None if self.histogram is None else (self.histogram,)
+
+    def fetchall(self):
+        return [(key,) for key in self.shard_keys]
+
+    def mogrify(self, sql, params):
+        value = params[0]
+
+        if isinstance(value, str):
+            value = "'{0}'".format(value)
+
+        return sql.replace("%s", str(value)).encode("utf-8")
+
+
+def get_shard_filters(pg_cur, shards, geom_field=None):
+    sql_list = utils.split_sql_into_list(pg_cur, SQL, "census_bdys", "sa1", "bdy", "gid", {}, logging.getLogger(),
+                                         shards, geom_field)
+
+    return [sql.replace(SQL.replace("{shard_filter}", ""), "") for sql in sql_list]
+
+
+# returns the shards (as indexes) a key falls in
+def get_key_shards(shard_filters, key):
+    key_shards = list()
+
+    for i, shard_filter in enumerate(shard_filters):
+        if key is None:
+            matched = shard_filter == "TRUE" or "bdy.gid IS NULL" in shard_filter
+        else:
+            expression = shard_filter.replace(" OR bdy.gid IS NULL", "").replace("bdy.gid", "key") \
+                .replace(" AND ", " and ").replace("TRUE", "True")
+            matched = eval(expression, {"key": key})
+
+        if matched:
+            key_shards.append(i)
+
+    return key_shards
+
+
+def test_first_and_last_shards_are_open_ended():
+    shard_filters = get_shard_filters(ShardCursor([1, 30, 60, 90]), 4)
+
+    assert shard_filters == ["(bdy.gid < 30 OR bdy.gid IS NULL)",
+                             "bdy.gid >= 30 AND bdy.gid < 60",
+                             "bdy.gid >= 60 AND bdy.gid < 90",
+                             "bdy.gid >= 90"]
+
+
+# keys outside the range seen when splitting (e.g. added since) still land in a shard
+@pytest.mark.parametrize("key", [None, -1000, 0, 1, 29, 30, 59, 60, 89, 90, 1000])
+def test_every_key_is_in_one_shard(key):
+    shard_filters = get_shard_filters(ShardCursor([1, 30, 60, 90]), 4)
+
+    assert len(get_key_shards(shard_filters, key)) == 1
+
+
+def test_single_shard_covers_everything():
+    pg_cur = ShardCursor([1, 30, 60, 90])
+
+    assert get_shard_filters(pg_cur, 1) == ["TRUE"]
+
+    # no need to look at the table
+    assert pg_cur.sql_list == []
+
+
+def test_fewer_keys_than_shards():
+    pg_cur = ShardCursor([1, 2])
+
+    shard_filters = get_shard_filters(pg_cur, 4)
+
+    assert shard_filters == ["(bdy.gid < 2 OR bdy.gid IS NULL)", "bdy.gid >= 2"]
+
+    for key in [None, 0, 1, 2, 3]:
+        assert len(get_key_shards(shard_filters, key)) == 1
+
+
+def test_one_key_is_one_shard():
+    assert get_shard_filters(ShardCursor([1]), 4) == ["TRUE"]
+
+
+def test_empty_table_is_one_shard():
+    assert get_shard_filters(ShardCursor([]), 4) == ["TRUE"]
+
+
+# an analysed table is split on its histogram, without reading the table
+def test_histogram_bounds_are_used():
+    pg_cur = ShardCursor([1, 2], histogram=[0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100])
+
+    shard_filters = get_shard_filters(pg_cur, 4)
+
+    assert shard_filters == ["(bdy.gid < 20 OR bdy.gid IS NULL)",
+                             "bdy.gid >= 20 AND bdy.gid < 50",
+                             "bdy.gid >= 50 AND bdy.gid < 80",
+                             "bdy.gid >= 80"]
+    assert "histogram_bounds::text::integer[]" in pg_cur.sql_list[-1]
+
+
+# a histogram with fewer buckets than shards, or repeated bounds, doesn't give empty shards
+def test_small_histogram_is_not_used():
+    pg_cur = ShardCursor([1, 30, 60, 90], histogram=[0, 50, 100])
+
+    assert len(get_shard_filters(pg_cur, 4)) == 4
+    assert "FROM pg_stats" not in pg_cur.sql_list[-1]
+
+
+def test_repeated_histogram_bounds_are_dropped():
+    pg_cur = ShardCursor([], histogram=[0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2])
+
+    assert get_shard_filters(pg_cur, 4) == ["(bdy.gid < 1 OR bdy.gid IS NULL)", "bdy.gid >= 1"]
+
+
+# geometry weighted shards are always counted - the histogram only counts rows
+def test_geometry_weighted_shards_skip_the_histogram():
+    pg_cur = ShardCursor([1, 30], histogram=[0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100])
+
+    assert get_shard_filters(pg_cur, 4, "geom") == ["(bdy.gid < 30 OR bdy.gid IS NULL)", "bdy.gid >= 30"]
+    assert len(pg_cur.sql_list) == 1
+    assert "SUM(ST_NPoints(geom))" in pg_cur.sql_list[0]
+
+
+def test_text_keys_are_quoted():
+    shard_filters = get_shard_filters(ShardCursor(["10101", "10201"], "text"), 2)
+
+    assert shard_filters == ["(bdy.gid < '10201' OR bdy.gid IS NULL)", "bdy.gid >= '10201'"]
+
+
+def test_sql_without_a_placeholder_is_rejected():
+    with pytest.raises(ValueError):
+        utils.split_sql_into_list(ShardCursor([1]), "SELECT 1", "census_bdys", "sa1", "bdy", "gid", {},
+                                  logging.getLogger(), 4)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# tests converting GeoJSON to TopoJSON: an edge shared by two boundaries is stored once and the arcs decode back to
+# the input rings
+
+import pytest
+
+import topojson
+
+DECIMAL_PLACES = 2
+
+# two squares sharing their 149.1 edge, both wound anticlockwise - so the shared edge runs in opposite directions
+LEFT_RING = [[149.0, -35.1], [149.1, -35.1], [149.1, -35.0], [149.0, -35.0], [149.0, -35.1]]
+RIGHT_RING = [[149.1, -35.1], [149.2, -35.1], [149.2, -35.0], [149.1, -35.0], [149.1, -35.1]]
+
+FEATURE_COLLECTION = {"type": "FeatureCollection",
+                      "features": [{"type": "Feature", "id": "left", "properties": {"name": "Left"},
+                                    "geometry": {"type": "Polygon", "coordinates": [LEFT_RING]}},
+                                   {"type": "Feature", "id": "right", "properties": {"name": "Right"},
+                                    "geometry": {"type": "MultiPolygon", "coordinates": [[RIGHT_RING]]}}]}
+
+
+@pytest.fixture
+def topology():
+    return topojson.get_topology(FEATURE_COLLECTION, "squares", DECIMAL_PLACES)
+
+
+# undoes the delta encoding & quantisation of an arc
+def decode_arc(topology, encoded_arc):
+    scale = topology["transform"]["scale"]
+    translate = topology["transform"]["translate"]
+
+    x = 0
+    y = 0
+    points = list()
+
+    for delta in encoded_arc:
+        x += delta[0]
+        y += delta[1]
+        points.append([round(x * scale[0] + translate[0], DECIMAL_PLACES),
+                       round(y * scale[1] + translate[1], DECIMAL_PLACES)])
+
+    return points
+
+
+# joins a ring's arcs back together - each arc starts where the last one ended
+def decode_ring(topology, ring_arcs):
+    ring = list()
+
+    for index in ring_arcs:
+        if index < 0:
+            points = list(reversed(decode_arc(topology, topology["arcs"][~index])))
+        else:
+            points = decode_arc(topology, topology["arcs"][index])
+
+        if len(ring) > 0:
+            assert points[0] == ring[-1]
+            points = points[1:]
+
+        ring.extend(points)
+
+    return ring
+
+
+# rings can start at any point - rotate a closed ring to start at its lowest point to compare it
+def normalise_ring(ring):
+    open_ring = ring[:-1]
+    start = open_ring.index(min(open_ring))
+
+    return open_ring[start:] + open_ring[:start + 1]
+
+
+def get_shared_arcs(geometries):
+    arc_sets = list()
+
+    for geometry in geometries:
+        arc_sets.append(set([index if index >= 0 else ~index
+                             for polygon in geometry["arcs"] for ring_arcs in polygon for index in ring_arcs]))
+
+    return arc_sets[0] & arc_sets[1]
+
+
+def test_shared_edge_is_one_arc(topology):
+    geometries = topology["objects"]["squares"]["geometries"]
+
+    shared_arcs = get_shared_arcs(geometries)
+    assert len(shared_arcs) == 1
+
+    shared_index = shared_arcs.pop()
+    assert decode_arc(topology, topology["arcs"][shared_index]) in ([[149.1, -35.1], [149.1, -35.0]],
+                                                                    [[149.1, -35.0], [149.1, -35.1]])
+
+    # one square uses the shared arc as stored, the other in reverse
+    ring_arcs_list = [geometry["arcs"][0][0] for geometry in geometries]
+    assert sorted([shared_index in ring_arcs for ring_arcs in ring_arcs_list]) == [False, True]
+    assert sorted([~shared_index in ring_arcs for ring_arcs in ring_arcs_list]) == [False, True]
+
+    # the shared edge + the rest of each square
+    assert len(topology["arcs"]) == 3
+
+
+def test_arcs_decode_to_the_input_rings(topology):
+    geometries = topology["objects"]["squares"]["geometries"]
+
+    for geometry, input_ring in zip(geometries, [LEFT_RING, RIGHT_RING]):
+        assert len(geometry["arcs"]) == 1
+        assert len(geometry["arcs"][0]) == 1
+
+        ring = decode_ring(topology, geometry["arcs"][0][0])
+
+        assert ring[0] == ring[-1]
+        assert normalise_ring(ring) == normalise_ring(input_ring)
+
+
+def test_ids_properties_and_bbox_are_kept(topology):
+    geometries = topology["objects"]["squares"]["geometries"]
+
+    assert [geometry["type"] for geometry in geometries] == ["MultiPolygon", "MultiPolygon"]
+    assert [geometry["id"] for geometry in geometries] == ["left", "right"]
+    assert [geometry["properties"] for geometry in geometries] == [{"name": "Left"}, {"name": "Right"}]
+    assert topology["bbox"] == [149.0, -35.1, 149.2, -35.0]
+
+
+# an unshared ring is a single arc, however it's wound
+def test_unshared_ring_is_one_arc():
+    feature = {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [LEFT_RING]}}
+    feature_collection = {"type": "FeatureCollection", "features": [feature]}
+
+    topology = topojson.get_topology(feature_collection, "square", DECIMAL_PLACES)
+    geometry = topology["objects"]["square"]["geometries"][0]
+
+    assert geometry["arcs"] == [[[0]]]
+    assert normalise_ring(decode_ring(topology, [0])) == normalise_ring(LEFT_RING)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# converts GeoJSON FeatureCollections of (multi)polygons into TopoJSON topologies. Edges shared by neighbouring
+# boundaries are stored once, as arcs, and coordinates are quantised to integers and delta encoded.
+# See https://github.com/topojson/topojson-specification
+
+import math
+
+
+def get_topology(feature_collection, object_name, decimal_places):
+    # quantise coordinates to the precision they already have - the topology loses no detail
+    scale = math.pow(10.0, -decimal_places)
+
+    features = feature_collection["features"]
+    bbox = get_bbox(features)
+
+    if bbox is not None:
+        translate = [round(bbox[0], decimal_places), round(bbox[1], decimal_places)]
+    else:
+        translate = [0.0, 0.0]
+
+    # get the quantised rings of every polygon
+    feature_polygons = list()
+
+    for feature in features:
+        polygons = list()
+
+        for polygon in get_polygons(feature.get("geometry")):
+            rings = list()
+
+            for ring in polygon:
+                quantised_ring = quantise_ring(ring, translate, scale)
+
+                if quantised_ring is not None:
+                    rings.append(quantised_ring)
+                elif len(rings) == 0:
+                    break  # the exterior ring has collapsed - drop the polygon
+
+            if len(rings) > 0:
+                polygons.append(rings)
+
+        feature_polygons.append(polygons)
+
+    # junctions are where 3 or more edges meet - i.e. where a shared edge starts or ends
+    junctions = get_junctions([ring for polygons in feature_polygons for polygon in polygons for ring in polygon])
+
+    # cut the rings into arcs at the junctions, storing each arc once
+    arcs = list()
+    arc_index = dict()
+    geometries = list()
+
+    for feature, polygons in zip(features, feature_polygons):
+        if len(polygons) > 0:
+            geometry = {"type": "MultiPolygon",
+                        "arcs": [[get_ring_arcs(ring, junctions, arcs, arc_index) for ring in polygon]
+                                 for polygon in polygons]}
+        else:
+            geometry = {"type": None}
+
+        if "id" in feature:
+            geometry["id"] = feature["id"]
+
+        if feature.get("properties") is not None:
+            geometry["properties"] = feature["properties"]
+
+        geometries.append(geometry)
+
+    topology = dict()
+    topology["type"] = "Topology"
+    topology["transform"] = {"scale": [scale, scale], "translate": translate}
+    topology["objects"] = {object_name: {"type": "GeometryCollection", "geometries": geometries}}
+    topology["arcs"] = [delta_encode(arc) for arc in arcs]
+
+    if bbox is not None:
+        topology["bbox"] = bbox
+
+    return topology
+
+
+# returns the polygons of a Polygon or MultiPolygon as lists of rings. other geometry types are ignored
+def get_polygons(geometry):
+    if geometry is None:
+        return []
+    elif geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    else:
+        return []
+
+
+def get_bbox(features):
+    bbox = None
+
+    for feature in features:
+        for polygon in get_polygons(feature.get("geometry")):
+            for ring in polygon:
+                for point in ring:
+                    if bbox is None:
+                        bbox = [point[0], point[1], point[0], point[1]]
+                    else:
+                        bbox = [min(bbox[0], point[0]), min(bbox[1], point[1]),
+                                max(bbox[2], point[0]), max(bbox[3], point[1])]
+
+    return bbox
+
+
+# converts a ring to integer coordinates, dropping repeated points. returns None if the ring collapses
+def quantise_ring(ring, translate, scale):
+    quantised_ring = list()
+
+    for point in ring:
+        quantised_point = (int(round((point[0] - translate[0]) / scale)),
+                           int(round((point[1] - translate[1]) / scale)))
+
+        if len(quantised_ring) == 0 or quantised_point != quantised_ring[-1]:
+            quantised_ring.append(quantised_point)
+
+    if len(quantised_ring) > 0 and quantised_ring[0] != quantised_ring[-1]:
+        quantised_ring.append(quantised_ring[0])
+
+    # a ring needs at least 3 distinct points (plus the closing point)
+    if len(quantised_ring) < 4:
+        return None
+
+    return quantised_ring
+
+
+# returns the points that connect to 3 or more other points, across all rings
+def get_junctions(rings):
+    neighbour_dict = dict()
+
+    for ring in rings:
+        for i in range(0, len(ring) - 1):
+            neighbour_dict.setdefault(ring[i], set()).add(ring[i + 1])
+            neighbour_dict.setdefault(ring[i + 1], set()).add(ring[i])
+
+    return set([point for point, neighbours in neighbour_dict.items() if len(neighbours) > 2])
+
+
+# cuts a closed ring into arcs at its junctions and returns their indexes (~index for an arc used in reverse)
+def get_ring_arcs(ring, junctions, arcs, arc_index):
+    open_ring = ring[:-1]
+    junction_positions = [i for i, point in enumerate(open_ring) if point in junctions]
+
+    if len(junction_positions) == 0:
+        # a ring with no junctions is one arc - start it at its lowest point so a ring shared in full
+        # (e.g. an island boundary that's also a hole) matches in either direction
+        start = open_ring.index(min(open_ring))
+        return [add_arc(open_ring[start:] + open_ring[:start + 1], arcs, arc_index)]
+
+    # start the ring at its first junction, then cut it at each junction
+    start = junction_positions[0]
+    rotated_ring = open_ring[start:] + open_ring[:start + 1]
+    cut_positions = [position - start for position in junction_positions] + [len(open_ring)]
+
+    ring_arcs = list()
+
+    for i in range(0, len(cut_positions) - 1):
+        ring_arcs.append(add_arc(rotated_ring[cut_positions[i]:cut_positions[i + 1] + 1], arcs, arc_index))
+
+    return ring_arcs
+
+
+# returns the index of an arc, adding it if it's new
+def add_arc(points, arcs, arc_index):
+    key = tuple(points)
+
+    if key in arc_index:
+        return arc_index[key]
+
+    reversed_key = tuple(reversed(points))
+
+    if reversed_key in arc_index:
+        return ~arc_index[reversed_key]
+
+    arcs.append(points)
+    arc_index[key] = len(arcs) - 1
+
+    return arc_index[key]
+
+
+# first point as is, the rest as the difference from the previous point
+def delta_encode(arc):
+    encoded_arc = [list(arc[0])]
+
+    for i in range(1, len(arc)):
+        encoded_arc.append([arc[i][0] - arc[i - 1][0], arc[i][1] - arc[i - 1][1]])
+
+    return encoded_arc
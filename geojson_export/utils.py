@@ -1,147 +1,830 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import checkpoint
+import csv
 import io
+import json
+import metrics
 import multiprocessing
+import multiprocessing.util
 import math
 import os
+import pandas
 import platform
 import psycopg2
+import psycopg2.extensions
+import queue
+import re
+import s3utils
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import topojson
 
+from datetime import datetime, timedelta
 
-# calculates the area tolerance (in m2) for vector simplification using the Visvalingam-Whyatt algorithm
-def get_tolerance(zoom_level):
+# pyarrow is optional - parsed metadata sheets are only cached (as Parquet) if it's installed.
+# it's required to export the census stats to Parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
-    # pixels squared factor
-    tolerance_square_pixels = 7
 
-    # default Google/Bing map tile scales
-    metres_per_pixel = 156543.03390625 / math.pow(2.0, float(zoom_level + 1))
+# map zoom levels the zoom level table covers (see get_zoom_levels)
+MIN_ZOOM_LEVEL = 0
+MAX_ZOOM_LEVEL = 22
 
-    # the tolerance (metres) for vector simplification using the VW algorithm
-    square_metres_per_pixel = math.pow(metres_per_pixel, 2.0)
+# metres per pixel at zoom level 0 for the default Google/Bing 256 pixel map tiles
+ZOOM_0_METRES_PER_PIXEL = 156543.03390625
 
-    # tolerance to use
-    tolerance = square_metres_per_pixel * tolerance_square_pixels
+# rough metres to degrees conversion, using spherical WGS84 datum radius for simplicity and speed
+METRES_TO_DEGREES = (2.0 * math.pi * 6378137.0) / 360.0
 
-    return tolerance
+# where a shard's filter goes in a query split by split_sql_into_list
+SHARD_FILTER_PLACEHOLDER = "{shard_filter}"
 
 
-# maximum number of decimal places for boundary coordinates - improves display performance
-def get_decimal_places(zoom_level):
+# returns the simplification & display parameters of every map zoom level, by zoom level. they're calculated once
+# per run (from the tile size, retina scale & tolerance settings) and kept in the settings, so every query & export
+# uses exactly the same values. also stored in the web schema (see create_zoom_level_table) for clients to use
+def get_zoom_levels(settings):
+    if settings.get('zoom_levels') is None:
+        zoom_levels = dict()
 
-    # rough metres to degrees conversation, using spherical WGS84 datum radius for simplicity and speed
-    metres2degrees = (2.0 * math.pi * 6378137.0) / 360.0
+        # pixels are smaller on bigger tiles & high resolution (retina) screens
+        pixel_scale = 256.0 / (settings['tile_size'] * settings['retina_scale'])
 
-    # default Google/Bing map tile scales
-    metres_per_pixel = 156543.03390625 / math.pow(2.0, float(zoom_level))
+        for zoom_level in range(MIN_ZOOM_LEVEL, MAX_ZOOM_LEVEL + 1):
+            metres_per_pixel = ZOOM_0_METRES_PER_PIXEL * pixel_scale / math.pow(2.0, float(zoom_level))
 
-    # the tolerance for thinning data and limiting decimal places in GeoJSON responses
-    degrees_per_pixel = metres_per_pixel / metres2degrees
+            # the area tolerance (in m2) for vector simplification using the Visvalingam-Whyatt algorithm.
+            # based on the pixels of the next zoom level, so shapes still look right when overzoomed
+            tolerance = math.pow(metres_per_pixel / 2.0, 2.0) * settings['tolerance_square_pixels']
 
-    scale_string = "{:10.9f}".format(degrees_per_pixel).split(".")[1]
-    places = 1
+            # maximum number of decimal places for boundary coordinates - one more than the number of zero decimal
+            # places in the size of a pixel in degrees. e.g. 0.00001234 = 4 zeros = 5 decimal places
+            degrees_per_pixel = max(round(metres_per_pixel / METRES_TO_DEGREES, 9), 0.000000001)
+
+            if degrees_per_pixel < 0.1:
+                decimal_places = -int(math.floor(math.log10(degrees_per_pixel)))
+            else:
+                decimal_places = 1
+
+            zoom_levels[zoom_level] = {"zoom": zoom_level, "tile_size": settings['tile_size'],
+                                       "retina_scale": settings['retina_scale'], "metres_per_pixel": metres_per_pixel,
+                                       "tolerance": tolerance, "decimal_places": decimal_places}
+
+        settings['zoom_levels'] = zoom_levels
+
+    return settings['zoom_levels']
+
+
+def get_zoom_level(zoom_level, settings):
+    return get_zoom_levels(settings)[zoom_level]
+
+
+# stores the zoom level table in the web schema. returns True if the zoom levels have changed since the last load
+# (i.e. the web optimised boundaries need to be rebuilt)
+def create_zoom_level_table(pg_cur, settings):
+    table_name = "{0}.zoom_levels".format(settings['web_schema'])
+
+    zoom_levels = get_zoom_levels(settings)
+    rows = [(zoom_level["zoom"], zoom_level["tile_size"], zoom_level["retina_scale"], zoom_level["metres_per_pixel"],
+             zoom_level["tolerance"], zoom_level["decimal_places"]) for zoom_level in
+            [zoom_levels[zoom] for zoom in sorted(zoom_levels)]]
+
+    pg_cur.execute("SELECT to_regclass('{0}')".format(table_name))
+
+    if pg_cur.fetchone()[0] is not None:
+        pg_cur.execute("SELECT zoom, tile_size, retina_scale, metres_per_pixel, tolerance, decimal_places "
+                       "FROM {0} ORDER BY zoom".format(table_name))
+
+        # compare the floats to fewer digits than Postgres returns (15 by default before Postgres 12)
+        def round_row(row):
+            return [round(value, 6) if isinstance(value, float) else value for value in row]
+
+        if [round_row(row) for row in pg_cur.fetchall()] == [round_row(row) for row in rows]:
+            return False
+
+    pg_cur.execute("DROP TABLE IF EXISTS {0};"
+                   "CREATE TABLE {0} (zoom smallint NOT NULL PRIMARY KEY, tile_size integer NOT NULL, "
+                   "retina_scale double precision NOT NULL, metres_per_pixel double precision NOT NULL, "
+                   "tolerance double precision NOT NULL, decimal_places smallint NOT NULL) WITH (OIDS=FALSE);"
+                   "ALTER TABLE {0} OWNER TO {1}".format(table_name, settings['pg_user']))
+
+    pg_cur.copy_expert("COPY {0} FROM stdin WITH CSV".format(table_name), RowCsvStream(rows), size=COPY_BUFFER_SIZE)
+
+    return True
+
+
+# size of the chunks read from source files and sent to Postgres during a COPY
+COPY_BUFFER_SIZE = 65536
+
+# how often to log the progress of a multiprocessing step
+PROGRESS_REPORT_SECONDS = 30
+
+# number of rows read from Postgres & written to a Parquet file at a time
+PARQUET_BATCH_ROWS = 50000
+
+# maximum number of processes when it's set from the Postgres server's cores
+MAX_AUTO_PROCESSES = 16
+
+# how often the number of jobs run at once is adjusted (see get_adaptive_results)
+ADAPTIVE_INTERVAL_SECONDS = 5
+
+# the minimum number of jobs that must finish in an interval before its throughput is compared with the smoothed
+# throughput of the previous intervals, and the weight given to the latest interval when smoothing it
+ADAPTIVE_MIN_RESULTS = 2
+ADAPTIVE_SMOOTHING = 0.3
+
+# how often steps waiting on jobs check whether the run has been aborted (see abort_event)
+ABORT_CHECK_SECONDS = 1
+
+# identifies the pool workers' connections in pg_stat_activity
+WORKER_APPLICATION_NAME = "census-loader worker"
 
-    trigger = "0"
 
-    # find how many zero decimal places there are. e.g. 0.00001234 = 4 zeros
-    for c in scale_string:
-        if c == trigger:
-            places += 1
+# read-only file-like wrapper that cleans census CSV files in fixed size chunks as COPY consumes them.
+# strips spaces, rogue non-ascii characters (\x1A) and leading/trailing whitespace without reading the whole file
+class CleanCsvStream(object):
+
+    def __init__(self, raw_file, chunk_size=COPY_BUFFER_SIZE):
+        self.raw_file = raw_file
+        self.chunk_size = chunk_size
+        self.started = False  # True once the leading whitespace has been skipped
+        self.pending_whitespace = ""  # trailing whitespace held back until we know it's not the end of the file
+        self.buffer = ""
+
+    # clean the next raw chunk. returns None at the end of the file
+    def _next_chunk(self):
+        while True:
+            raw = self.raw_file.read(self.chunk_size)
+
+            if raw == "":
+                return None
+
+            chunk = raw.replace(" ", "").replace("\x1A", "")
+
+            if not self.started:
+                chunk = chunk.lstrip()
+
+                if chunk == "":
+                    continue
+
+                self.started = True
+
+            # hold back any trailing whitespace - it's only kept if more data follows it
+            body = chunk.rstrip()
+
+            if body == "":
+                self.pending_whitespace += chunk
+                continue
+
+            data = self.pending_whitespace + body
+            self.pending_whitespace = chunk[len(body):]
+
+            return data
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buffer) < size:
+            chunk = self._next_chunk()
+
+            if chunk is None:
+                break
+
+            self.buffer += chunk
+
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, ""
         else:
-            trigger = "don't do anything else"  # used to cleanly exit the loop
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
 
-    return places
+        return data
 
+    def readline(self, size=-1):
+        while "\n" not in self.buffer:
+            chunk = self._next_chunk()
 
-# takes a list of sql queries or command lines and runs them using multiprocessing
-def multiprocess_csv_import(work_list, settings, logger):
-    pool = multiprocessing.Pool(processes=settings['max_concurrent_processes'])
+            if chunk is None:
+                break
+
+            self.buffer += chunk
+
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+
+        if size is not None and 0 <= size < end:
+            end = size
+
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+
+        return data
+
+
+# read-only file-like wrapper that writes rows (lists of values) as CSV as COPY consumes them.
+# None and NaN values are written as empty strings (i.e. NULLs when copied with NULL as '')
+class RowCsvStream(object):
+
+    def __init__(self, rows, chunk_rows=1000):
+        self.rows = iter(rows)
+        self.chunk_rows = chunk_rows
+        self.buffer = ""
+
+    # write the next batch of rows. returns None when there are no rows left
+    def _next_chunk(self):
+        chunk_file = io.StringIO()
+        writer = csv.writer(chunk_file, lineterminator="\n")
+
+        for i, row in enumerate(self.rows):
+            writer.writerow(["" if value is None or value != value else value for value in row])
+
+            if i + 1 >= self.chunk_rows:
+                break
+
+        return chunk_file.getvalue() or None
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self.buffer) < size:
+            chunk = self._next_chunk()
+
+            if chunk is None:
+                break
+
+            self.buffer += chunk
+
+        if size is None or size < 0:
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+
+        return data
+
+    def readline(self, size=-1):
+        while "\n" not in self.buffer:
+            chunk = self._next_chunk()
+
+            if chunk is None:
+                break
+
+            self.buffer += chunk
+
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+
+        if size is not None and 0 <= size < end:
+            end = size
+
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+
+        return data
+
+
+# long lived pool of worker processes, shared by every multiprocessing step in a run (see start_pool)
+worker_pool = None
+
+# each pool worker's own Postgres connection, opened once by init_worker and reused for every job it runs
+worker_pg_conn = None
+
+# time the worker's current job has spent waiting on Postgres (see TimedCursor)
+worker_db_seconds = 0.0
+
+# main process connection for monitoring the Postgres server's load while jobs run (see get_server_activity). shared by
+# the steps running at the same time (see scheduler.py), one query at a time
+monitor_pg_conn = None
+monitor_lock = threading.Lock()
+
+# the number of jobs run at once at the end of the last step of each job type - the next step starts from there
+adaptive_window_dict = dict()
+
+# set when a job fails and the run is aborted (see --abort-on-failure). every step waiting on jobs in the pool stops
+# waiting (they check it at least every ABORT_CHECK_SECONDS), and no more jobs are run
+abort_event = threading.Event()
+
+# the number of steps waiting on jobs in the pool - when aborting, the pool is terminated once none are left
+pool_users = 0
+pool_users_lock = threading.Lock()
+
+
+# worker cursor that adds the time spent in each call to Postgres to the current job's database time
+class TimedCursor(psycopg2.extensions.cursor):
+    def _timed(self, function, *args, **kwargs):
+        global worker_db_seconds
+
+        start_time = time.time()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            worker_db_seconds += time.time() - start_time
+
+    def execute(self, *args, **kwargs):
+        return self._timed(super(TimedCursor, self).execute, *args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        return self._timed(super(TimedCursor, self).copy_expert, *args, **kwargs)
+
+    def fetchone(self):
+        return self._timed(super(TimedCursor, self).fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(super(TimedCursor, self).fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._timed(super(TimedCursor, self).fetchall)
+
+    # server side cursors fetch more rows from Postgres as they're iterated
+    def __next__(self):
+        return self._timed(super(TimedCursor, self).__next__)
+
+
+# creates the shared worker pool. call this before opening any Postgres connections in the main process
+def start_pool(settings):
+    global worker_pool
+
+    worker_pool = multiprocessing.Pool(processes=settings['max_concurrent_processes'],
+                                       initializer=init_worker, initargs=(settings,))
+
+    return worker_pool
+
+
+# waits for outstanding jobs and shuts down the shared worker pool
+def stop_pool():
+    global worker_pool
+
+    if worker_pool is not None:
+        worker_pool.close()
+        worker_pool.join()
+        worker_pool = None
+
+    close_monitor_connection()
+
+
+# kills the shared worker pool immediately, abandoning any running or queued jobs
+def terminate_pool():
+    global worker_pool
+
+    if worker_pool is not None:
+        worker_pool.terminate()
+        worker_pool.join()
+        worker_pool = None
+
+    close_monitor_connection()
+
+
+# returns the shared worker pool, creating it if required
+def get_pool(settings):
+    if worker_pool is None:
+        start_pool(settings)
+
+    return worker_pool
+
+
+# pool initializer - connects the worker process to Postgres (and starts profiling it, if requested)
+def init_worker(settings):
+    if settings.get('profile_directory') is not None:
+        metrics.start_worker_profile(settings)
+
+    try:
+        connect_worker(settings)
+    except psycopg2.Error:
+        pass  # the first job run by this worker will retry the connection and report the error
+
+
+# opens the worker's Postgres connection (it's closed when the worker process exits)
+def connect_worker(settings):
+    global worker_pg_conn
+
+    worker_pg_conn = psycopg2.connect(settings['pg_connect_string'], application_name=WORKER_APPLICATION_NAME)
+    worker_pg_conn.autocommit = True
+
+    multiprocessing.util.Finalize(None, worker_pg_conn.close, exitpriority=10)
+
+
+# returns a cursor on the worker's persistent connection, reconnecting if the connection has been lost.
+# give the cursor a name to create a server side cursor (for streaming big query results)
+def get_worker_cursor(settings, name=None):
+    if worker_pg_conn is None or worker_pg_conn.closed:
+        connect_worker(settings)
+
+    if name is not None:
+        # WITH HOLD is required in autocommit mode
+        return worker_pg_conn.cursor(name, withhold=True, cursor_factory=TimedCursor)
+    else:
+        return worker_pg_conn.cursor(cursor_factory=TimedCursor)
+
+
+# runs a function over a list of work items in the shared worker pool, reporting results as each job finishes.
+# on_success is called (in the main process) with the work item and result dict of each job that succeeds.
+# returns False if a job failed and the run was aborted (see --abort-on-failure)
+def multiprocess_jobs(job_function, work_list, job_type, settings, logger, on_success=None):
+    global pool_users
+
+    if abort_event.is_set():
+        return False
+
+    with pool_users_lock:
+        pool = get_pool(settings)
+        pool_users += 1
+
+    try:
+        # all jobs are queued now - the time each one waits for a worker is measured from here
+        queued_time = datetime.now()
+
+        job_list = [[job_function, w, settings, i, queued_time] for i, w in enumerate(work_list)]
+
+        if settings.get('adaptive_processes'):
+            results = get_adaptive_results(pool, job_list, job_type, settings, logger)
+        else:
+            results = get_unordered_results(pool, job_list)
+
+        return process_results(results, work_list, job_type, settings, logger, on_success)
+    finally:
+        # kill the jobs still running once every step has stopped waiting on them (steps running at the same time
+        # share the pool - see scheduler.py)
+        with pool_users_lock:
+            pool_users -= 1
+
+            if abort_event.is_set() and pool_users == 0:
+                terminate_pool()
+
+
+# runs jobs in the worker pool, returning their results as they finish. stops if the run is aborted
+def get_unordered_results(pool, job_list):
+    iterator = pool.imap_unordered(run_job, job_list)
+
+    for i in range(0, len(job_list)):
+        while True:
+            try:
+                yield iterator.next(timeout=ABORT_CHECK_SECONDS)
+                break
+            except multiprocessing.TimeoutError:
+                if abort_event.is_set():
+                    return
+
+
+# runs jobs in the worker pool, returning their results as they finish. the number of jobs run at once (the window)
+# is adjusted as they run: it's increased by 1 while throughput holds up, decreased by 1 if throughput drops or the
+# Postgres server has more active queries than cores, and halved if any of the jobs are waiting on locks.
+# throughput is compared with a moving average of the previous intervals', and only once enough jobs have finished
+# in an interval (an interval in which long jobs are all still running isn't a drop in throughput)
+def get_adaptive_results(pool, job_list, job_type, settings, logger):
+    result_queue = queue.Queue()
+
+    max_window = settings['max_concurrent_processes']
+    window = min(adaptive_window_dict.get(job_type, max(max_window // 2, 1)), max_window)
+
+    # errors raised outside of run_job (e.g. unpicklable work) - returned as a failed job
+    def get_error_callback(job_index):
+        return lambda ex: result_queue.put({"result": "JOB FAILED! : {0}".format(ex), "index": job_index,
+                                            "name": get_job_name(job_list[job_index][1]), "seconds": 0.0})
+
+    next_job = 0
+    num_running = 0
+    num_results = 0
+
+    interval_start_time = datetime.now()
+    interval_work = 0
+    interval_results = 0
+    average_rate = None
+    check_time = interval_start_time
+
+    while num_results < len(job_list) and not abort_event.is_set():
+        while num_running < window and next_job < len(job_list):
+            pool.apply_async(run_job, (job_list[next_job],), callback=result_queue.put,
+                             error_callback=get_error_callback(next_job))
+            next_job += 1
+            num_running += 1
+
+        try:
+            result = result_queue.get(timeout=min(ADAPTIVE_INTERVAL_SECONDS, ABORT_CHECK_SECONDS))
+
+            num_running -= 1
+            num_results += 1
+
+            # measure throughput in rows if the job copies rows, otherwise in jobs
+            interval_work += result.get("rows") or 1
+            interval_results += 1
+
+            yield result
+        except queue.Empty:
+            pass
+
+        # adjust the window while there are jobs waiting to run (the last few jobs always run at less than the window)
+        if (datetime.now() - check_time).total_seconds() >= ADAPTIVE_INTERVAL_SECONDS and next_job < len(job_list):
+            check_time = datetime.now()
+            active_queries, lock_waits = get_server_activity(settings)
+
+            if lock_waits > 0:
+                new_window = max(window // 2, 1)
+                reason = "{0} jobs waiting on locks".format(lock_waits)
+            elif active_queries > settings['server_cores']:
+                new_window = max(window - 1, 1)
+                reason = "{0} active queries on {1} server cores".format(active_queries, settings['server_cores'])
+            elif interval_results < ADAPTIVE_MIN_RESULTS:
+                continue  # too few jobs have finished to measure throughput - carry on measuring it
+            else:
+                rate = interval_work / (check_time - interval_start_time).total_seconds()
+
+                if average_rate is not None and rate < average_rate * 0.9:
+                    new_window = max(window - 1, 1)
+                    reason = "throughput down"
+                else:
+                    new_window = min(window + 1, max_window)
+                    reason = "throughput up"
+
+                if average_rate is None:
+                    average_rate = rate
+                else:
+                    average_rate = ADAPTIVE_SMOOTHING * rate + (1.0 - ADAPTIVE_SMOOTHING) * average_rate
+
+            if new_window != window:
+                logger.debug("\t\t- {0} : running {1} jobs at a time ({2})".format(job_type, new_window, reason))
+                window = new_window
+
+            interval_start_time = check_time
+            interval_work = 0
+            interval_results = 0
+
+    adaptive_window_dict[job_type] = window
+
+
+# returns the number of queries running on the Postgres server & the number of pool workers waiting on locks
+def get_server_activity(settings):
+    global monitor_pg_conn
+
+    try:
+        with monitor_lock:
+            if monitor_pg_conn is None or monitor_pg_conn.closed:
+                monitor_pg_conn = psycopg2.connect(settings['pg_connect_string'])
+                monitor_pg_conn.autocommit = True
+
+            pg_cur = monitor_pg_conn.cursor()
+            pg_cur.execute("SELECT count(*) FILTER (WHERE state = 'active' AND pid <> pg_backend_pid()), "
+                           "count(*) FILTER (WHERE wait_event_type = 'Lock' AND application_name = %s) "
+                           "FROM pg_stat_activity", (WORKER_APPLICATION_NAME,))
+            row = pg_cur.fetchone()
+            pg_cur.close()
+    except psycopg2.Error:
+        return 0, 0  # go on throughput alone
+
+    return int(row[0]), int(row[1])
+
+
+def close_monitor_connection():
+    global monitor_pg_conn
+
+    if monitor_pg_conn is not None:
+        monitor_pg_conn.close()
+        monitor_pg_conn = None
+
+
+# sets the number of cores on the Postgres server and, if it's not set, the number of processes to use.
+# Postgres can't report its server's cores, so they're only known if the server is on this machine - for a remote
+# server the number of processes must be set, and is taken as its cores. returns False if it isn't set.
+# call this before starting the worker pool
+def set_process_count(settings, logger):
+    if is_local_server(settings):
+        settings['server_cores'] = multiprocessing.cpu_count()
+    elif settings['max_concurrent_processes'] is not None:
+        settings['server_cores'] = settings['max_concurrent_processes']
+    else:
+        logger.fatal("The number of cores on the Postgres server ({0}) is unknown as it isn't on this machine"
+                     "\nACTION: Set '--max-processes' to the number of cores on the server"
+                     .format(settings['pg_host']))
+        return False
+
+    if settings['max_concurrent_processes'] is None:
+        settings['max_concurrent_processes'] = max(min(settings['server_cores'], MAX_AUTO_PROCESSES), 1)
+
+    if settings['adaptive_processes']:
+        logger.info("\t- using up to {0} processes, adjusted to the load on the Postgres server's {1} cores"
+                    .format(settings['max_concurrent_processes'], settings['server_cores']))
+    else:
+        logger.info("\t- using {0} processes".format(settings['max_concurrent_processes']))
+
+    return True
+
+
+# is the Postgres server on this machine?
+def is_local_server(settings):
+    return settings['pg_host'] in ["localhost", "127.0.0.1", "::1", ""] or settings['pg_host'].startswith("/")
+
+
+# runs a single job in a worker process - times it and traps any errors so they're reported in the main process
+def run_job(args):
+    global worker_db_seconds
+
+    job_function = args[0]
+    work = args[1]
+    settings = args[2]
+    job_index = args[3]
+    queued_time = args[4]
+
+    start_time = datetime.now()
+    worker_db_seconds = 0.0
+
+    try:
+        result = job_function([work, settings])
+    except Exception as ex:
+        result = "JOB FAILED! : {0} : {1}".format(get_job_name(work), ex)
+
+    # jobs return a result string, or a dict with a result string and optional stats (e.g. rows copied)
+    if not isinstance(result, dict):
+        result = {"result": result}
+
+    result["name"] = get_job_name(work)
+    result["index"] = job_index
+    result["seconds"] = (datetime.now() - start_time).total_seconds()
+    result["queue_wait_seconds"] = (start_time - queued_time).total_seconds()
+    result["db_seconds"] = worker_db_seconds
+    result["worker"] = multiprocessing.current_process().name
+    result["worker_pid"] = os.getpid()
+
+    return result
+
+
+# short description of a job for logging
+def get_job_name(work):
+    if isinstance(work, dict):
+        name = work.get("name") or work.get("file_path") or work.get("pg_table") or str(work)
+    else:
+        name = str(work)
+
+    name = " ".join(name.split())
+
+    if len(name) > 80:
+        name = name[:77] + "..."
+
+    return name
+
+
+# logs job results as they arrive, with throughput & ETA. Aborts the run on the first failure if requested
+def process_results(results, work_list, job_type, settings, logger, on_success=None):
+    start_time = datetime.now()
+    last_report_time = start_time
 
     num_jobs = len(work_list)
 
-    results = pool.imap_unordered(run_csv_import_multiprocessing, [[w, settings] for w in work_list])
+    num_results = 0
+    num_failed = 0
+    rows = 0
+
+    for result in results:
+        if abort_event.is_set():
+            break
+
+        num_results += 1
+        rows += result.get("rows") or 0
+
+        logger.debug("\t\t- {0} : {1} : {2:.1f}s".format(job_type, result["name"], result["seconds"]))
+        metrics.record_job(job_type, work_list[result["index"]], result, settings)
+
+        if result["result"] != "SUCCESS":
+            num_failed += 1
+            logger.warning(result["result"])
+
+            if settings.get('abort_on_failure'):
+                logger.fatal("\t- {0} job failed - aborting the run ({1} of {2} jobs finished)"
+                             .format(job_type, num_results, num_jobs))
+                abort_event.set()
+                return False
+        elif on_success is not None:
+            on_success(work_list[result["index"]], result)
+
+        # report progress periodically and when the last job finishes
+        now = datetime.now()
 
-    pool.close()
-    pool.join()
+        if num_results == num_jobs or (now - last_report_time).total_seconds() >= PROGRESS_REPORT_SECONDS:
+            last_report_time = now
+            elapsed = max((now - start_time).total_seconds(), 0.001)
+            eta = timedelta(seconds=int(elapsed / num_results * (num_jobs - num_results)))
 
-    result_list = list(results)
-    num_results = len(result_list)
+            progress = "\t\t- {0} : {1} of {2} jobs done : {3:.1f} jobs/s" \
+                .format(job_type, num_results, num_jobs, num_results / elapsed)
+
+            if rows > 0:
+                progress += " : {0:.0f} rows/s".format(rows / elapsed)
+
+            logger.info(progress + " : ETA {0}".format(eta))
+
+    # a job in another step failed
+    if abort_event.is_set():
+        logger.warning("\t- {0} : stopped, the run was aborted ({1} of {2} jobs finished)"
+                       .format(job_type, num_results, num_jobs))
+        return False
 
     if num_jobs > num_results:
         logger.warning("\t- A MULTIPROCESSING PROCESS FAILED WITHOUT AN ERROR\nACTION: Check the record counts")
 
-    for result in result_list:
-        if result != "SUCCESS":
-            logger.info(result)
+    if num_failed > 0:
+        logger.warning("\t- {0} of {1} {2} jobs failed".format(num_failed, num_jobs, job_type))
+
+    return True
+
+
+# takes a list of csv files and imports them using multiprocessing
+def multiprocess_csv_import(work_list, settings, logger, on_success=None):
+    return multiprocess_jobs(run_csv_import_multiprocessing, work_list, "csv import", settings, logger, on_success)
 
 
 def run_csv_import_multiprocessing(args):
     file_dict = args[0]
     settings = args[1]
 
-    pg_conn = psycopg2.connect(settings['pg_connect_string'])
-    pg_conn.autocommit = True
-    pg_cur = pg_conn.cursor()
+    pg_cur = get_worker_cursor(settings)
 
     # CREATE TABLE
 
-    # get the census fields to use in the create table statement
-    field_list = list()
-
-    # select the field ordered by sequential_id (required to match field names with the right data)
-    sql = "SELECT sequential_id || ' double precision' AS field " \
-          "FROM {0}.metadata_stats " \
-          "WHERE lower(table_number) LIKE '{1}%' " \
-          "ORDER BY table_number, right(sequential_id, length(sequential_id) - 1)::integer " \
-        .format(settings['data_schema'], file_dict["table"])
-    pg_cur.execute(sql)
-
-    fields = pg_cur.fetchall()
-
-    for field in fields:
-        field_list.append(field[0].lower())
-
-    fields_string = ",".join(field_list)
+    # the census fields to use in the create table statement (precomputed for every table - see get_table_fields)
+    fields_string = file_dict["fields"]
 
     # create the table
     table_name = file_dict["boundary"] + "_" + file_dict["table"]
 
-    create_table_sql = "DROP TABLE IF EXISTS {0}.{1} CASCADE;" \
-                       "CREATE TABLE {0}.{1} ({4} text, {2}) WITH (OIDS=FALSE);" \
-                       "ALTER TABLE {0}.metadata_tables OWNER TO {3}" \
-        .format(settings['data_schema'], table_name, fields_string,
-                settings['pg_user'], settings['region_id_field'])
+    # deferred finalisation: create the table and COPY into it with FREEZE in the same transaction (the rows are
+    # written frozen, so no vacuum is needed to freeze them later, and with wal_level = minimal the COPY isn't
+    # WAL logged). the primary key etc... are added by finalise_csv_tables
+    deferred = settings['deferred_finalise']
+    partitioned = settings['partitioned_tables']
+
+    if partitioned:
+        # the table becomes a boundary's partition of its census table once it's loaded. creating (or dropping) a
+        # partition takes an ACCESS EXCLUSIVE lock on its census table, which waits for (and blocks) the loads of its
+        # other boundaries - and with --deferred-finalise would be held for the whole COPY, in the COPY's
+        # transaction. attaching a loaded table only needs a SHARE UPDATE EXCLUSIVE lock, which doesn't block loads.
+        # the default sets the boundary & the check lets the table be attached without a scan. the previous load's
+        # partition is dropped by create_partitioned_tables
+        create_table_sql = "DROP TABLE IF EXISTS {0}.{1} CASCADE;" \
+                           "CREATE TABLE {0}.{1} (boundary text NOT NULL DEFAULT '{3}' CHECK (boundary = '{3}'), " \
+                           "{5} text NOT NULL, {2}) WITH (OIDS=FALSE);" \
+                           "ALTER TABLE {0}.{1} OWNER TO {4}" \
+            .format(settings['data_schema'], table_name, fields_string, file_dict["boundary"], settings['pg_user'],
+                    settings['region_id_field'])
+    else:
+        create_table_sql = "DROP TABLE IF EXISTS {0}.{1} CASCADE;" \
+                           "CREATE TABLE {0}.{1} ({4} text, {2}) WITH (OIDS=FALSE);" \
+                           "ALTER TABLE {0}.{1} OWNER TO {3}" \
+            .format(settings['data_schema'], table_name, fields_string,
+                    settings['pg_user'], settings['region_id_field'])
+
+    # the columns in the CSV file
+    column_list = [settings['region_id_field']] + [field.split(" ")[0] for field in fields_string.split(",")]
 
-    pg_cur.execute(create_table_sql)
+    if deferred:
+        pg_cur.execute("BEGIN")
 
     # IMPORT CSV FILE
 
     try:
-        # read CSV into a string
-        raw_string = open(file_dict["path"], 'r').read()
+        pg_cur.execute(create_table_sql)
 
-        # clean whitespace and rogue non-ascii characters
-        clean_string = raw_string.lstrip().rstrip().replace(" ", "").replace("\x1A", "")
+        # stream the CSV into Postgres, cleaning it a chunk at a time (keeps memory use flat regardless of file size)
+        with open(file_dict["path"], 'r') as raw_file:
+            csv_file = CleanCsvStream(raw_file)
 
-        # convert to in memory stream
-        csv_file = io.StringIO(clean_string)
-        csv_file.seek(0)  # move position back to beginning of file before reading
+            # import into Postgres
+            if deferred:
+                sql = "COPY {0}.{1} ({2}) FROM stdin " \
+                      "WITH (FORMAT csv, HEADER true, DELIMITER ',', NULL '..', FREEZE true)" \
+                    .format(settings['data_schema'], table_name, ",".join(column_list))
+            else:
+                sql = "COPY {0}.{1} ({2}) FROM stdin WITH CSV HEADER DELIMITER as ',' NULL as '..'" \
+                    .format(settings['data_schema'], table_name, ",".join(column_list))
+            pg_cur.copy_expert(sql, csv_file, size=COPY_BUFFER_SIZE)
+            rows = pg_cur.rowcount
 
-        # import into Postgres
-        sql = "COPY {0}.{1} FROM stdin WITH CSV HEADER DELIMITER as ',' NULL as '..'" \
-            .format(settings['data_schema'], table_name)
-        pg_cur.copy_expert(sql, csv_file)
+        if deferred:
+            pg_cur.execute("COMMIT")
 
     except Exception as ex:
+        if deferred:
+            rollback_transaction(pg_cur)
+
+        pg_cur.close()
         return "IMPORT CSV INTO POSTGRES FAILED! : {0} : {1}".format(file_dict["path"], ex)
 
-    # add primary key and vacuum index
-    sql = "ALTER TABLE {0}.{1} ADD CONSTRAINT {1}_pkey PRIMARY KEY ({2});" \
-          "ALTER TABLE {0}.{1} CLUSTER ON {1}_pkey" \
-        .format(settings['data_schema'], table_name, settings['region_id_field'])
+    # hash the file for its load manifest record here, rather than in the main process (see checkpoint.record_unit)
+    file_hash = checkpoint.get_file_hash(file_dict["path"])
+
+    if deferred:
+        pg_cur.close()
+        return {"result": "SUCCESS", "rows": rows, "hash": file_hash}
+
+    # add primary key and vacuum index. partitions are attached to their census table once they have their primary
+    # key - the census table's primary key uses it, instead of building another index while it's locked
+    if partitioned:
+        sql = "ALTER TABLE {0}.{1} ADD CONSTRAINT {1}_pkey PRIMARY KEY (boundary, {2});" \
+              "ALTER TABLE {0}.{3} ATTACH PARTITION {0}.{1} FOR VALUES IN ('{4}');" \
+              "ALTER TABLE {0}.{1} CLUSTER ON {1}_pkey" \
+            .format(settings['data_schema'], table_name, settings['region_id_field'], file_dict["table"],
+                    file_dict["boundary"])
+    else:
+        sql = "ALTER TABLE {0}.{1} ADD CONSTRAINT {1}_pkey PRIMARY KEY ({2});" \
+              "ALTER TABLE {0}.{1} CLUSTER ON {1}_pkey" \
+            .format(settings['data_schema'], table_name, settings['region_id_field'])
     pg_cur.execute(sql)
 
     pg_cur.execute("VACUUM ANALYSE {0}.{1}".format(settings['data_schema'], table_name))
@@ -149,42 +832,166 @@ def run_csv_import_multiprocessing(args):
     result = "SUCCESS"
 
     pg_cur.close()
-    pg_conn.close()
 
-    return result
+    return {"result": result, "rows": rows, "hash": file_hash}
 
 
-# takes a list of sql queries or command lines and runs them using multiprocessing
-def multiprocess_list(mp_type, work_list, settings, logger):
-    pool = multiprocessing.Pool(processes=settings['max_concurrent_processes'])
+# takes a list of census metadata spreadsheets and imports them using multiprocessing
+def multiprocess_metadata_import(work_list, settings, logger, on_success=None):
+    return multiprocess_jobs(run_metadata_import_multiprocessing, work_list, "metadata import", settings, logger,
+                             on_success)
 
-    num_jobs = len(work_list)
 
-    if mp_type == "sql":
-        results = pool.imap_unordered(run_sql_multiprocessing, [[w, settings] for w in work_list])
-    else:
-        results = pool.imap_unordered(run_command_line, work_list)
+# imports the metadata sheets of a census spreadsheet, streaming their rows straight into COPY
+def run_metadata_import_multiprocessing(args):
+    file_dict = args[0]
+    settings = args[1]
 
-    pool.close()
-    pool.join()
+    pg_cur = get_worker_cursor(settings)
 
-    result_list = list(results)
-    num_results = len(result_list)
+    rows = 0
 
-    if num_jobs > num_results:
-        logger.warning("\t- A MULTIPROCESSING PROCESS FAILED WITHOUT AN ERROR\nACTION: Check the record counts")
+    try:
+        file_hash = checkpoint.get_file_hash(file_dict["path"])
+        sheets = get_metadata_sheets(file_dict["path"], file_hash, settings)
+
+        for table_dict, df in zip(settings["census_metadata_dicts"], sheets):
+            # find the header row - the data starts on the row after it
+            first_column = df.iloc[:, 0].astype(str).str.lower()
+            header_rows = (first_column == table_dict["first_row"]).values.nonzero()[0]
+
+            if len(header_rows) == 0:
+                pg_cur.close()
+                return "METADATA HEADER ROW NOT FOUND! : {0} : {1}".format(file_dict["path"], table_dict["table"])
+
+            # drop the unwanted rows at the top & excess columns in unclean Excel worksheets
+            df_clean = df.iloc[header_rows[0] + 1:, :table_dict["columns"]]
+
+            sql = "COPY {0}.{1} FROM stdin WITH CSV NULL as ''".format(settings['data_schema'], table_dict["table"])
+            pg_cur.copy_expert(sql, RowCsvStream(df_clean.itertuples(index=False, name=None)),
+                               size=COPY_BUFFER_SIZE)
+            rows += pg_cur.rowcount
+
+    except Exception as ex:
+        pg_cur.close()
+        return "IMPORT METADATA INTO POSTGRES FAILED! : {0} : {1}".format(file_dict["path"], ex)
+
+    pg_cur.close()
+
+    return {"result": "SUCCESS", "rows": rows, "hash": file_hash}
+
+
+# returns the metadata worksheets of a census spreadsheet as dataframes of strings (one per metadata table).
+# parsing Excel files is slow - the sheets are cached as Parquet by the spreadsheet's hash so reloads skip the parse
+# (only if pyarrow is installed - a cache of pickles could be used to run someone else's code)
+def get_metadata_sheets(file_path, file_hash, settings):
+    cache_paths = list()
+
+    if pyarrow is not None:
+        cache_paths = [os.path.join(settings['cache_directory'], "metadata_{0}_{1}.parquet".format(file_hash, i))
+                       for i in range(0, len(settings["census_metadata_dicts"]))]
 
-    for result in result_list:
-        if result != "SUCCESS":
-            logger.info(result)
+        if all([os.path.isfile(cache_path) for cache_path in cache_paths]):
+            return [pandas.read_parquet(cache_path) for cache_path in cache_paths]
+
+    xl = pandas.ExcelFile(file_path)
+
+    sheets = list()
+
+    for i in range(0, len(settings["census_metadata_dicts"])):
+        df = xl.parse(xl.sheet_names[i], header=None, dtype=str)
+        df.columns = [str(column) for column in df.columns]  # Parquet needs text column names
+        sheets.append(df)
+
+    # write each cache file to a temp file first, so a failed write doesn't leave a corrupt cache behind
+    try:
+        if len(cache_paths) > 0:
+            make_cache_directory(settings)
+
+        for df, cache_path in zip(sheets, cache_paths):
+            temp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+            df.to_parquet(temp_path)
+            os.rename(temp_path, cache_path)
+    except (IOError, OSError):
+        pass  # the cache is only an optimisation
+
+    return sheets
+
+
+# creates the cache directory if it doesn't exist, readable & writable by the current user only
+def make_cache_directory(settings):
+    os.makedirs(settings['cache_directory'], mode=0o700, exist_ok=True)
+
+
+# takes a list of census stats tables and exports them to Parquet using multiprocessing
+def multiprocess_parquet_export(work_list, settings, logger, on_success=None):
+    return multiprocess_jobs(run_parquet_export_multiprocessing, work_list, "parquet export", settings, logger,
+                             on_success)
+
+
+# exports a census stats table to a Parquet file, a batch of rows at a time, then uploads it to S3 (if requested)
+def run_parquet_export_multiprocessing(args):
+    work_dict = args[0]
+    settings = args[1]
+
+    schema = pyarrow.schema([(settings['region_id_field'], pyarrow.string())] +
+                            [(column_name, pyarrow.float64()) for column_name in work_dict["column_names"]])
+
+    # the processes exporting a table's partitions all create its directory
+    os.makedirs(os.path.dirname(work_dict["path"]), exist_ok=True)
+
+    # write to a temp file first, so a failed export doesn't leave a partial file behind
+    temp_path = "{0}.{1}.tmp".format(work_dict["path"], os.getpid())
+    rows = 0
+
+    pg_cur = get_worker_cursor(settings, "parquet_export")
+
+    try:
+        pg_cur.execute("SELECT {0}, {1} FROM {2} ORDER BY {0}"
+                       .format(settings['region_id_field'], ",".join(work_dict["columns"]), work_dict["table"]))
+
+        parquet_writer = pyarrow.parquet.ParquetWriter(temp_path, schema)
+
+        try:
+            while True:
+                batch = pg_cur.fetchmany(PARQUET_BATCH_ROWS)
+
+                if len(batch) == 0:
+                    break
+
+                arrays = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*batch), schema)]
+                parquet_writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+                rows += len(batch)
+        finally:
+            parquet_writer.close()
+
+        os.rename(temp_path, work_dict["path"])
+        num_bytes = os.path.getsize(work_dict["path"])
+    finally:
+        pg_cur.close()
+
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+    if work_dict["key"] is not None:
+        s3utils.upload_file(s3utils.get_s3_client(), settings['s3_bucket'], work_dict["key"], work_dict["path"],
+                            "application/vnd.apache.parquet", settings)
+
+    return {"result": "SUCCESS", "rows": rows, "bytes": num_bytes}
+
+
+# takes a list of sql queries or command lines and runs them using multiprocessing
+def multiprocess_list(mp_type, work_list, settings, logger, on_success=None):
+    if mp_type == "sql":
+        return multiprocess_jobs(run_sql_multiprocessing, work_list, "sql", settings, logger, on_success)
+    else:
+        return multiprocess_jobs(run_command_line_multiprocessing, work_list, "command", settings, logger, on_success)
 
 
 def run_sql_multiprocessing(args):
     the_sql = args[0]
     settings = args[1]
-    pg_conn = psycopg2.connect(settings['pg_connect_string'])
-    pg_conn.autocommit = True
-    pg_cur = pg_conn.cursor()
+    pg_cur = get_worker_cursor(settings)
 
     # # set raw gnaf database schema (it's needed for the primary and foreign key creation)
     # if settings['raw_gnaf_schema'] != "public":
@@ -197,11 +1004,14 @@ def run_sql_multiprocessing(args):
         result = "SQL FAILED! : {0} : {1}".format(the_sql, ex)
 
     pg_cur.close()
-    pg_conn.close()
 
     return result
 
 
+def run_command_line_multiprocessing(args):
+    return run_command_line(args[0])
+
+
 def run_command_line(cmd):
     # run the command line without any output (it'll still tell you if it fails miserably)
     try:
@@ -214,65 +1024,219 @@ def run_command_line(cmd):
     return result
 
 
-def split_sql_into_list(pg_cur, the_sql, table_schema, table_name, table_alias, table_gid, settings, logger):
-    # get min max gid values from the table to split
-    min_max_sql = "SELECT MIN({2}) AS min, MAX({2}) AS max FROM {0}.{1}".format(table_schema, table_name, table_gid)
+# takes a list of tile export jobs (one per boundary & zoom level) and runs them using multiprocessing
+def multiprocess_tile_export(work_list, settings, logger, on_success=None):
+    return multiprocess_jobs(run_tile_export_multiprocessing, work_list, "tile export", settings, logger, on_success)
+
+
+# runs a query that returns one map tile per row (x, y, content) and uploads the tiles to S3 as they're read.
+# tiles that haven't changed since the last export are skipped. returns the hash of every tile, for the S3 index
+def run_tile_export_multiprocessing(args):
+    work_dict = args[0]
+    settings = args[1]
+
+    previous_tiles = work_dict["previous_tiles"]
+    tiles = dict()
+    uploaded_bytes = 0
+
+    pg_cur = get_worker_cursor(settings, "tile_export")
+    pg_cur.itersize = 100
+    pg_cur.execute(work_dict["sql"])
+
+    def get_changed_tiles():
+        nonlocal uploaded_bytes
+
+        for x, y, content in pg_cur:
+            # GeoJSON tiles are text, vector tiles are binary
+            if isinstance(content, str):
+                body = content.encode("utf-8")
+            else:
+                body = bytes(content)
+            tile_id = "{0}/{1}".format(x, y)
 
-    pg_cur.execute(min_max_sql)
+            tiles[tile_id] = s3utils.get_content_hash(body)
+
+            if previous_tiles.get(tile_id) != tiles[tile_id]:
+                key = "{0}/{1}/{2}.{3}".format(work_dict["key_prefix"], work_dict["zoom"], tile_id,
+                                               work_dict["file_type"])
+                uploaded_bytes += len(body)
+                yield key, body, work_dict["content_type"]
 
     try:
-        result = pg_cur.fetchone()
+        num_uploaded = s3utils.put_objects(s3utils.get_s3_client(), settings['s3_bucket'], get_changed_tiles(),
+                                           settings)
+    finally:
+        pg_cur.close()
+
+    return {"result": "SUCCESS", "rows": num_uploaded, "bytes": uploaded_bytes, "tiles": tiles}
+
 
-        min_pkey = int(result[0])
-        max_pkey = int(result[1])
-        diff = max_pkey - min_pkey
+# takes a list of TopoJSON tile jobs (one per boundary & zoom level) and runs them using multiprocessing
+def multiprocess_topojson_tiles(work_list, settings, logger, on_success=None):
+    return multiprocess_jobs(run_topojson_tiles_multiprocessing, work_list, "topojson tiles", settings, logger,
+                             on_success)
 
-        # Number of records in each query
-        rows_per_request = int(math.floor(float(diff) / float(settings['max_concurrent_processes']))) + 1
 
-        # If less records than processes or rows per request,
-        # reduce both to allow for a minimum of 15 records each process
-        if float(diff) / float(settings['max_concurrent_processes']) < 10.0:
-            rows_per_request = 10
-            processes = int(math.floor(float(diff) / 10.0)) + 1
+# converts a boundary's GeoJSON tiles for a zoom level into TopoJSON and copies them into its tile table,
+# a batch at a time
+def run_topojson_tiles_multiprocessing(args):
+    work_dict = args[0]
+    settings = args[1]
+
+    read_cur = get_worker_cursor(settings, "topojson_tiles")
+    read_cur.itersize = 100
+    pg_cur = get_worker_cursor(settings)
+
+    copy_sql = "COPY {0} (z, x, y, tile) FROM STDIN WITH CSV".format(work_dict["table"])
+    rows = 0
+
+    try:
+        read_cur.execute(work_dict["sql"])
+
+        tile_file = io.StringIO()
+        tile_writer = csv.writer(tile_file)
+
+        for x, y, geojson in read_cur:
+            topology = topojson.get_topology(json.loads(geojson), work_dict["boundary"], work_dict["decimal_places"])
+            tile_writer.writerow([work_dict["zoom"], x, y, json.dumps(topology, separators=(",", ":"))])
+            rows += 1
+
+            if tile_file.tell() >= COPY_BUFFER_SIZE * 16:
+                copy_csv_buffer(pg_cur, copy_sql, tile_file)
+                tile_file = io.StringIO()
+                tile_writer = csv.writer(tile_file)
+
+        copy_csv_buffer(pg_cur, copy_sql, tile_file)
+    finally:
+        read_cur.close()
+        pg_cur.close()
+
+    return {"result": "SUCCESS", "rows": rows}
+
+
+def copy_csv_buffer(pg_cur, copy_sql, csv_file):
+    if csv_file.tell() > 0:
+        csv_file.seek(0)
+        pg_cur.copy_expert(copy_sql, csv_file, size=COPY_BUFFER_SIZE)
+
+
+# splits a query into a list of queries that each run over one range (shard) of a key field, so they can be run in
+# parallel. the query must contain SHARD_FILTER_PLACEHOLDER where the shard's filter goes, e.g.
+# "INSERT INTO ... FROM census_bdys.sa1 AS bdy WHERE bdy.geom IS NOT NULL AND {shard_filter} GROUP BY ...".
+# the key ranges hold roughly the same number of rows, or the same number of points if a geometry field is given
+# (see get_shard_bounds). all rows for a key value land in the same shard, so queries can group by the key
+def split_sql_into_list(pg_cur, the_sql, table_schema, table_name, table_alias, table_gid, settings, logger,
+                        shards=None, geom_field=None):
+    if SHARD_FILTER_PLACEHOLDER not in the_sql:
+        raise ValueError("no {0} placeholder in the SQL statement to split".format(SHARD_FILTER_PLACEHOLDER))
+
+    if shards is None:
+        shards = settings['max_concurrent_processes']
+
+    if shards > 1:
+        bound_list = get_shard_bounds(pg_cur, table_schema, table_name, table_gid, shards, geom_field)
+
+        if len(bound_list) + 1 < shards:
             logger.info("\t\t- running {0} processes (adjusted due to low row count in table to split)"
-                        .format(processes))
+                        .format(len(bound_list) + 1))
+    else:
+        bound_list = list()
+
+    # quote the bounds as literals of the key's type
+    literal_list = [pg_cur.mogrify("%s", (bound,)) for bound in bound_list]
+    literal_list = [literal.decode("utf-8") if isinstance(literal, bytes) else literal for literal in literal_list]
+
+    key = "{0}.{1}".format(table_alias, table_gid)
+    sql_list = list()
+
+    for i in range(0, len(literal_list) + 1):
+        filter_list = list()
+
+        if i > 0:
+            filter_list.append("{0} >= {1}".format(key, literal_list[i - 1]))
+        if i < len(literal_list):
+            filter_list.append("{0} < {1}".format(key, literal_list[i]))
+
+        if len(filter_list) == 0:
+            shard_filter = "TRUE"
+        elif i == 0:
+            # rows without a key go in the first shard
+            shard_filter = "({0} OR {1} IS NULL)".format(filter_list[0], key)
         else:
-            processes = settings['max_concurrent_processes']
+            shard_filter = " AND ".join(filter_list)
 
-        # create list of sql statements to run with multiprocessing
-        sql_list = []
-        start_pkey = min_pkey - 1
+        sql_list.append(the_sql.replace(SHARD_FILTER_PLACEHOLDER, shard_filter))
 
-        for i in range(0, processes):
-            end_pkey = start_pkey + rows_per_request
+    # logger.info('\n'.join(sql_list))
 
-            where_clause = " WHERE {0}.{3} > {1} AND {0}.{3} <= {2}" \
-                .format(table_alias, start_pkey, end_pkey, table_gid)
+    return sql_list
 
-            if "WHERE " in the_sql:
-                mp_sql = the_sql.replace(" WHERE ", where_clause + " AND ")
-            elif "GROUP BY " in the_sql:
-                mp_sql = the_sql.replace("GROUP BY ", where_clause + " GROUP BY ")
-            elif "ORDER BY " in the_sql:
-                mp_sql = the_sql.replace("ORDER BY ", where_clause + " ORDER BY ")
-            else:
-                if ";" in the_sql:
-                    mp_sql = the_sql.replace(";", where_clause + ";")
-                else:
-                    mp_sql = the_sql + where_clause
-                    logger.warning("\t\t- NOTICE: no ; found at the end of the SQL statement")
 
-            sql_list.append(mp_sql)
-            start_pkey = end_pkey
+# returns the sorted key values that split a table into (up to) the given number of shards: shard 1 holds keys below
+# the first value, shard 2 keys from the first value to below the second, and so on. shards are balanced by:
+#   - the total points of each key's geometries, if a geometry field is given (big, detailed boundaries take longer
+#     to process than many small ones)
+#   - otherwise the number of rows - using the key's histogram in pg_stats if the table has been analysed (no need to
+#     read the table), or a running count of rows by key (like ntile(), but never splitting a key) if it hasn't
+# fewer shards are returned if there aren't enough distinct keys
+def get_shard_bounds(pg_cur, table_schema, table_name, key_field, shards, geom_field=None):
+    bound_list = None
 
-        # logger.info('\n'.join(sql_list))
+    if geom_field is None:
+        bound_list = get_histogram_shard_bounds(pg_cur, table_schema, table_name, key_field, shards)
 
-        return sql_list
-    except Exception as ex:
-        logger.fatal("Looks like the table in this query is empty: {0}\n{1}".format(min_max_sql, ex))
+    if bound_list is None:
+        if geom_field is not None:
+            weight = "COALESCE(SUM(ST_NPoints({0})), 0) + COUNT(*)".format(geom_field)
+        else:
+            weight = "COUNT(*)"
+
+        # each key's shard is the share of the total weight up to and including the key
+        pg_cur.execute("SELECT MIN(key) FROM (SELECT key, ceil(SUM(weight) OVER (ORDER BY key) * {4} / "
+                       "SUM(weight) OVER ()) AS shard FROM (SELECT {2} AS key, ({3})::double precision AS weight "
+                       "FROM {0}.{1} WHERE {2} IS NOT NULL GROUP BY {2}) AS keys) AS shards "
+                       "GROUP BY shard ORDER BY 1"
+                       .format(table_schema, table_name, key_field, weight, shards))
+
+        # the first shard starts at the lowest key
+        bound_list = [row[0] for row in pg_cur.fetchall()][1:]
+
+    return bound_list
+
+
+# returns shard bounds picked evenly from the key's histogram (each histogram bucket holds roughly the same number of
+# rows), or None if there's no usable histogram (e.g. the table hasn't been analysed, or doesn't exist)
+def get_histogram_shard_bounds(pg_cur, table_schema, table_name, key_field, shards):
+    pg_cur.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                   "WHERE attrelid = to_regclass('{0}.{1}') AND attname = '{2}'"
+                   .format(table_schema, table_name, key_field))
+    row = pg_cur.fetchone()
+
+    if row is None:
         return None
 
+    key_type = row[0]
+
+    pg_cur.execute("SELECT histogram_bounds::text::{3}[] FROM pg_stats "
+                   "WHERE schemaname = '{0}' AND tablename = '{1}' AND attname = '{2}'"
+                   .format(table_schema, table_name, key_field, key_type))
+    row = pg_cur.fetchone()
+
+    # need at least a bucket per shard
+    if row is None or row[0] is None or len(row[0]) <= shards:
+        return None
+
+    histogram_list = row[0]
+    bound_list = list()
+
+    for i in range(1, shards):
+        bound = histogram_list[int(round(float(i) * float(len(histogram_list) - 1) / float(shards)))]
+
+        if bound not in bound_list:
+            bound_list.append(bound)
+
+    return bound_list
+
 
 def check_python_version(logger):
     # get python and psycopg2 version
@@ -310,25 +1274,9 @@ def check_postgis_version(pg_cur, settings, logger):
                 .format(pg_version, postgis_version, geos_version))
 
 
-def multiprocess_shapefile_load(work_list, settings, logger):
-    pool = multiprocessing.Pool(processes=settings['max_concurrent_processes'])
-
-    num_jobs = len(work_list)
-
-    results = pool.imap_unordered(intermediate_shapefile_load_step, [[w, settings] for w in work_list])
-
-    pool.close()
-    pool.join()
-
-    result_list = list(results)
-    num_results = len(result_list)
-
-    if num_jobs > num_results:
-        logger.warning("\t- A MULTIPROCESSING PROCESS FAILED WITHOUT AN ERROR\nACTION: Check the record counts")
-
-    for result in result_list:
-        if result != "SUCCESS":
-            logger.info(result)
+def multiprocess_shapefile_load(work_list, settings, logger, on_success=None):
+    return multiprocess_jobs(intermediate_shapefile_load_step, work_list, "shapefile load", settings, logger,
+                             on_success)
 
 
 def intermediate_shapefile_load_step(args):
@@ -341,19 +1289,31 @@ def intermediate_shapefile_load_step(args):
     pg_schema = work_dict['pg_schema']
     delete_table = work_dict['delete_table']
     spatial = work_dict['spatial']
+    staging = work_dict.get('staging', False)
+    id_prefix = work_dict.get('id_prefix')
 
-    pg_conn = psycopg2.connect(settings['pg_connect_string'])
-    pg_conn.autocommit = True
-    pg_cur = pg_conn.cursor()
+    pg_cur = get_worker_cursor(settings)
+
+    result = import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_table, spatial,
+                                          settings['shapefile_dump_format'], staging, id_prefix)
+
+    pg_cur.close()
 
-    result = import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_table, spatial)
+    # hash the Shapefile for its load manifest record here, rather than in the main process
+    if result == "SUCCESS":
+        return {"result": result, "hash": checkpoint.get_file_hash(file_path)}
 
     return result
 
 
-# imports a Shapefile into Postgres in 2 steps: SHP > SQL; SQL > Postgres
+# imports a Shapefile into Postgres using shp2pgsql (part of PostGIS), either:
+#   - streaming its dump format output straight into a COPY (default - bounded memory and much faster than INSERTs); or
+#   - in 2 steps: SHP > SQL; SQL > Postgres
 # overcomes issues trying to use psql with PGPASSWORD set at runtime
-def import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_table, spatial):
+# staging tables are created unlogged, without a spatial index, ready to be merged into another table
+# id_prefix is an (id field, prefix) tuple - the prefix is added to the id field's values as they're loaded
+def import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_table, spatial, dump_format=True,
+                                 staging=False, id_prefix=None):
 
     # delete target table or append to it?
     if delete_table:
@@ -362,16 +1322,48 @@ def import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_
         delete_append_flag = "-a"
 
     # assign coordinate system if spatial, otherwise flag as non-spatial
-    if spatial:
+    if spatial and staging:
+        spatial_or_dbf_flags = "-s 4283"
+    elif spatial:
         spatial_or_dbf_flags = "-s 4283 -I"
     else:
         spatial_or_dbf_flags = "-G -n"
 
+    # output COPY statements instead of INSERTs
+    if dump_format:
+        spatial_or_dbf_flags += " -D"
+
     # build shp2pgsql command line
     shp2pgsql_cmd = "shp2pgsql {0} {1} -i \"{2}\" {3}.{4}" \
         .format(delete_append_flag, spatial_or_dbf_flags, file_path, pg_schema, pg_table)
     # print(shp2pgsql_cmd)
 
+    if dump_format:
+        result = copy_shapefile_dump_to_postgres(pg_cur, shp2pgsql_cmd, file_path, delete_table, spatial, staging,
+                                                 id_prefix)
+    else:
+        result = run_shapefile_sql_in_postgres(pg_cur, shp2pgsql_cmd, file_path, pg_table, delete_table, spatial,
+                                               staging, id_prefix)
+
+    if result != "SUCCESS":
+        return result
+
+    # Cluster table on spatial index for performance
+    if delete_table and spatial and not staging:
+        sql = "ALTER TABLE {0}.{1} CLUSTER ON {1}_geom_idx".format(pg_schema, pg_table)
+
+        try:
+            pg_cur.execute(sql)
+        except:
+            return "\tImporting {0} - Couldn't cluster on spatial index".format(pg_table)
+
+    return "SUCCESS"
+
+
+# converts a Shapefile to one big SQL script in memory and runs it
+def run_shapefile_sql_in_postgres(pg_cur, shp2pgsql_cmd, file_path, pg_table, delete_table, spatial, staging,
+                                  id_prefix=None):
+
     # convert the Shapefile to SQL statements
     try:
         process = subprocess.Popen(shp2pgsql_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
@@ -379,11 +1371,107 @@ def import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_
     except:
         return "Importing {0} - Couldn't convert Shapefile to SQL".format(file_path)
 
+    if process.returncode != 0:
+        return "Importing {0} - Couldn't convert Shapefile to SQL : shp2pgsql failed with exit code {1}\n" \
+               "shp2pgsql result was: {2} ".format(file_path, process.returncode, err.decode("utf-8", "replace"))
+
     # print("SQL object is this long: {}".format(len(sql_obj)))
     # print("Error is: {}".format(err))
 
     # prep Shapefile SQL
-    sql = sql_obj.decode("utf-8")  # this is required for Python 3
+    sql = prep_shapefile_sql(sql_obj.decode("utf-8"), delete_table, spatial, staging)  # decode required for Python 3
+
+    # prefix the ids in one rewrite, after the INSERTs & before the spatial index is created
+    if id_prefix is not None:
+        sql = add_id_prefix_sql(sql, id_prefix, delete_table)
+
+    # import data to Postgres
+    try:
+        pg_cur.execute(sql)
+    except:
+        # the script runs in a transaction - clear it so the connection can be reused
+        rollback_transaction(pg_cur)
+
+        # if import fails for some reason - output sql to file for debugging
+        target = open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fail_{}.sql'.format(pg_table)), "w")
+        target.write(sql)
+
+        return "\tImporting {0} - Couldn't run Shapefile SQL\nshp2pgsql result was: {1} ".format(file_path, err)
+
+    return "SUCCESS"
+
+
+# streams shp2pgsql dump format output into Postgres: runs the SQL before the COPY data, pipes the data rows straight
+# into copy_expert as shp2pgsql writes them, then runs the SQL after the data (index creation etc...)
+def copy_shapefile_dump_to_postgres(pg_cur, shp2pgsql_cmd, file_path, delete_table, spatial, staging,
+                                    id_prefix=None):
+
+    try:
+        err_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(shp2pgsql_cmd, stdout=subprocess.PIPE, stderr=err_file, shell=True)
+    except:
+        return "Importing {0} - Couldn't convert Shapefile to SQL".format(file_path)
+
+    try:
+        # run everything up to the COPY statement (create table etc...)
+        pre_copy_lines = list()
+        copy_sql = None
+
+        for line in iter(process.stdout.readline, b""):
+            line = line.decode("utf-8")
+
+            if line.startswith("COPY "):
+                copy_sql = line.strip().rstrip(";")
+                break
+
+            pre_copy_lines.append(line)
+
+        if copy_sql is None:
+            raise Exception("no COPY statement found in shp2pgsql output")
+
+        pre_copy_sql = prep_shapefile_sql("".join(pre_copy_lines), delete_table, spatial, staging)
+        row_transform = None
+
+        # prefix the ids as they're streamed, into a text id column
+        if id_prefix is not None:
+            pre_copy_sql = set_column_type(pre_copy_sql, id_prefix[0], "text")
+            row_transform = get_id_prefix_transform(copy_sql, id_prefix)
+
+        pg_cur.execute(pre_copy_sql)
+
+        # stream the data rows
+        pg_cur.copy_expert(copy_sql, CopyDataStream(process.stdout, row_transform), size=COPY_BUFFER_SIZE)
+
+        # run whatever's left (create index, commit & analyse) - if shp2pgsql succeeded (its output may be cut short)
+        post_copy_sql = process.stdout.read().decode("utf-8")
+
+        if process.wait() != 0:
+            raise Exception("shp2pgsql failed with exit code {0}".format(process.returncode))
+
+        pg_cur.execute(prep_shapefile_sql(post_copy_sql, delete_table, spatial, staging))
+
+    except Exception as ex:
+        # the dump runs in a transaction - clear it so the connection can be reused
+        rollback_transaction(pg_cur)
+
+        process.kill()
+        process.wait()
+
+        err_file.seek(0)
+        err = err_file.read().decode("utf-8", "replace")
+
+        return "\tImporting {0} - Couldn't copy Shapefile data : {1}\nshp2pgsql result was: {2} " \
+            .format(file_path, ex, err)
+
+    finally:
+        process.stdout.close()
+        err_file.close()
+
+    return "SUCCESS"
+
+
+# fixes shp2pgsql output so it runs cleanly on all versions of PostGIS
+def prep_shapefile_sql(sql, delete_table, spatial, staging=False):
     sql = sql.replace("Shapefile type: ", "-- Shapefile type: ")
     sql = sql.replace("Postgis type: ", "-- Postgis type: ")
     sql = sql.replace("SELECT DropGeometryColumn", "-- SELECT DropGeometryColumn")
@@ -396,23 +1484,120 @@ def import_shapefile_to_postgres(pg_cur, file_path, pg_table, pg_schema, delete_
     sql = sql.replace("DROP TABLE ", "DROP TABLE IF EXISTS ")
     sql = sql.replace("DROP TABLE IF EXISTS IF EXISTS ", "DROP TABLE IF EXISTS ")
 
-    # import data to Postgres
+    # staging tables don't need to survive a crash - skip writing them to the WAL
+    if staging:
+        sql = sql.replace("CREATE TABLE ", "CREATE UNLOGGED TABLE ")
+
+    return sql
+
+
+# changes the type of a column in shp2pgsql's CREATE TABLE statement (e.g. "ced_code16" varchar(3) > text)
+def set_column_type(sql, column_name, column_type):
+    return re.sub(r'"{0}" [a-z0-9_ ]+(\([0-9, ]+\))?(?=[,)])'.format(re.escape(column_name)),
+                  '"{0}" {1}'.format(column_name, column_type), sql, count=1)
+
+
+# returns a function that adds a prefix to the id field of a shp2pgsql dump data row (tab separated COPY text)
+def get_id_prefix_transform(copy_sql, id_prefix):
+    id_field, prefix = id_prefix
+
+    # find the id field in the COPY statement's column list
+    column_list = [column.strip().strip('"') for column in
+                   copy_sql[copy_sql.index("(") + 1:copy_sql.index(")")].split(",")]
+    id_position = column_list.index(id_field)
+
+    prefix = prefix.encode("utf-8")
+
+    def add_prefix(row):
+        values = row.split(b"\t", id_position + 1)
+
+        if values[id_position] != b"\\N":
+            values[id_position] = prefix + values[id_position]
+
+        return b"\t".join(values)
+
+    return add_prefix
+
+
+# adds an id prefix to a shp2pgsql SQL script: the id field is converted to text & prefixed in one rewrite,
+# before the spatial index (if any) is created, so the index is only built once.
+# appends to an existing table only prefix the new rows
+def add_id_prefix_sql(sql, id_prefix, delete_table):
+    table_name = re.search(r'^(?:CREATE (?:UNLOGGED )?TABLE|INSERT INTO) ("[^"]+"\."[^"]+")', sql,
+                           re.MULTILINE).group(1)
+    id_field, prefix = id_prefix
+
+    if delete_table:
+        alter_sql = "ALTER TABLE {0} ALTER COLUMN \"{1}\" TYPE text USING '{2}' || \"{1}\";\n"\
+            .format(table_name, id_field, prefix)
+    else:
+        alter_sql = "UPDATE {0} SET \"{1}\" = '{2}' || \"{1}\" WHERE left(\"{1}\", {3}) <> '{2}';\n"\
+            .format(table_name, id_field, prefix, len(prefix))
+
+    position = re.search(r"^(CREATE INDEX |COMMIT;)", sql, re.MULTILINE)
+
+    if position is None:
+        return sql + alter_sql
+
+    return sql[:position.start()] + alter_sql + sql[position.start():]
+
+
+# ends a failed transaction on a connection that's being reused (connections are in autocommit mode, so this only
+# matters when a script issued its own BEGIN)
+def rollback_transaction(pg_cur):
     try:
-        pg_cur.execute(sql)
+        pg_cur.execute("ROLLBACK")
     except:
-        # if import fails for some reason - output sql to file for debugging
-        target = open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fail_{}.sql'.format(pg_table)), "w")
-        target.write(sql)
+        pass
 
-        return "\tImporting {0} - Couldn't run Shapefile SQL\nshp2pgsql result was: {1} ".format(file_path, err)
 
-    # Cluster table on spatial index for performance
-    if delete_table and spatial:
-        sql = "ALTER TABLE {0}.{1} CLUSTER ON {1}_geom_idx".format(pg_schema, pg_table)
+# read-only file-like wrapper over the data section of a COPY ... FROM stdin dump (e.g. shp2pgsql -D output).
+# returns the raw data rows as they're read and stops at the \. end of data marker, leaving the rest of the dump unread
+# row_transform is an optional function that changes each data row as it's read
+class CopyDataStream(object):
 
-        try:
-            pg_cur.execute(sql)
-        except:
-            return "\tImporting {0} - Couldn't cluster on spatial index".format(pg_table)
+    def __init__(self, dump_file, row_transform=None):
+        self.dump_file = dump_file
+        self.row_transform = row_transform
+        self.finished = False
+        self.buffer = bytearray()
+
+    # reads the next data row into the buffer. returns False at the end of the data
+    def _next_row(self):
+        if not self.finished:
+            line = self.dump_file.readline()
+
+            if line == b"" or line.rstrip(b"\r\n") == b"\\.":
+                self.finished = True
+            elif self.row_transform is not None:
+                self.buffer += self.row_transform(line)
+            else:
+                self.buffer += line
+
+        return not self.finished
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self.buffer) < size) and self._next_row():
+            pass
+
+        if size is None or size < 0:
+            size = len(self.buffer)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+    def readline(self, size=-1):
+        if len(self.buffer) == 0:
+            self._next_row()
+
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+
+        if size is not None and 0 <= size < end:
+            end = size
+
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
 
-    return "SUCCESS"
\ No newline at end of file
+        return data